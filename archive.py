@@ -0,0 +1,282 @@
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime
+
+MAGIC = b"\x93NUMPY"
+HEADER_SIZE = 128
+ENDIAN = "<" if sys.byteorder == "little" else ">"
+
+# One row per quarter. Every column is its own .npy file, so numpy.load
+# with mmap_mode="r" opens them as they are. power is the forced power in
+# W, negative while discharging.
+COLUMNS = (
+    ("start", "d", f"{ENDIAN}f8"),
+    ("price", "f", f"{ENDIAN}f4"),
+    ("action", "b", "|i1"),
+    ("power", "f", f"{ENDIAN}f4"),
+    ("target_soc", "f", f"{ENDIAN}f4"),
+    ("soc", "f", f"{ENDIAN}f4"),
+    ("consumption", "f", f"{ENDIAN}f4"),
+    ("solar", "f", f"{ENDIAN}f4"),
+)
+# Planned action of a quarter
+IDLE = 0
+CHARGE = 1
+DISCHARGE = 2
+
+SHAPE = re.compile(rb"'shape': \((\d+),\)")
+
+
+def npy_header(descr, rows):
+    # Always HEADER_SIZE bytes, so the row count can be rewritten in place
+    text = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': ({rows},), }}"
+    text = text.ljust(HEADER_SIZE - len(MAGIC) - 4 - 1) + "\n"
+    return MAGIC + b"\x01\x00" + struct.pack("<H", len(text)) + text.encode("latin1")
+
+
+def header_rows(header):
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        return None
+    match = SHAPE.search(header)
+    return int(match.group(1)) if match else None
+
+
+class Chunk:
+    # One day or month of quarters, every column mapped read-only and cast
+    # to a flat memoryview. Slices of them share the mapping, which stays
+    # open until close() or until the last of them is dropped.
+    def __init__(self, path):
+        self.path = path
+        self.name = path.name
+        self.columns = {}
+        self.mappings = []
+        rows = None
+        for name, typecode, _ in COLUMNS:
+            with (path / f"{name}.npy").open("rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mappings.append(mapping)
+            count = header_rows(mapping[:HEADER_SIZE])
+            if count is None:
+                raise ValueError(f"Not an archive column: {path / name}.npy")
+            view = memoryview(mapping)[HEADER_SIZE:].cast("B")
+            column = view[: count * array(typecode).itemsize].cast(typecode)
+            self.columns[name] = column
+            rows = count if rows is None else min(rows, count)
+        self.rows = rows or 0
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Slices taken with slice() must be gone by now
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        for mapping in self.mappings:
+            mapping.close()
+        self.mappings = []
+
+    def slice(self, start_ts, end_ts):
+        # Column views of the quarters starting in [start_ts, end_ts)
+        starts = self.columns["start"]
+        i = bisect_left(starts, start_ts, 0, self.rows)
+        j = bisect_left(starts, end_ts, i, self.rows)
+        return {name: column[i:j] for name, column in self.columns.items()}
+
+
+class QuarterArchive:
+    # Append-only per-quarter record of prices, the plan and what the
+    # battery did. Rows go to a chunk per local day under days/, and
+    # compact() rolls finished months into a chunk under months/.
+    def __init__(self, path, tz):
+        self.path = path
+        self.tz = tz
+        self.current = None
+        self.current_rows = 0
+        self.last_start = None
+        # Column files of the current chunk, kept open between appends
+        self.files = {}
+
+    def append(self, row):
+        # row maps column names to values, missing ones are stored as NaN
+        # (0 for action). Quarters must come in time order.
+        start = row["start"]
+        if self.last_start is not None and start <= self.last_start:
+            return False
+        chunk = self.path / "days" / datetime.fromtimestamp(start, self.tz).date().isoformat()
+        if chunk != self.current:
+            self.open_chunk(chunk)
+            if self.last_start is not None and start <= self.last_start:
+                return False
+
+        # Data first and the row count after, so a crash in between only
+        # leaves bytes that open_chunk cuts off
+        rows = self.current_rows + 1
+        for name, typecode, descr in COLUMNS:
+            value = row.get(name)
+            if value is None:
+                value = 0 if typecode == "b" else float("nan")
+            f = self.files[name]
+            f.seek(HEADER_SIZE + self.current_rows * array(typecode).itemsize)
+            f.write(array(typecode, [value]).tobytes())
+            f.seek(0)
+            f.write(npy_header(descr, rows))
+            f.flush()
+        self.current_rows = rows
+        self.last_start = start
+        return True
+
+    def open_chunk(self, chunk):
+        self.close()
+        chunk.mkdir(parents=True, exist_ok=True)
+        rows = None
+        for name, typecode, descr in COLUMNS:
+            column = chunk / f"{name}.npy"
+            if not column.exists():
+                column.write_bytes(npy_header(descr, 0))
+            with column.open("rb") as f:
+                count = header_rows(f.read(HEADER_SIZE))
+            count = count or 0
+            rows = count if rows is None else min(rows, count)
+        for name, typecode, descr in COLUMNS:
+            f = self.files[name] = (chunk / f"{name}.npy").open("r+b")
+            f.truncate(HEADER_SIZE + rows * array(typecode).itemsize)
+            f.write(npy_header(descr, rows))
+            f.flush()
+        self.current = chunk
+        self.current_rows = rows
+        if rows:
+            with Chunk(chunk) as existing:
+                last = existing.columns["start"][rows - 1]
+            self.last_start = last if self.last_start is None else max(self.last_start, last)
+
+    def close(self):
+        # Appending to the current chunk opens its files again
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.current = None
+
+    def chunks(self, first=None, last=None):
+        # Chunks holding local days first..last (dates, both optional) in
+        # time order
+        found = []
+        for kind in ("months", "days"):
+            folder = self.path / kind
+            if not folder.exists():
+                continue
+            for chunk in folder.iterdir():
+                if chunk.name.endswith((".tmp", ".old")):
+                    continue
+                if kind == "months":
+                    year, month = map(int, chunk.name.split("-"))
+                    begins = date(year, month, 1)
+                    ends = date(year + month // 12, month % 12 + 1, 1)
+                else:
+                    begins = date.fromisoformat(chunk.name)
+                    ends = date.fromordinal(begins.toordinal() + 1)
+                if (last is not None and begins > last) or (first is not None and ends <= first):
+                    continue
+                found.append((chunk.name, chunk))
+        return [Chunk(chunk) for _, chunk in sorted(found)]
+
+    def scan(self, start=None, end=None):
+        # Column views per chunk for the quarters starting in [start, end),
+        # nothing is copied. A missing bound leaves that side open.
+        start_ts = start.timestamp() if start is not None else float("-inf")
+        end_ts = end.timestamp() if end is not None else float("inf")
+        first = start.astimezone(self.tz).date() if start is not None else None
+        last = end.astimezone(self.tz).date() if end is not None else None
+        for chunk in self.chunks(first, last):
+            columns = chunk.slice(start_ts, end_ts)
+            if len(columns["start"]):
+                yield columns
+
+    def read(self, start=None, end=None):
+        # The same quarters as scan() joined into one array per column
+        result = {name: array(typecode) for name, typecode, _ in COLUMNS}
+        for columns in self.scan(start, end):
+            for name, column in columns.items():
+                result[name].frombytes(column.tobytes())
+        return result
+
+    def compact(self, today):
+        # Rolls the day chunks of every month before today's into one chunk
+        # per month. A month chunk left by an interrupted run is merged
+        # with the days again. The old month chunk is only moved aside
+        # until the new one is in place, so a crash never leaves the merged
+        # copy in the .tmp folder alone.
+        folder = self.path / "days"
+        if not folder.exists():
+            return []
+        current_month = today.isoformat()[:7]
+        months = {}
+        for chunk in sorted(folder.iterdir()):
+            month = chunk.name[:7]
+            if chunk.name.endswith(".tmp") or month >= current_month:
+                continue
+            months.setdefault(month, []).append(chunk)
+
+        compacted = []
+        for month, days in sorted(months.items()):
+            target = self.path / "months" / month
+            old = target.with_name(month + ".old")
+            if old.exists():
+                if target.exists():
+                    shutil.rmtree(old)
+                else:
+                    os.replace(old, target)
+            sources = ([target] if target.exists() else []) + days
+            tmp = target.with_name(month + ".tmp")
+            shutil.rmtree(tmp, ignore_errors=True)
+            tmp.mkdir(parents=True)
+            chunks = [Chunk(source) for source in sources]
+            try:
+                self.write_merged(tmp, chunks)
+            finally:
+                for chunk in chunks:
+                    chunk.close()
+            if any(self.current == day for day in days):
+                self.close()
+            if target.exists():
+                os.replace(target, old)
+            os.replace(tmp, target)
+            shutil.rmtree(old, ignore_errors=True)
+            for day in days:
+                shutil.rmtree(day)
+            compacted.append(month)
+        return compacted
+
+    def write_merged(self, folder, chunks):
+        # Rows in time order, a quarter present in more than one source is
+        # kept once
+        keep = []
+        last = None
+        for chunk in chunks:
+            starts = chunk.columns["start"]
+            first = 0
+            if last is not None:
+                first = bisect_left(starts, last + 1e-6, 0, chunk.rows)
+            if first < chunk.rows:
+                keep.append((chunk, first))
+                last = starts[chunk.rows - 1]
+        rows = sum(chunk.rows - first for chunk, first in keep)
+        for name, typecode, descr in COLUMNS:
+            with (folder / f"{name}.npy").open("wb") as f:
+                f.write(npy_header(descr, rows))
+                for chunk, first in keep:
+                    f.write(chunk.columns[name][first : chunk.rows].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
@@ -0,0 +1,73 @@
+import asyncio
+from datetime import timedelta
+from battery_commands import AsyncInverterCommander
+from constants import SERVICE_CALL_TIMEOUT
+from metrics import timer
+from price_series import PriceSeries
+from scheduler import SungrowScheduler
+
+
+class AsyncSungrowScheduler(SungrowScheduler):
+    # Variant on AppDaemon's async API: both price days are fetched
+    # concurrently on the loop and inverter writes go out through
+    # AsyncInverterCommander. The planning logic itself is unchanged and
+    # runs in the executor with the prices already in hand.
+
+    commander_class = AsyncInverterCommander
+
+    def initialize(self):
+        self.prefetched_prices = None
+        super().initialize()
+
+    # The price watcher runs these once tomorrow's prices are in, so the
+    # prefetch wraps the code that reads them
+    async def plan_night(self, run_time=None):
+        await self.run_with_prices(super().plan_night, run_time)
+
+    async def check_no_nightly_charge(self, run_time=None):
+        await self.run_with_prices(super().check_no_nightly_charge, run_time)
+
+    def run_price_job(self, job):
+        # Coroutine planners go through AppDaemon to run on its loop
+        if asyncio.iscoroutinefunction(job):
+            self.run_in(job, 0)
+        else:
+            job()
+
+    async def run_with_prices(self, planner, run_time):
+        self.prefetched_prices = await self.fetch_prices()
+        try:
+            await self.run_in_executor(planner, run_time)
+        finally:
+            self.prefetched_prices = None
+
+    def get_prices(self):
+        if self.prefetched_prices is not None:
+            return self.prefetched_prices
+        return super().get_prices()
+
+    async def fetch_prices(self):
+        today = self.local_now().date()
+        with timer(self, "price_fetch"):
+            days = await asyncio.gather(
+                *(self.fetch_price_day(dt) for dt in (today, today + timedelta(days=1)))
+            )
+        all_prices = [q for day_prices in days for q in day_prices]
+        self.log(f"Retrieved {len(all_prices)} hourly prices")
+        return PriceSeries.from_quarters(all_prices, self.tz, first_day=today)
+
+    async def fetch_price_day(self, dt):
+        request = self.price_request(dt)
+        cached = self.price_cache.get(request["areas"], request["currency"], dt, now=self.local_now().timestamp())
+        if cached is not None:
+            return cached
+
+        try:
+            result = await asyncio.wait_for(
+                self.call_service("nordpool/get_prices_for_date", **request),
+                SERVICE_CALL_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            self.error(f"Timed out fetching prices for {dt}")
+            return []
+        return self.store_price_day(dt, self.extract_day_prices(result, dt))
@@ -1,67 +1,216 @@
+import asyncio
+from constants import (
+    COMMAND_COALESCE_SECONDS,
+    SERVICE_CALL_TIMEOUT,
+    MAX_INFLIGHT_WRITES
+)
+from metrics import timed, timer
+
+EMS_MODE = "input_select.set_sg_ems_mode"
+FORCED_CMD = "input_select.set_sg_battery_forced_charge_discharge_cmd"
+MAX_SOC = "input_number.set_sg_max_soc"
+FORCED_POWER = "input_number.set_sg_forced_charge_discharge_power"
+
+# Write order matches the order the inverter expects the fields in
+ENTITIES = (EMS_MODE, FORCED_CMD, MAX_SOC, FORCED_POWER)
+
+
+class InverterCommander:
+    # Requests and the known state are keyed by the names in ENTITIES.
+    # `entities` maps them, in the same order, onto another inverter's
+    # entity ids. A request is written straight away, requests arriving
+    # within coalesce_seconds of a write are held back and written
+    # together when that window ends.
+    def __init__(self, app, coalesce_seconds=COMMAND_COALESCE_SECONDS, on_commanded=None, entities=None):
+        self.app = app
+        self.coalesce_seconds = coalesce_seconds
+        self.on_commanded = on_commanded
+        self.entity_ids = dict(zip(ENTITIES, entities or ENTITIES))
+        self.roles = {entity_id: role for role, entity_id in self.entity_ids.items()}
+        self.known = {}
+        self.pending = {}
+        self.flush_handle = None
+
+    def resync(self):
+        for entity_id in ENTITIES:
+            self.known[entity_id] = normalize(entity_id, self.app.get_state(self.entity_ids[entity_id]))
+
+    def listen(self):
+        for entity_id in ENTITIES:
+            self.app.listen_state(self.on_entity_change, self.entity_ids[entity_id])
+
+    def on_entity_change(self, entity, attribute, old, new, kwargs):
+        role = self.roles.get(entity, entity)
+        self.known[role] = normalize(role, new)
+
+    def request(self, values, immediate=False):
+        # Immediate requests do not wait for a window or open one, and
+        # take whatever was already waiting along
+        self.pending.update(values)
+        if immediate and self.flush_handle is not None:
+            self.app.cancel_timer(self.flush_handle)
+            self.flush_handle = None
+        if self.flush_handle is None:
+            self.flush(window=not immediate)
+
+    def open_window(self):
+        if self.coalesce_seconds > 0:
+            self.flush_handle = self.app.run_in(self.flush, self.coalesce_seconds)
+
+    def flush(self, kwargs=None, window=True):
+        self.flush_handle = None
+        pending, self.pending = self.pending, {}
+        sent = False
+
+        for entity_id in ENTITIES:
+            if entity_id not in pending:
+                continue
+            value = pending[entity_id]
+            if self.known.get(entity_id) == value:
+                continue
+
+            if window and not sent:
+                self.open_window()
+            service, service_kwargs = service_call(self.entity_ids[entity_id], value)
+            with timer(self.app, "service_call"):
+                self.app.call_service(service, **service_kwargs)
+            self.known[entity_id] = value
+            sent = True
+
+        if sent and self.on_commanded is not None:
+            self.on_commanded()
+
+
+class AsyncInverterCommander(InverterCommander):
+    # Same cache and coalescing, but the flush runs on the AppDaemon loop
+    # and sends the writes concurrently with a bounded number in flight
+    def __init__(
+        self,
+        app,
+        coalesce_seconds=COMMAND_COALESCE_SECONDS,
+        on_commanded=None,
+        max_inflight=MAX_INFLIGHT_WRITES,
+        timeout=SERVICE_CALL_TIMEOUT,
+        entities=None
+    ):
+        super().__init__(app, coalesce_seconds, on_commanded, entities)
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.timeout = timeout
+
+    def request(self, values, immediate=False):
+        self.pending.update(values)
+        if immediate and self.flush_handle is not None:
+            self.app.cancel_timer(self.flush_handle)
+            self.flush_handle = None
+        if self.flush_handle is None:
+            self.flush_handle = self.app.run_in(self.flush, 0, window=not immediate)
+
+    async def flush(self, kwargs=None):
+        self.flush_handle = None
+        pending, self.pending = self.pending, {}
+
+        changes = [
+            (entity_id, pending[entity_id])
+            for entity_id in ENTITIES
+            if entity_id in pending and self.known.get(entity_id) != pending[entity_id]
+        ]
+
+        sent = bool(changes)
+        # Requests arriving while these are in flight wait for the window
+        if sent and (kwargs or {}).get("window", True):
+            self.open_window()
+
+        # The EMS mode decides how the inverter reads the forced fields,
+        # so it has to land before the rest are sent
+        if changes and changes[0][0] == EMS_MODE:
+            await self.send(*changes[0])
+            changes = changes[1:]
+
+        await asyncio.gather(*(self.send(entity_id, value) for entity_id, value in changes))
+
+        if sent and self.on_commanded is not None:
+            self.on_commanded()
+
+    async def send(self, entity_id, value):
+        service, service_kwargs = service_call(self.entity_ids[entity_id], value)
+        async with self.semaphore:
+            try:
+                with timer(self.app, "service_call"):
+                    await asyncio.wait_for(self.app.call_service(service, **service_kwargs), self.timeout)
+            except asyncio.TimeoutError:
+                self.app.error(f"Timed out setting {self.entity_ids[entity_id]} to {value}")
+                # Unknown outcome, make sure the next request writes it again
+                self.known.pop(entity_id, None)
+                return
+        self.known[entity_id] = value
+
+
+def service_call(entity_id, value):
+    if entity_id.startswith("input_select."):
+        return "input_select/select_option", {"entity_id": entity_id, "option": value}
+    return "input_number/set_value", {"entity_id": entity_id, "value": value}
+
+
+def normalize(entity_id, value):
+    if value is None or entity_id.startswith("input_select."):
+        return value
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def get_commander(app):
+    commander = getattr(app, "inverter", None)
+    if commander is None:
+        commander = app.inverter = InverterCommander(app)
+    return commander
+
+
+@timed("command.set_start_charge")
 def set_start_charge(app, target_soc, power):
-    app.call_service(
-        "input_select/select_option",
-        entity_id="input_select.set_sg_ems_mode",
-        option="Forced mode"
-    )
-    app.call_service(
-        "input_select/select_option",
-        entity_id="input_select.set_sg_battery_forced_charge_discharge_cmd",
-        option="Forced charge"
-    )
-    app.call_service(
-        "input_number/set_value",
-        entity_id="input_number.set_sg_max_soc",
-        value=target_soc
-    )
-    app.call_service(
-        "input_number/set_value",
-        entity_id="input_number.set_sg_forced_charge_discharge_power",
-        value=power
-    )
+    get_commander(app).request({
+        EMS_MODE: "Forced mode",
+        FORCED_CMD: "Forced charge",
+        MAX_SOC: float(target_soc),
+        FORCED_POWER: float(power),
+    })
 
+@timed("command.set_stop_charge")
 def set_stop_charge(app):
-    app.call_service(
-        "input_select/select_option",
-        entity_id="input_select.set_sg_battery_forced_charge_discharge_cmd",
-        option="Stop (default)"
-    )
-    app.call_service(
-        "input_number/set_value",
-        entity_id="input_number.set_sg_max_soc",
-        value=100
-    )
-    app.call_service(
-        "input_number/set_value",
-        entity_id="input_number.set_sg_forced_charge_discharge_power",
-        value=0
-    )
+    get_commander(app).request({
+        FORCED_CMD: "Stop (default)",
+        MAX_SOC: 100.0,
+        FORCED_POWER: 0.0,
+    })
 
+@timed("command.set_start_discharge")
 def set_start_discharge(app):
-    app.call_service(
-        "input_select/select_option",
-        entity_id="input_select.set_sg_ems_mode",
-        option="Self-consumption mode (default)"
-    )
-    app.call_service(
-        "input_select/select_option",
-        entity_id="input_select.set_sg_battery_forced_charge_discharge_cmd",
-        option="Stop (default)"
-    )
-    app.call_service(
-        "input_number/set_value",
-        entity_id="input_number.set_sg_max_soc",
-        value=100
-    )
-    app.call_service(
-        "input_number/set_value",
-        entity_id="input_number.set_sg_forced_charge_discharge_power",
-        value=0
-    )
+    get_commander(app).request({
+        EMS_MODE: "Self-consumption mode (default)",
+        FORCED_CMD: "Stop (default)",
+        MAX_SOC: 100.0,
+        FORCED_POWER: 0.0,
+    })
     
+@timed("command.set_stop_discharge")
 def set_stop_discharge(app):
-    app.call_service(
-        "input_select/select_option",
-        entity_id="input_select.set_sg_ems_mode",
-        option="Forced mode"
-    )
+    get_commander(app).request({
+        EMS_MODE: "Forced mode",
+    })
+
+@timed("command.set_forced_discharge")
+def set_forced_discharge(app, power):
+    get_commander(app).request({
+        EMS_MODE: "Forced mode",
+        FORCED_CMD: "Forced discharge",
+        FORCED_POWER: float(power),
+    }, immediate=True)
+
+@timed("command.set_stop_forced_discharge")
+def set_stop_forced_discharge(app):
+    get_commander(app).request({
+        EMS_MODE: "Forced mode",
+        FORCED_CMD: "Stop (default)",
+        FORCED_POWER: 0.0,
+    })
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.corpus import TZ, generate_price_day
+from benchmarks.fake_hass import FakeHass, install
+
+install()
+
+from async_scheduler import AsyncSungrowScheduler
+from battery_commands import (
+    ENTITIES,
+    AsyncInverterCommander,
+    InverterCommander,
+    set_start_charge,
+    set_start_discharge,
+)
+from price_cache import PriceCache
+from scheduler import SungrowScheduler
+
+
+class SlowScheduler(SungrowScheduler):
+    latency = 0.0
+
+    def call_service(self, service, **kwargs):
+        time.sleep(self.latency)
+        return FakeHass.call_service(self, service, **kwargs)
+
+
+class SlowAsyncScheduler(AsyncSungrowScheduler):
+    latency = 0.0
+
+    async def call_service(self, service, **kwargs):
+        await asyncio.sleep(self.latency)
+        return FakeHass.call_service(self, service, **kwargs)
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: func(*args, **kwargs))
+
+
+def make_app(cls, latency):
+    rng = random.Random(1)
+    today = datetime.now(TZ).date()
+    prices_by_date = {
+        (today + timedelta(days=i)).isoformat(): generate_price_day(rng, today + timedelta(days=i))
+        for i in range(2)
+    }
+    app = cls(prices_by_date=prices_by_date, tz=TZ)
+    app.latency = latency
+    app.prefetched_prices = None
+    return app
+
+
+def measure_sync(latency, runs):
+    app = make_app(SlowScheduler, latency)
+    commander = app.inverter = InverterCommander(app, coalesce_seconds=0)
+
+    fetch = []
+    switch = []
+    for _ in range(runs):
+        app.price_cache = PriceCache()
+        started = time.perf_counter()
+        prices = app.get_prices()
+        fetch.append(time.perf_counter() - started)
+        assert prices.is_complete_day(0) and prices.is_complete_day(1)
+
+        set_start_discharge(app)
+        started = time.perf_counter()
+        set_start_charge(app, 80, 3000)
+        switch.append(time.perf_counter() - started)
+    return fetch, switch, commander
+
+
+async def measure_async(latency, runs):
+    app = make_app(SlowAsyncScheduler, latency)
+    commander = app.inverter = AsyncInverterCommander(app, coalesce_seconds=0)
+
+    fetch = []
+    switch = []
+    for _ in range(runs):
+        app.price_cache = PriceCache()
+        started = time.perf_counter()
+        prices = await app.fetch_prices()
+        fetch.append(time.perf_counter() - started)
+        assert prices.is_complete_day(0) and prices.is_complete_day(1)
+
+        set_start_discharge(app)
+        await commander.flush()
+        set_start_charge(app, 80, 3000)
+        started = time.perf_counter()
+        await commander.flush()
+        switch.append(time.perf_counter() - started)
+    return fetch, switch, commander
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare sync and async service paths under injected latency")
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+    latency = args.latency_ms / 1000
+
+    sync_fetch, sync_switch, sync_commander = measure_sync(latency, args.runs)
+    async_fetch, async_switch, async_commander = asyncio.run(measure_async(latency, args.runs))
+
+    for entity_id in ENTITIES:
+        assert sync_commander.known[entity_id] == async_commander.known[entity_id]
+
+    print(f"injected latency {args.latency_ms:.0f} ms per service call")
+    print(f"{'path':<16} {'sync ms':>9} {'async ms':>9}")
+    for name, sync_values, async_values in (
+        ("price fetch", sync_fetch, async_fetch),
+        ("charge switch", sync_switch, async_switch),
+    ):
+        print(
+            f"{name:<16} "
+            f"{sum(sync_values) / len(sync_values) * 1000:>9.1f} "
+            f"{sum(async_values) / len(async_values) * 1000:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
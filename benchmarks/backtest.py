@@ -0,0 +1,382 @@
+import argparse
+import json
+import math
+import random
+import time
+from array import array
+from datetime import datetime, time as clock_time, timedelta
+from pathlib import Path
+
+from benchmarks.corpus import TZ, DAY_KINDS, generate_price_day
+from benchmarks.fake_hass import install
+
+install()
+
+import battery_commands
+import consumption
+import constants
+import load_follow
+import optimizer
+import scheduler
+from archive import QuarterArchive
+from battery_commands import EMS_MODE, FORCED_CMD, MAX_SOC, FORCED_POWER, InverterCommander
+from consumption import CONSUMPTION_SENSOR
+from forecast import FORECAST_SENSOR
+from plan_cache import PlanCache
+from price_series import PriceSeries, quarters_in_day
+from sites import Site
+
+SEED = 2025
+# Modules that import tunable constants by name
+TUNABLE_MODULES = (constants, optimizer, scheduler, consumption, battery_commands, load_follow)
+
+
+class History:
+    # Quarter prices plus consumption and solar Wh aligned with them, and
+    # the raw Nordpool-shaped days the fake service answers with
+    def __init__(self, price_days, consumption_wh, solar_wh):
+        self.price_days = price_days
+        self.prices = PriceSeries.from_quarters([q for day in price_days for q in day], TZ)
+        self.consumption_wh = array("d", consumption_wh)
+        self.solar_wh = array("d", solar_wh)
+        if not len(self.prices) == len(self.consumption_wh) == len(self.solar_wh):
+            raise ValueError("prices, consumption and solar must have one value per quarter")
+        self.prices_by_date = {
+            datetime.fromisoformat(day[0]["start"]).date().isoformat(): day
+            for day in price_days if day
+        }
+
+
+def generate_history(seed, first_day, days):
+    rng = random.Random(seed)
+    price_days = []
+    consumption_wh = []
+    solar_wh = []
+    for i in range(days):
+        day = first_day + timedelta(days=i)
+        price_day = generate_price_day(rng, day, rng.choice(DAY_KINDS))
+        price_days.append(price_day)
+
+        # Heating load in winter on top of morning and evening peaks
+        base = rng.uniform(250, 450) if scheduler.is_winter_day(day) else rng.uniform(120, 250)
+        # Daylight hours and peak output follow the season
+        season = math.cos(2 * math.pi * (day.timetuple().tm_yday - 172) / 365)
+        sunrise = 6.5 - 3 * season
+        sunset = 17.5 + 4.5 * season
+        peak_kw = 8 * (0.35 + 0.65 * (season + 1) / 2) * rng.uniform(0.2, 1.0)
+
+        for q in price_day:
+            start = datetime.fromisoformat(q["start"])
+            hour = start.hour + start.minute / 60
+            peak = math.exp(-((hour - 7.5) ** 2) / 2) + 1.4 * math.exp(-((hour - 18.5) ** 2) / 4)
+            consumption_wh.append(base * (0.7 + peak) * rng.uniform(0.8, 1.2))
+            if sunrise < hour < sunset:
+                kw = peak_kw * math.sin(math.pi * (hour - sunrise) / (sunset - sunrise))
+                solar_wh.append(kw * 250 * rng.uniform(0.8, 1.0))
+            else:
+                solar_wh.append(0.0)
+    return History(price_days, consumption_wh, solar_wh)
+
+
+def load_history(path):
+    # JSON with "prices" (Nordpool quarter dicts), "consumption_wh" and
+    # "solar_wh" lists aligned with the prices, or a scheduler archive
+    # directory
+    if Path(path).is_dir():
+        return load_archive(path)
+    data = json.loads(Path(path).read_text())
+    price_days = {}
+    for q in data["prices"]:
+        price_days.setdefault(datetime.fromisoformat(q["start"]).astimezone(TZ).date(), []).append(q)
+    return History(
+        [price_days[day] for day in sorted(price_days)],
+        data["consumption_wh"],
+        data["solar_wh"],
+    )
+
+
+def load_archive(path):
+    # The longest run of consecutive days the archive has complete price
+    # and consumption rows for. The archive only knows forecast solar, so
+    # that stands in for production.
+    archive = QuarterArchive(Path(path), TZ)
+    days = {}
+    for columns in archive.scan():
+        starts, prices, consumption, solar = (columns[name] for name in ("start", "price", "consumption", "solar"))
+        for i in range(len(starts)):
+            start = datetime.fromtimestamp(starts[i], TZ)
+            days.setdefault(start.date(), []).append((start, prices[i], consumption[i], solar[i]))
+
+    complete = [
+        day for day, rows in sorted(days.items())
+        if len(rows) == quarters_in_day(TZ, day)
+        and not any(math.isnan(price) or math.isnan(wh) for _, price, wh, _ in rows)
+    ]
+    best = []
+    run = []
+    for day in complete:
+        if run and (day - run[-1]).days != 1:
+            run = []
+        run.append(day)
+        if len(run) > len(best):
+            best = list(run)
+    if not best:
+        raise ValueError(f"No complete days in {path}")
+
+    price_days = []
+    consumption_wh = []
+    solar_wh = []
+    for day in best:
+        price_day = []
+        for start, price, wh, solar in days[day]:
+            price_day.append({
+                "start": start.isoformat(),
+                "end": datetime.fromtimestamp(start.timestamp() + 900, TZ).isoformat(),
+                "price": round(price, 2),
+            })
+            consumption_wh.append(wh)
+            solar_wh.append(0.0 if math.isnan(solar) else solar)
+        price_days.append(price_day)
+    return History(price_days, consumption_wh, solar_wh)
+
+
+def apply_overrides(overrides):
+    # Returns the previous values so the caller can restore them
+    previous = {}
+    for name, value in overrides.items():
+        if not hasattr(constants, name):
+            raise ValueError(f"Unknown constant {name}")
+        previous[name] = getattr(constants, name)
+        for module in TUNABLE_MODULES:
+            if name in vars(module):
+                setattr(module, name, value)
+    return previous
+
+
+class SimulatedBattery:
+    # Energy balance of one quarter at a time, driven by the same inverter
+    # entities the scheduler writes. Returns grid Wh, negative on export.
+    __slots__ = ("energy", "capacity", "floor", "limit")
+
+    def __init__(self, soc):
+        self.capacity = constants.BATTERY_CAPACITY
+        self.floor = constants.MIN_SOC / 100 * self.capacity
+        self.limit = constants.MAX_CHARGE_POWER * 0.25
+        self.energy = soc / 100 * self.capacity
+
+    @property
+    def soc(self):
+        return self.energy / self.capacity * 100
+
+    def step(self, mode, cmd, max_soc, power, load_wh, solar_wh):
+        net = load_wh - solar_wh
+        ceiling = min(max_soc if max_soc is not None else 100, 100) / 100 * self.capacity
+
+        if mode == "Forced mode":
+            if cmd == "Forced charge":
+                charge = min((power or 0) * 0.25, self.limit, max(ceiling - self.energy, 0))
+                self.energy += charge
+                return net + charge
+            if cmd == "Forced discharge":
+                discharge = min((power or 0) * 0.25, max(self.energy - self.floor, 0))
+                self.energy -= discharge
+                return net - discharge
+            return net
+
+        # Self-consumption: cover the load first, store any surplus
+        if net > 0:
+            supplied = min(net, self.limit, max(self.energy - self.floor, 0))
+            self.energy -= supplied
+            return net - supplied
+        stored = min(-net, self.limit, max(ceiling - self.energy, 0))
+        self.energy += stored
+        return net + stored
+
+
+# Nordpool publishes the next day's prices around this time
+PRICES_PUBLISHED = clock_time(13, 0)
+
+
+class BacktestCommander(InverterCommander):
+    # Writes land on the virtual clock straight away
+    def __init__(self, app, **kwargs):
+        super().__init__(app, coalesce_seconds=0, **kwargs)
+
+
+class BacktestScheduler(scheduler.SungrowScheduler):
+    # The real planner on a virtual clock with nothing written to disk
+    clock = None
+    site = Site(state_dir=None)
+    commander_class = BacktestCommander
+    price_cache_file = None
+    plan_cache_file = None
+
+    def local_now(self):
+        return self.clock
+
+    def call_service(self, service, **kwargs):
+        # A day's prices only exist once they would have been published
+        if service == "nordpool/get_prices_for_date":
+            day = datetime.fromisoformat(kwargs["date"]).date()
+            published = datetime.combine(day - timedelta(days=1), PRICES_PUBLISHED, TZ)
+            if self.clock < published:
+                return {"result": {"response": {}}}
+        return super().call_service(service, **kwargs)
+
+
+def make_plan_cache(history):
+    # Room for every plan of the replay, two solves a day plus spares, so
+    # runs sharing the cache hit on every day they plan the same way
+    return PlanCache(size=4 * len(history.prices_by_date))
+
+
+def make_scheduler(history, initial_soc, scheduler_class, plan_cache=None):
+    start = datetime.fromtimestamp(history.prices.starts[0], TZ)
+    app = scheduler_class(
+        states={
+            "sensor.battery_level": str(initial_soc),
+            "input_text.latest_battery_balance_upper": (start - timedelta(days=7)).isoformat(),
+            "input_number.latest_night_charge_high_price": "0",
+            "input_boolean.skip_next_battery_schedule": "off",
+            EMS_MODE: "Self-consumption mode (default)",
+            FORCED_CMD: "Stop (default)",
+            MAX_SOC: "100",
+            FORCED_POWER: "0",
+        },
+        prices_by_date=history.prices_by_date,
+        tz=TZ,
+    )
+    app.clock = start
+    app.initialize()
+    # Runs over the same history can share one cache, plans only depend
+    # on the optimizer constants that are part of its key
+    if plan_cache is not None:
+        app.plan_cache = plan_cache
+    return app
+
+
+def daily_jobs(app, history):
+    # (ts, method) for the run_daily callbacks over the replayed days
+    jobs = []
+    for day in sorted(history.prices_by_date):
+        on = datetime.fromisoformat(day).date()
+        for at, job in ((clock_time(12, 45), app.watch_prices), (clock_time(21, 55), app.plan_next_day)):
+            jobs.append((datetime.combine(on, at, TZ).timestamp(), job))
+    jobs.sort(key=lambda job: job[0])
+    return jobs
+
+
+def publish_forecast(app, history, ts, rng):
+    # Hourly kW for the next 24 hours from the actual solar, with one
+    # forecast error factor per update
+    prices = history.prices
+    solar = history.solar_wh
+    error = rng.uniform(0.7, 1.3)
+    first = ts - ts % 3600 + 3600
+    entries = []
+    for hour in range(24):
+        hour_ts = first + hour * 3600
+        index = prices.index_of(hour_ts)
+        wh = sum(solar[index : index + 4]) if index is not None else 0.0
+        entries.append({
+            "time": datetime.fromtimestamp(hour_ts, TZ).isoformat(),
+            "value": round(wh / 1000 * error, 3),
+        })
+    app.set_state(FORECAST_SENSOR, state="on", attributes={"power": entries})
+
+
+def run_backtest(history, initial_soc=50, scheduler_class=BacktestScheduler, seed=SEED, plan_cache=None):
+    app = make_scheduler(history, initial_soc, scheduler_class, plan_cache)
+    battery = SimulatedBattery(initial_soc)
+    rng = random.Random(seed)
+    dispatcher = app.dispatcher
+    known = app.inverter.known
+    prices = history.prices
+    consumption_wh = history.consumption_wh
+    solar_wh = history.solar_wh
+    jobs = daily_jobs(app, history)
+    next_job = 0
+    meter_kwh = 0.0
+
+    daily_cost = {}
+    daily_reference = {}
+    for i in range(len(prices)):
+        start_ts = prices.starts[i]
+        while next_job < len(jobs) and jobs[next_job][0] <= start_ts:
+            job_ts, job = jobs[next_job]
+            next_job += 1
+            app.clock = datetime.fromtimestamp(job_ts, TZ)
+            publish_forecast(app, history, job_ts, rng)
+            job()
+
+        app.clock = datetime.fromtimestamp(start_ts, TZ)
+        load = consumption_wh[i]
+        solar = solar_wh[i]
+        # One live load reading per quarter, its average net power
+        app.load_follower.on_load_power(app.site.load_power, "state", None, f"{(load - solar) * 4:.0f}", {})
+        if dispatcher.heap and dispatcher.heap[0][0] <= start_ts:
+            dispatcher.fire()
+
+        grid_wh = battery.step(known[EMS_MODE], known[FORCED_CMD], known[MAX_SOC], known[FORCED_POWER], load, solar)
+        price = prices.prices[i]
+        day = app.clock.date()
+        daily_cost[day] = daily_cost.get(day, 0.0) + grid_wh * price / 1_000_000
+        daily_reference[day] = daily_reference.get(day, 0.0) + (load - solar) * price / 1_000_000
+
+        # Meter and SoC readings arrive at the end of the quarter
+        app.clock = datetime.fromtimestamp(prices.ends[i], TZ)
+        meter_kwh += load / 1000
+        app.on_consumption_change(CONSUMPTION_SENSOR, "state", None, f"{meter_kwh:.3f}", {})
+        soc = f"{battery.soc:.1f}"
+        app.states["sensor.battery_level"] = soc
+        app.on_battery_level_change("sensor.battery_level", "state", None, soc, {})
+
+    return daily_cost, daily_reference
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the scheduler over historical prices, load and solar")
+    parser.add_argument("--history", help="JSON file with prices, consumption_wh and solar_wh, or an archive directory")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--first-day", default="2025-01-01")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--soc", type=float, default=50)
+    parser.add_argument(
+        "--set", action="append", default=[], metavar="NAME=VALUE",
+        help="Override a constant, e.g. SEK_THRESHOLD=250 or OPTIMIZER_ENGINE=robust or DISCHARGE_CONTROL=load_follow"
+    )
+    args = parser.parse_args(argv)
+
+    if args.history:
+        history = load_history(args.history)
+    else:
+        first_day = datetime.fromisoformat(args.first_day).date()
+        history = generate_history(args.seed, first_day, args.days)
+
+    overrides = {}
+    for item in args.set:
+        name, _, value = item.partition("=")
+        try:
+            overrides[name] = float(value) if "." in value else int(value)
+        except ValueError:
+            overrides[name] = value
+    apply_overrides(overrides)
+
+    started = time.perf_counter()
+    plan_cache = make_plan_cache(history)
+    daily_cost, daily_reference = run_backtest(history, args.soc, seed=args.seed, plan_cache=plan_cache)
+    elapsed = time.perf_counter() - started
+
+    days = len(daily_cost)
+    total = sum(daily_cost.values())
+    reference = sum(daily_reference.values())
+    print(f"days            {days}")
+    print(f"SEK/day         {total / days:.2f}")
+    print(f"no battery      {reference / days:.2f}")
+    print(f"saved SEK       {reference - total:.2f}")
+    print(f"plan cache hits {plan_cache.hit_rate():.0%}")
+    print(f"runtime s       {elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
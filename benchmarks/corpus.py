@@ -0,0 +1,116 @@
+import math
+import random
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from price_series import PriceSeries, quarters_in_day
+
+TZ = ZoneInfo("Europe/Stockholm")
+DAY_KINDS = ("normal", "normal", "normal", "flat", "negative", "spiky")
+
+
+def generate_price_day(rng, day, kind="normal"):
+    # One SE3 day of quarter prices in SEK/MWh (92/100 on DST days), shaped
+    # like the Nordpool service response: morning and evening peaks on top
+    # of a base level
+    base = rng.uniform(150, 900)
+    swing = rng.uniform(100, 1500)
+    noise = rng.uniform(10, 80)
+    start = datetime(day.year, day.month, day.day, tzinfo=TZ).timestamp()
+
+    prices = []
+    for i in range(quarters_in_day(TZ, day)):
+        quarter_start = datetime.fromtimestamp(start + 900 * i, TZ)
+        hour = quarter_start.hour + quarter_start.minute / 60
+        peak = (
+            math.exp(-((hour - 8) ** 2) / 4)
+            + 1.3 * math.exp(-((hour - 18.5) ** 2) / 6)
+        )
+        price = base + swing * peak + rng.gauss(0, noise)
+
+        if kind == "flat":
+            price = base + rng.gauss(0, noise / 2)
+        elif kind == "negative" and 10 <= hour < 16:
+            price = -rng.uniform(5, 300)
+        elif kind == "spiky" and rng.random() < 0.06:
+            price += rng.uniform(1500, 6000)
+
+        prices.append({
+            "start": quarter_start.isoformat(),
+            "end": datetime.fromtimestamp(start + 900 * (i + 1), TZ).isoformat(),
+            "price": round(price, 2),
+        })
+    return prices
+
+
+def generate_forecast(rng, now, peak=None):
+    # Hourly sensor.power_production_next_24hours "power" attribute
+    peak = rng.uniform(0.05, 1.2) if peak is None else peak
+    sunrise = rng.uniform(4, 9)
+    sunset = rng.uniform(16, 22)
+    first = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+    entries = []
+    for i in range(24):
+        time = first + timedelta(hours=i)
+        hour = time.hour
+        if sunrise < hour < sunset:
+            value = peak * math.sin(math.pi * (hour - sunrise) / (sunset - sunrise))
+            value *= rng.uniform(0.6, 1.0)
+        else:
+            value = 0.0
+        entries.append({"time": time.isoformat(), "value": round(value, 3)})
+    return entries
+
+
+def generate_consumption_history(rng, now, hours, avg_15min_energy_wh):
+    # Recorder rows for sensor.total_consumed_energy, one per five minutes
+    samples = hours * 12
+    energy_kwh = rng.uniform(1000, 20000)
+    history = []
+    for i in range(samples + 1):
+        history.append({
+            "state": f"{energy_kwh:.3f}",
+            "last_changed": now - timedelta(minutes=5 * (samples - i)),
+        })
+        energy_kwh += avg_15min_energy_wh / 3 / 1000 * rng.uniform(0.5, 1.5)
+    return [history]
+
+
+class Scenario:
+    __slots__ = ("prices", "forecast", "history", "current_soc", "avg_15min_energy_wh", "now")
+
+    def __init__(self, prices, forecast, history, current_soc, avg_15min_energy_wh, now):
+        self.prices = prices
+        self.forecast = forecast
+        self.history = history
+        self.current_soc = current_soc
+        self.avg_15min_energy_wh = avg_15min_energy_wh
+        # The time the forecast and consumption history lead up to
+        self.now = now
+
+
+def generate_scenarios(seed, count, first_day=None):
+    rng = random.Random(seed)
+    first_day = first_day or datetime(2025, 1, 6, tzinfo=TZ)
+    # A clock between noon and 22:00 on the first day, picked by the seed,
+    # so a seed gives the same corpus on every run
+    now = first_day.replace(hour=12) + timedelta(minutes=seed % 600)
+
+    scenarios = []
+    for i in range(count):
+        day = first_day + timedelta(days=i)
+        prices = (
+            generate_price_day(rng, day, rng.choice(DAY_KINDS))
+            + generate_price_day(rng, day + timedelta(days=1), rng.choice(DAY_KINDS))
+        )
+        avg_15min_energy_wh = rng.uniform(150, 900)
+        scenarios.append(Scenario(
+            prices=PriceSeries.from_quarters(prices, TZ),
+            forecast=generate_forecast(rng, now),
+            history=generate_consumption_history(rng, now, 8, avg_15min_energy_wh),
+            current_soc=round(rng.uniform(20, 90), 1),
+            avg_15min_energy_wh=avg_15min_energy_wh,
+            now=now,
+        ))
+    return scenarios
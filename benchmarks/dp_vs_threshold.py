@@ -0,0 +1,81 @@
+import random
+import time
+from datetime import datetime, time as clock_time, timedelta
+
+from benchmarks.corpus import TZ, generate_price_day, DAY_KINDS
+from constants import BATTERY_CAPACITY, MAX_CHARGE_POWER, MIN_SOC
+from optimizer import select_night_plan
+from price_series import PriceSeries
+
+DAYS = 200
+SEED = 42
+# Robust engine: load scenarios per day as factors on the day's average,
+# one per stored profile day and solar error in a real setup
+SCENARIOS = 140
+
+
+def simulate_cost(prices, charge_quarters, discharge_quarters, avg_15min_energy_wh, current_soc):
+    charge = {q.start_ts for q in charge_quarters}
+    discharge = {q.start_ts for q in discharge_quarters}
+    energy = max(current_soc - MIN_SOC, 0) / 100 * BATTERY_CAPACITY
+    capacity = (100 - MIN_SOC) / 100 * BATTERY_CAPACITY
+    cost = 0.0
+    for q in prices:
+        grid_wh = avg_15min_energy_wh
+        if q.start_ts in charge:
+            added = min(MAX_CHARGE_POWER * 0.25, capacity - energy)
+            energy += added
+            grid_wh += added
+        elif q.start_ts in discharge and energy >= avg_15min_energy_wh:
+            energy -= avg_15min_energy_wh
+            grid_wh = 0
+        cost += q.price * grid_wh
+    return cost / 1_000_000
+
+
+def run(engine, days):
+    costs = []
+    durations = []
+    for prices, avg_15min_energy_wh, current_soc, scenarios in days:
+        started = time.perf_counter()
+        charge_quarters, discharge_quarters = select_night_plan(
+            prices, avg_15min_energy_wh, current_soc, engine=engine, scenarios=scenarios
+        )
+        durations.append(time.perf_counter() - started)
+        costs.append(simulate_cost(
+            prices.between(prices.local_time(0, clock_time(22)), prices.local_time(2, clock_time(0))), charge_quarters, discharge_quarters, avg_15min_energy_wh, current_soc
+        ))
+    return costs, durations
+
+
+def main():
+    rng = random.Random(SEED)
+    scenario_rng = random.Random(SEED + 1)
+    days = []
+    for i in range(DAYS):
+        day = datetime(2025, 1, 1, tzinfo=TZ) + timedelta(days=i)
+        prices = PriceSeries.from_quarters(
+            generate_price_day(rng, day, rng.choice(DAY_KINDS))
+            + generate_price_day(rng, day + timedelta(days=1), rng.choice(DAY_KINDS)),
+            TZ
+        )
+        avg_15min_energy_wh = rng.uniform(200, 800)
+        scenarios = [
+            [avg_15min_energy_wh * factor] * len(prices)
+            for factor in (scenario_rng.uniform(0.6, 1.4) for _ in range(SCENARIOS))
+        ]
+        days.append((prices, avg_15min_energy_wh, rng.uniform(MIN_SOC, 60), scenarios))
+
+    print(f"{'engine':<10} {'SEK/day':>9} {'mean ms':>9} {'max ms':>9}")
+    for engine in ("threshold", "dp", "robust"):
+        costs, durations = run(engine, days)
+        print(
+            f"{engine:<10} "
+            f"{sum(costs) / len(costs):>9.2f} "
+            f"{sum(durations) / len(durations) * 1000:>9.3f} "
+            f"{max(durations) * 1000:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import sys
+import types
+from datetime import datetime
+
+
+class FakeHass:
+    # Minimal stand-in for hass.Hass that answers from in-memory state and
+    # records every service call and timer instead of talking to AppDaemon
+
+    def __init__(self, states=None, prices_by_date=None, history=None, tz=None):
+        self.states = dict(states or {})
+        self.updated = dict.fromkeys(self.states, datetime.now(tz).isoformat())
+        self.prices_by_date = dict(prices_by_date or {})
+        self.history = history or [[]]
+        self.tz = tz
+        self.service_calls = []
+        self.timers = {}
+        self.listeners = []
+        self.next_handle = 0
+        self.now = None
+
+    def reset_calls(self):
+        self.service_calls.clear()
+        self.timers.clear()
+
+    def log(self, msg, *args, **kwargs):
+        pass
+
+    def error(self, msg, *args, **kwargs):
+        pass
+
+    def datetime(self):
+        return self.now or datetime.now(self.tz)
+
+    def get_state(self, entity_id, attribute=None, **kwargs):
+        state = self.states.get(entity_id)
+        if attribute == "all":
+            if state is None:
+                return None
+            full = dict(state) if isinstance(state, dict) else {"state": state, "attributes": {}}
+            full.setdefault("last_updated", self.updated.get(entity_id))
+            return full
+        if attribute is None:
+            return state["state"] if isinstance(state, dict) else state
+        if isinstance(state, dict):
+            return state.get("attributes", {}).get(attribute)
+        return None
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        self.states[entity_id] = state if attributes is None else {"state": state, "attributes": attributes}
+        self.updated[entity_id] = datetime.now(self.tz).isoformat()
+
+    def turn_on(self, entity_id, **kwargs):
+        self.states[entity_id] = "on"
+
+    def turn_off(self, entity_id, **kwargs):
+        self.states[entity_id] = "off"
+
+    def get_history(self, entity_id, start_time=None, end_time=None, **kwargs):
+        self.service_calls.append(("recorder/history", {"entity_id": entity_id}))
+        return self.history
+
+    def call_service(self, service, **kwargs):
+        self.service_calls.append((service, kwargs))
+        if service == "nordpool/get_prices_for_date":
+            prices = self.prices_by_date.get(kwargs["date"])
+            return {"result": {"response": {kwargs["areas"]: prices} if prices else {}}}
+        if service in ("input_select/select_option", "input_number/set_value"):
+            value = kwargs.get("option", kwargs.get("value"))
+            self.states[kwargs["entity_id"]] = value
+        return {}
+
+    def _add_timer(self, kind, callback, when, kwargs):
+        self.next_handle += 1
+        handle = f"timer-{self.next_handle}"
+        self.timers[handle] = (kind, callback, when, kwargs)
+        return handle
+
+    def run_at(self, callback, when, **kwargs):
+        return self._add_timer("run_at", callback, when, kwargs)
+
+    def run_in(self, callback, delay, **kwargs):
+        return self._add_timer("run_in", callback, delay, kwargs)
+
+    def run_daily(self, callback, start, **kwargs):
+        return self._add_timer("run_daily", callback, start, kwargs)
+
+    def run_every(self, callback, start, interval, **kwargs):
+        return self._add_timer("run_every", callback, start, kwargs)
+
+    def listen_state(self, callback, entity_id=None, **kwargs):
+        self.listeners.append((callback, entity_id, kwargs))
+        return f"listener-{len(self.listeners)}"
+
+    def cancel_timer(self, handle, **kwargs):
+        return self.timers.pop(handle, None) is not None
+
+    def timer_count(self, kind=None):
+        return sum(1 for timer in self.timers.values() if kind is None or timer[0] == kind)
+
+
+def install():
+    # Lets `import appdaemon.plugins.hass.hassapi as hass` resolve to FakeHass
+    hassapi = types.ModuleType("appdaemon.plugins.hass.hassapi")
+    hassapi.Hass = FakeHass
+    names = ["appdaemon", "appdaemon.plugins", "appdaemon.plugins.hass"]
+    for name in names:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules["appdaemon.plugins.hass.hassapi"] = hassapi
+    sys.modules["appdaemon.plugins.hass"].hassapi = hassapi
+    return FakeHass
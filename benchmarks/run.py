@@ -0,0 +1,286 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+from datetime import datetime, time as clock_time, timedelta
+from pathlib import Path
+
+from benchmarks.corpus import TZ, generate_scenarios
+from benchmarks.fake_hass import install
+
+install()
+
+from constants import CHEAP_CHARGE_PRICE
+from consumption import ConsumptionEstimator
+from dispatcher import Dispatcher
+from forecast import FORECAST_SENSOR, SolarForecast, get_forecast
+from load_follow import LoadFollower
+from optimizer import evaluate_candidate, select_night_plan
+from price_series import PriceSeries
+from scheduler import SungrowScheduler
+
+BASELINE_FILE = Path(__file__).with_name("baseline.json")
+SEED = 20250106
+
+
+class CorpusScheduler(SungrowScheduler):
+    # The planner at the corpus clock the scenario was generated for
+    clock = None
+
+    def local_now(self):
+        return self.clock
+
+
+def make_app(scenario):
+    app = CorpusScheduler(
+        states={
+            "sensor.battery_level": str(scenario.current_soc),
+            "sensor.power_production_next_24hours": {
+                "state": "on",
+                "attributes": {"power": scenario.forecast},
+            },
+            "input_text.latest_battery_balance_upper": (
+                scenario.now - timedelta(days=3)
+            ).isoformat(),
+            "input_number.latest_night_charge_high_price": "300",
+        },
+        history=scenario.history,
+        tz=TZ,
+    )
+    app.clock = app.now = scenario.now
+    app.dispatcher = Dispatcher(app, TZ, clock=app.local_now)
+    app.charge_windows = []
+    app.armed = {}
+    app.set_discharge_schedule([])
+    app.current_soc = scenario.current_soc
+    app.consumption = ConsumptionEstimator()
+    app.seed_consumption()
+    app.reset_calls()
+    return app
+
+
+def case_select_night_plan(scenario):
+    return lambda: select_night_plan(
+        scenario.prices, scenario.avg_15min_energy_wh, scenario.current_soc
+    ), None
+
+
+def case_get_forecast(scenario):
+    app = make_app(scenario)
+    return lambda: get_forecast(app), app
+
+
+def case_forecast_resample(scenario):
+    app = make_app(scenario)
+    state = app.get_state(FORECAST_SENSOR, attribute="all")
+
+    def resample():
+        forecast = SolarForecast(TZ)
+        forecast.update(state)
+        return forecast.grid()
+    return resample, app
+
+
+def case_get_target_soc(scenario):
+    app = make_app(scenario)
+    charge_quarters, discharge_quarters = select_night_plan(
+        scenario.prices, scenario.avg_15min_energy_wh, scenario.current_soc
+    )
+    charge_quarters = charge_quarters or list(scenario.prices.between(clock_time(22), clock_time(0)))
+    return lambda: app.get_target_soc(charge_quarters, len(discharge_quarters), False), app
+
+
+def case_set_night_charging(scenario):
+    app = make_app(scenario)
+    charge_quarters, discharge_quarters = select_night_plan(
+        scenario.prices, scenario.avg_15min_energy_wh, scenario.current_soc
+    )
+    charge_quarters = charge_quarters or list(scenario.prices.between(clock_time(22), clock_time(0)))
+
+    def run():
+        app.set_night_charging(charge_quarters, len(discharge_quarters))
+        app.arm_plan()
+    return run, app
+
+
+def case_load_follow(scenario):
+    # A live load reading through to the forced power write. The rate
+    # limit is off so every reading is written.
+    app = make_app(scenario)
+    now = app.local_now()
+    quarter = PriceSeries.from_quarters([{
+        "start": (now - timedelta(minutes=1)).isoformat(),
+        "end": (now + timedelta(minutes=14)).isoformat(),
+        "price": 1.0,
+    }], TZ)[0]
+    follower = LoadFollower(app, min_interval=0)
+    loads = itertools.cycle(("800", "1600"))
+    follower.on_load_power("sensor.load_power", "state", None, next(loads), {})
+    follower.start(quarter, scenario.avg_15min_energy_wh * 4)
+
+    def run():
+        follower.on_load_power("sensor.load_power", "state", None, next(loads), {})
+    return run, app
+
+
+CASES = {
+    "select_night_plan": case_select_night_plan,
+    "get_forecast": case_get_forecast,
+    "forecast_resample": case_forecast_resample,
+    "get_target_soc": case_get_target_soc,
+    "set_night_charging": case_set_night_charging,
+    "load_follow": case_load_follow,
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def run_case(make_case, scenarios, repeat):
+    durations = []
+    service_calls = []
+    timers = []
+
+    for scenario in scenarios:
+        fn, app = make_case(scenario)
+        for _ in range(repeat):
+            if app is not None:
+                app.reset_calls()
+            started = time.perf_counter()
+            fn()
+            durations.append(time.perf_counter() - started)
+            if app is not None:
+                service_calls.append(len(app.service_calls))
+                timers.append(app.timer_count())
+
+    tracemalloc.start()
+    peaks = []
+    for scenario in scenarios:
+        fn, app = make_case(scenario)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": percentile(durations, 50) * 1000,
+        "p90_ms": percentile(durations, 90) * 1000,
+        "p99_ms": percentile(durations, 99) * 1000,
+        "alloc_kib": percentile(peaks, 90) / 1024,
+        "service_calls": max(service_calls, default=0),
+        "timers": max(timers, default=0),
+    }
+
+
+def reference_night_plan(prices, avg_15min_energy_wh, current_soc):
+    best = None
+    night = prices.between(clock_time(22), clock_time(6))
+    for price in sorted({q.price for q in night}):
+        candidate = evaluate_candidate(prices, price, avg_15min_energy_wh, current_soc)
+        if candidate and (best is None or (candidate[2], len(candidate[0])) > best[0]):
+            best = ((candidate[2], len(candidate[0])), candidate)
+    cheap_quarters = [q for q in night if q.price < CHEAP_CHARGE_PRICE]
+    if not best:
+        return cheap_quarters, []
+    unique_charge = {q.start_ts: q for q in best[1][0] + cheap_quarters}
+    return sorted(unique_charge.values(), key=lambda q: q.start_ts), best[1][1]
+
+
+def reference_forecast(entries):
+    start_time = None
+    end_time = None
+    started = False
+    for entry in entries:
+        power = entry["value"]
+        when = datetime.fromisoformat(entry["time"])
+        if not started and power >= 0.15:
+            start_time = when - timedelta(minutes=30) if power >= 0.2 else when
+            started = True
+        elif started and power < 0.15:
+            end_time = when - timedelta(minutes=30) if power < 0.1 else when
+            break
+    return start_time, end_time
+
+
+def check_regression(scenarios):
+    mismatches = 0
+    for scenario in scenarios:
+        if get_forecast(make_app(scenario)) != reference_forecast(scenario.forecast):
+            mismatches += 1
+        for current_soc in (scenario.current_soc, 30, 95):
+            args = (scenario.prices, scenario.avg_15min_energy_wh, current_soc)
+            if select_night_plan(*args) != reference_night_plan(*args):
+                mismatches += 1
+    return mismatches
+
+
+def compare(results, baseline, tolerance, noise_floor_ms):
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["p90_ms"] - expected["p90_ms"] < noise_floor_ms:
+            # Sub-noise differences on microsecond cases are timer jitter
+            result = dict(result, p90_ms=expected["p90_ms"])
+        for metric in ("p90_ms", "alloc_kib"):
+            if result[metric] > expected[metric] * (1 + tolerance):
+                failures.append(f"{name}: {metric} {result[metric]:.3f} > baseline {expected[metric]:.3f}")
+        for metric in ("service_calls", "timers"):
+            if result[metric] > expected[metric]:
+                failures.append(f"{name}: {metric} {result[metric]} > baseline {expected[metric]}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the planner hot paths")
+    parser.add_argument("--scenarios", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--noise-floor-ms", type=float, default=0.05)
+    parser.add_argument("--case", action="append", choices=sorted(CASES))
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    scenarios = generate_scenarios(args.seed, args.scenarios)
+
+    mismatches = check_regression(scenarios)
+    if mismatches:
+        print(f"select_night_plan differs from the reference on {mismatches} runs")
+        return 1
+
+    results = {}
+    print(f"{'case':<20} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'KiB':>8} {'calls':>6} {'timers':>6}")
+    for name in args.case or CASES:
+        result = run_case(CASES[name], scenarios, args.repeat)
+        results[name] = result
+        print(
+            f"{name:<20} {result['p50_ms']:>8.3f} {result['p90_ms']:>8.3f} {result['p99_ms']:>8.3f} "
+            f"{result['alloc_kib']:>8.1f} {result['service_calls']:>6} {result['timers']:>6}"
+        )
+
+    if args.update_baseline:
+        baseline = json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+        baseline.update(results)
+        BASELINE_FILE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline written to {BASELINE_FILE}")
+        return 0
+
+    if not BASELINE_FILE.exists():
+        return 0
+
+    failures = compare(results, json.loads(BASELINE_FILE.read_text()), args.tolerance, args.noise_floor_ms)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
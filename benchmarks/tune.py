@@ -0,0 +1,159 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks import backtest
+
+# UNRANKED_DISCHARGE_QUARTERS and MAX_CHARGE_QUARTERS are not read by the
+# planner yet, so sweeping them would only multiply the runs
+DEFAULT_GRID = {
+    "SEK_THRESHOLD": (200, 250, 300, 350, 400),
+    "STANDARD_DEVIATION_THRESHOLD": (30, 50, 80),
+    "AVG_ENERGY_HOURS": (4, 8, 24),
+    "CHEAP_CHARGE_PRICE": (50, 100, 150),
+}
+CHECKPOINT_FILE = Path(__file__).with_name("tune_checkpoint.jsonl")
+
+history = None
+plan_cache = None
+
+
+def init_worker(history_file, seed, first_day, days):
+    # Every worker builds the replayed series and a plan cache once and
+    # reuses them per task
+    global history, plan_cache
+    if history_file:
+        history = backtest.load_history(history_file)
+    else:
+        history = backtest.generate_history(seed, datetime.fromisoformat(first_day).date(), days)
+    plan_cache = backtest.make_plan_cache(history)
+
+
+def evaluate(params, soc, seed):
+    previous = backtest.apply_overrides(params)
+    try:
+        daily_cost, daily_reference = backtest.run_backtest(history, soc, seed=seed, plan_cache=plan_cache)
+    finally:
+        backtest.apply_overrides(previous)
+    days = len(daily_cost)
+    return {
+        "params": params,
+        "sek_per_day": sum(daily_cost.values()) / days,
+        "saved_sek": sum(daily_reference.values()) - sum(daily_cost.values()),
+    }
+
+
+def parse_grid(items):
+    grid = dict(DEFAULT_GRID) if not items else {}
+    for item in items:
+        name, _, values = item.partition("=")
+        grid[name] = tuple(float(v) if "." in v else int(v) for v in values.split(","))
+    return grid
+
+
+def candidates(grid, samples, seed):
+    names = sorted(grid)
+    combos = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    if samples and samples < len(combos):
+        combos = random.Random(seed).sample(combos, samples)
+    return combos
+
+
+def key_of(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def load_checkpoint(path, run):
+    # Only results replayed over the same history count
+    results = {}
+    if path.exists():
+        for line in path.read_text().splitlines():
+            if line.strip():
+                result = json.loads(line)
+                if result.get("run") == run:
+                    results[key_of(result["params"])] = result
+    return results
+
+
+def write_profile(path, params):
+    lines = [f"# Tuned by benchmarks.tune on {datetime.now().date().isoformat()}"]
+    lines += [f"{name} = {value!r}" for name, value in sorted(params.items())]
+    Path(path).write_text("\n".join(lines) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep constants over backtested history")
+    parser.add_argument("--history", help="JSON file with prices, consumption_wh and solar_wh, or an archive directory")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--first-day", default="2025-01-01")
+    parser.add_argument("--seed", type=int, default=backtest.SEED)
+    parser.add_argument("--soc", type=float, default=50)
+    parser.add_argument(
+        "--grid", action="append", default=[], metavar="NAME=V1,V2,...",
+        help="Values to sweep for a constant, replaces the default grid"
+    )
+    parser.add_argument("--samples", type=int, default=0, help="Random subset of the grid to run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--checkpoint", type=Path, default=CHECKPOINT_FILE)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--profile", help="Write the best values as a constants profile")
+    args = parser.parse_args(argv)
+
+    grid = parse_grid(args.grid)
+    unknown = [name for name in grid if not hasattr(backtest.constants, name)]
+    if unknown:
+        parser.error(f"Unknown constants: {', '.join(unknown)}")
+    combos = candidates(grid, args.samples, args.seed)
+    run = key_of({
+        "history": args.history,
+        "seed": args.seed,
+        "first_day": args.first_day,
+        "days": args.days,
+        "soc": args.soc,
+    })
+    results = load_checkpoint(args.checkpoint, run)
+    todo = [params for params in combos if key_of(params) not in results]
+    print(f"{len(combos)} candidates, {len(combos) - len(todo)} from checkpoint, {args.workers} workers")
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=init_worker,
+        initargs=(args.history, args.seed, args.first_day, args.days),
+    ) as pool, args.checkpoint.open("a") as checkpoint:
+        futures = [pool.submit(evaluate, params, args.soc, args.seed) for params in todo]
+        for done, future in enumerate(as_completed(futures), 1):
+            result = dict(future.result(), run=run)
+            results[key_of(result["params"])] = result
+            checkpoint.write(json.dumps(result) + "\n")
+            checkpoint.flush()
+            print(f"\r{done}/{len(todo)} done", end="", flush=True)
+    if todo:
+        print()
+
+    ranked = sorted(
+        (results[key_of(params)] for params in combos),
+        key=lambda result: result["sek_per_day"]
+    )
+    names = sorted(combos[0]) if combos else []
+    print(" ".join(f"{name:>28}" for name in names) + f" {'SEK/day':>9} {'saved':>9}")
+    for result in ranked[: args.top]:
+        print(
+            " ".join(f"{result['params'][name]:>28}" for name in names)
+            + f" {result['sek_per_day']:>9.2f} {result['saved_sek']:>9.1f}"
+        )
+    print(f"{time.perf_counter() - started:.1f} s")
+
+    if args.profile and ranked:
+        write_profile(args.profile, ranked[0]["params"])
+        print(f"Profile written to {args.profile}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,39 @@
 SEK_THRESHOLD = 300
+CHEAP_CHARGE_PRICE = 100
 MIN_SOC = 30
 BATTERY_CAPACITY = 0.95 * 25600
 UNRANKED_DISCHARGE_QUARTERS = 2 * 4
 AVG_ENERGY_HOURS = 8
 MAX_CHARGE_POWER = 4000
+MIN_CHARGE_POWER = 800
 STANDARD_DEVIATION_THRESHOLD = 50
 MIN_CHARGE_QUARTERS = 8
 MAX_CHARGE_QUARTERS = 32
+DP_SOC_STEP = 1
+COMMAND_COALESCE_SECONDS = 1
+SERVICE_CALL_TIMEOUT = 10
+MAX_INFLIGHT_WRITES = 2
+PRICE_MISS_TTL = 5 * 60
+PRICE_CACHE_DAYS = 7
+PRICE_POLL_SECONDS = 5 * 60
+PRICE_POLL_MAX_SECONDS = 60 * 60
+LOAD_PROFILE_DAYS = 28
+LOAD_PROFILE_MIN_DAYS = 3
+METRICS_ENABLED = True
+METRICS_PUBLISH_SECONDS = 5 * 60
+MAX_PLANNER_WORKERS = 4
+REPLAN_DEBOUNCE_SECONDS = 60
+REPLAN_SOC_DELTA = 5
+REPLAN_LOAD_CHANGE = 0.25
+PLAN_CACHE_SIZE = 64
+PLAN_CACHE_SPILL_SIZE = 1024
+PLAN_CACHE_SOC_STEP = 1
+PLAN_CACHE_ENERGY_STEP = 10
+OPTIMIZER_ENGINE = "threshold"
+ROBUST_OBJECTIVE = "expected"
+ROBUST_SOLAR_ERRORS = (0.5, 0.75, 1.0, 1.25, 1.5)
+DISCHARGE_CONTROL = "self_consumption"
+MAX_DISCHARGE_POWER = 5000
+LOAD_FOLLOW_DEADBAND = 150
+LOAD_FOLLOW_MIN_INTERVAL = 5
+SNAPSHOT_SAVE_SECONDS = 60
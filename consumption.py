@@ -0,0 +1,98 @@
+from array import array
+from datetime import datetime
+from constants import AVG_ENERGY_HOURS
+
+CONSUMPTION_SENSOR = "sensor.total_consumed_energy"
+
+
+class ConsumptionEstimator:
+    # Rolling window over the cumulative consumption meter, one sample per
+    # resolution bucket in a fixed-size ring, so the 15-minute average is
+    # just (newest - oldest) over the span between them
+    def __init__(self, hours=None, resolution=60):
+        # AVG_ENERGY_HOURS is read here, so an override applies to new ones
+        self.window = (hours if hours is not None else AVG_ENERGY_HOURS) * 3600
+        self.resolution = resolution
+        self.capacity = int(self.window // resolution) + 2
+        self.times = array("d", bytes(8 * self.capacity))
+        self.values = array("d", bytes(8 * self.capacity))
+        self.head = 0
+        self.size = 0
+
+    def clear(self):
+        self.head = 0
+        self.size = 0
+
+    def seed(self, history):
+        self.clear()
+        if not history or not history[0]:
+            return
+        for s in history[0]:
+            self.add(to_timestamp(s["last_changed"]), s["state"])
+
+    def samples(self):
+        # Ring contents oldest first, for the plan snapshot
+        indexes = [(self.head + i) % self.capacity for i in range(self.size)]
+        return [self.times[i] for i in indexes], [self.values[i] for i in indexes]
+
+    def restore(self, times, values):
+        self.clear()
+        for ts, energy_kwh in zip(times, values):
+            self.add(ts, energy_kwh)
+
+    def add(self, ts, state):
+        try:
+            energy_kwh = float(state)
+        except (ValueError, TypeError):
+            return
+
+        capacity = self.capacity
+        if self.size:
+            last = (self.head + self.size - 1) % capacity
+            if ts < self.times[last]:
+                return
+            if energy_kwh < self.values[last]:
+                # Meter was reset, the old samples no longer line up
+                self.clear()
+            elif self.size > 1 and ts // self.resolution == self.times[last] // self.resolution:
+                self.times[last] = ts
+                self.values[last] = energy_kwh
+                return
+
+        if self.size == capacity:
+            self.head = (self.head + 1) % capacity
+            self.size -= 1
+
+        tail = (self.head + self.size) % capacity
+        self.times[tail] = ts
+        self.values[tail] = energy_kwh
+        self.size += 1
+
+    def expire(self, now):
+        # Keep the last sample at or before the window start as the anchor
+        cutoff = now - self.window
+        capacity = self.capacity
+        while self.size > 1 and self.times[(self.head + 1) % capacity] <= cutoff:
+            self.head = (self.head + 1) % capacity
+            self.size -= 1
+
+    def avg_15min_energy(self, now):
+        self.expire(now)
+        if self.size < 2:
+            return 0.0
+
+        last = (self.head + self.size - 1) % self.capacity
+        total_energy_wh = (self.values[last] - self.values[self.head]) * 1000
+        total_time_hours = (self.times[last] - self.times[self.head]) / 3600
+
+        if total_time_hours <= 0:
+            return 0.0
+
+        # Average Wh per 15 minutes
+        return total_energy_wh * (0.25 / total_time_hours)
+
+
+def to_timestamp(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(value).timestamp()
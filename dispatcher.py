@@ -0,0 +1,107 @@
+import heapq
+import itertools
+import threading
+from datetime import datetime
+from metrics import get_metrics, timer
+
+
+class Dispatcher:
+    # Keeps every planned callback in one heap and arms a single AppDaemon
+    # timer for the earliest of them. Events belong to a group and a whole
+    # group is cancelled by bumping its generation, so a replan does not
+    # have to touch the events it throws away.
+    def __init__(self, app, tz, clock=None):
+        self.app = app
+        self.tz = tz
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.generations = {}
+        self.cancelled = set()
+        self.armed_ts = None
+        self.armed_handle = None
+        self.lock = threading.Lock()
+
+    def schedule(self, group, callback, when, **kwargs):
+        ts = when.timestamp() if isinstance(when, datetime) else float(when)
+        event_id = next(self.counter)
+        with timer(self.app, "timer_registration"), self.lock:
+            generation = self.generations.get(group, 0)
+            heapq.heappush(self.heap, (ts, event_id, group, generation, callback, kwargs))
+            self.arm()
+        return event_id
+
+    def cancel(self, event_id):
+        with self.lock:
+            self.cancelled.add(event_id)
+            self.arm()
+
+    def cancel_group(self, group):
+        with self.lock:
+            self.generations[group] = self.generations.get(group, 0) + 1
+            self.arm()
+
+    def scope(self, name):
+        return DispatcherScope(self, f"{name}:")
+
+    def is_live(self, event_id, group, generation):
+        return event_id not in self.cancelled and generation == self.generations.get(group, 0)
+
+    def drop_dead(self):
+        heap = self.heap
+        while heap and not self.is_live(heap[0][1], heap[0][2], heap[0][3]):
+            self.cancelled.discard(heapq.heappop(heap)[1])
+
+    def arm(self):
+        self.drop_dead()
+        next_ts = self.heap[0][0] if self.heap else None
+        if next_ts == self.armed_ts:
+            return
+
+        if self.armed_handle is not None:
+            self.app.cancel_timer(self.armed_handle)
+            self.armed_handle = None
+        self.armed_ts = next_ts
+        if next_ts is not None:
+            self.armed_handle = self.app.run_at(self.fire, datetime.fromtimestamp(next_ts, self.tz))
+
+    def fire(self, kwargs=None):
+        now = (self.clock() if self.clock else datetime.now(self.tz)).timestamp()
+        due = []
+        with self.lock:
+            self.armed_handle = None
+            self.armed_ts = None
+            self.drop_dead()
+            while self.heap and self.heap[0][0] <= now:
+                ts, event_id, group, generation, callback, event_kwargs = heapq.heappop(self.heap)
+                if self.is_live(event_id, group, generation):
+                    due.append((ts, callback, event_kwargs))
+                self.cancelled.discard(event_id)
+            self.arm()
+
+        metrics = get_metrics(self.app)
+        for ts, callback, event_kwargs in due:
+            if metrics is not None:
+                # How late the callback runs against its planned time
+                metrics.observe("dispatch_drift", max(now - ts, 0) * 1000)
+            try:
+                callback(dict(event_kwargs))
+            except Exception as e:
+                self.app.error(f"Dispatched callback {getattr(callback, '__name__', callback)} failed: {e}")
+
+
+class DispatcherScope:
+    # One site's view of a shared Dispatcher. Its groups get the site name
+    # as prefix, so a site replanning only cancels its own events.
+    def __init__(self, dispatcher, prefix):
+        self.dispatcher = dispatcher
+        self.prefix = prefix
+
+    def schedule(self, group, callback, when, **kwargs):
+        return self.dispatcher.schedule(self.prefix + group, callback, when, **kwargs)
+
+    def cancel(self, event_id):
+        self.dispatcher.cancel(event_id)
+
+    def cancel_group(self, group):
+        self.dispatcher.cancel_group(self.prefix + group)
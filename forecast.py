@@ -1,33 +1,151 @@
+from array import array
 from datetime import datetime, timedelta
 
-def get_forecast(app):
-    THRESHOLD_MID = 0.15
-    THRESHOLD_HIGH = 0.2
-    THRESHOLD_LOW = 0.1
+FORECAST_SENSOR = "sensor.power_production_next_24hours"
+QUARTER_SECONDS = 900
 
-    data = app.get_state("sensor.power_production_next_24hours", attribute="power")
+THRESHOLD_MID = 0.15
+THRESHOLD_HIGH = 0.2
+THRESHOLD_LOW = 0.1
 
-    started = False
-    start_time = None
-    end_time = None
 
-    for entry in data:
-        power = entry["value"]
-        time = datetime.fromisoformat(entry["time"])
+class SolarForecast:
+    # The forecast "power" attribute (kW samples) resampled onto the same
+    # 15 minute grid as the price series. Samples are parsed only when the
+    # sensor's last_updated changes and the grid is built on first use;
+    # production windows are cached per set of thresholds and the
+    # cumulative curve makes energy queries O(1).
+    def __init__(self, tz):
+        self.tz = tz
+        self.last_updated = None
+        self.times = array("d")
+        self.values = array("d")
+        self.grid_start = None
+        self.energy = None
+        self.cumulative = None
+        self.windows = {}
 
-        if not started and power >= THRESHOLD_MID:
-            if power >= THRESHOLD_HIGH:
-                start_time = time - timedelta(minutes=30)
-            else:
-                start_time = time
-            started = True
+    def update(self, state):
+        # `state` is the full entity state (get_state(attribute="all")),
+        # returns True when the forecast had to be resampled
+        if not isinstance(state, dict):
+            state = {}
+        last_updated = state.get("last_updated")
+        if last_updated is not None and last_updated == self.last_updated:
+            return False
+
+        entries = (state.get("attributes") or {}).get("power") or []
+        points = sorted(
+            (datetime.fromisoformat(entry["time"]).timestamp(), float(entry["value"]))
+            for entry in entries
+        )
+        self.last_updated = last_updated
+        self.times = array("d", (ts for ts, _ in points))
+        self.values = array("d", (value for _, value in points))
+        self.windows = {}
+        self.energy = None
+        return True
 
-        elif started and power < THRESHOLD_MID:
-            # If we were strongly producing previous hour, end earlier
-            if power < THRESHOLD_LOW:
-                end_time = time - timedelta(minutes=30)
+    def resample(self):
+        # Average kW of a quarter is taken at its midpoint on the linear
+        # interpolation between samples, stored as Wh per quarter
+        times = self.times
+        values = self.values
+        self.energy = array("d")
+        self.cumulative = array("d", [0.0])
+        self.grid_start = None
+        if len(times) < 2:
+            return
+
+        self.grid_start = times[0] // QUARTER_SECONDS * QUARTER_SECONDS
+        quarters = int((times[-1] - self.grid_start) // QUARTER_SECONDS)
+        segment = 0
+        total = 0.0
+        for i in range(quarters):
+            mid = self.grid_start + i * QUARTER_SECONDS + QUARTER_SECONDS / 2
+            while segment + 2 < len(times) and times[segment + 1] <= mid:
+                segment += 1
+            t0, t1 = times[segment], times[segment + 1]
+            if mid < t0 or mid > t1:
+                kw = 0.0
             else:
-                end_time = time
-            break
-    
-    return start_time, end_time
\ No newline at end of file
+                kw = values[segment] + (values[segment + 1] - values[segment]) * (mid - t0) / (t1 - t0)
+            wh = max(kw, 0.0) * 1000 * QUARTER_SECONDS / 3600
+            self.energy.append(wh)
+            total += wh
+            self.cumulative.append(total)
+
+    def grid(self):
+        if self.energy is None:
+            self.resample()
+        return self.energy
+
+    def grid_index(self, when):
+        if self.grid_start is None:
+            return None
+        ts = when.timestamp() if isinstance(when, datetime) else float(when)
+        return int((ts - self.grid_start) // QUARTER_SECONDS)
+
+    def production(self, prices):
+        # Expected Wh per quarter aligned with a PriceSeries, 0 outside the
+        # forecast horizon
+        energy = self.grid()
+        result = [0.0] * len(prices)
+        if not energy:
+            return result
+        for i, start_ts in enumerate(prices.starts):
+            index = self.grid_index(start_ts)
+            if 0 <= index < len(energy):
+                result[i] = energy[index]
+        return result
+
+    def energy_between(self, start, end):
+        # Forecast Wh over whole quarters from `start` up to `end`
+        self.grid()
+        if self.grid_start is None:
+            return 0.0
+        last = len(self.energy)
+        first = min(max(self.grid_index(start), 0), last)
+        stop = min(max(self.grid_index(end), first), last)
+        return self.cumulative[stop] - self.cumulative[first]
+
+    def window(self, threshold=THRESHOLD_MID, high=THRESHOLD_HIGH, low=THRESHOLD_LOW):
+        # Production starts at the first sample at or above `threshold`,
+        # half an hour earlier when it is already above `high`, and ends at
+        # the next sample below it, half an hour earlier when below `low`
+        key = (threshold, high, low)
+        if key not in self.windows:
+            self.windows[key] = self.find_window(threshold, high, low)
+        return self.windows[key]
+
+    def find_window(self, threshold, high, low):
+        times = self.times
+        values = self.values
+        start_time = None
+        end_time = None
+
+        start = next((i for i, value in enumerate(values) if value >= threshold), None)
+        if start is None:
+            return start_time, end_time
+        start_time = datetime.fromtimestamp(times[start], self.tz)
+        if values[start] >= high:
+            start_time -= timedelta(minutes=30)
+
+        end = next((i for i in range(start + 1, len(values)) if values[i] < threshold), None)
+        if end is not None:
+            end_time = datetime.fromtimestamp(times[end], self.tz)
+            if values[end] < low:
+                end_time -= timedelta(minutes=30)
+        return start_time, end_time
+
+
+def get_solar_forecast(app, sensor=FORECAST_SENSOR):
+    forecast = getattr(app, "solar_forecast", None)
+    if forecast is None:
+        forecast = app.solar_forecast = SolarForecast(app.tz)
+    forecast.update(app.get_state(sensor, attribute="all"))
+    return forecast
+
+
+def get_forecast(app, sensor=FORECAST_SENSOR):
+    return get_solar_forecast(app, sensor).window()
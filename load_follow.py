@@ -0,0 +1,145 @@
+from battery_commands import set_forced_discharge, set_stop_forced_discharge
+from constants import MAX_DISCHARGE_POWER, LOAD_FOLLOW_DEADBAND, LOAD_FOLLOW_MIN_INTERVAL
+from metrics import timer
+
+
+class LoadFollower:
+    # Forced discharge inside a planned quarter, with the power following
+    # the live load so nothing is bought or exported, within the energy
+    # budget the plan gives the quarter. Load readings are followed
+    # straight away, and grid readings trim what the load sensor does not
+    # see (solar, unmetered circuits). Changes inside the deadband
+    # are not written, and writes are at least min_interval apart. A
+    # change held back by that goes out when the interval ends.
+    def __init__(
+        self,
+        app,
+        max_power=MAX_DISCHARGE_POWER,
+        deadband=LOAD_FOLLOW_DEADBAND,
+        min_interval=LOAD_FOLLOW_MIN_INTERVAL
+    ):
+        self.app = app
+        self.max_power = max_power
+        self.deadband = deadband
+        self.min_interval = min_interval
+        self.quarter = None
+        self.budget_wh = 0.0
+        self.discharged_wh = 0.0
+        self.started_ts = None
+        self.power = 0.0
+        self.power_ts = None
+        self.desired = 0.0
+        self.load_w = None
+        self.trim = 0.0
+        self.written_ts = None
+        self.deferred = False
+
+    def listen(self):
+        self.app.listen_state(self.on_load_power, self.app.site.load_power)
+        self.app.listen_state(self.on_grid_power, self.app.site.grid_power)
+
+    def start(self, quarter, budget_wh):
+        # budget_wh is for the whole quarter, a late start gets its share
+        now_ts = self.app.local_now().timestamp()
+        if now_ts >= quarter.end_ts:
+            return
+        self.account(now_ts)
+        self.quarter = quarter
+        self.budget_wh = budget_wh * min((quarter.end_ts - now_ts) / (quarter.end_ts - quarter.start_ts), 1.0)
+        self.discharged_wh = 0.0
+        self.started_ts = now_ts
+        self.app.dispatcher.cancel_group("load_follow")
+        self.deferred = False
+        initial = self.load_w + self.trim if self.load_w is not None else budget_wh * 3600 / (quarter.end_ts - quarter.start_ts)
+        self.write(self.limit(initial, now_ts), now_ts)
+
+    def stop(self):
+        if self.quarter is None:
+            return
+        now_ts = self.app.local_now().timestamp()
+        self.account(now_ts)
+        self.app.log(f"Load follow: {self.discharged_wh:.0f} of {self.budget_wh:.0f} Wh discharged")
+        self.quarter = None
+        self.power = 0.0
+        self.app.dispatcher.cancel_group("load_follow")
+        self.deferred = False
+        set_stop_forced_discharge(self.app)
+
+    def mean_power(self):
+        # Average power since the quarter started following, None when it
+        # is not
+        if self.quarter is None:
+            return None
+        now_ts = self.app.local_now().timestamp()
+        self.account(now_ts)
+        if now_ts <= self.started_ts:
+            return self.power
+        return self.discharged_wh * 3600 / (now_ts - self.started_ts)
+
+    def on_load_power(self, entity, attribute, old, new, kwargs):
+        load_w = to_watts(new)
+        if load_w is None:
+            return
+        self.load_w = load_w
+        if self.quarter is not None:
+            self.regulate(load_w + self.trim)
+
+    def on_grid_power(self, entity, attribute, old, new, kwargs):
+        grid_w = to_watts(new)
+        if grid_w is None or self.quarter is None:
+            return
+        # Readings right after a write may not show it yet
+        now_ts = self.app.local_now().timestamp()
+        if self.written_ts is not None and now_ts - self.written_ts < self.min_interval:
+            return
+        target = self.power + grid_w
+        if self.load_w is not None:
+            self.trim = target - self.load_w
+        self.regulate(target)
+
+    def regulate(self, desired):
+        with timer(self.app, "load_follow"):
+            now_ts = self.app.local_now().timestamp()
+            if now_ts >= self.quarter.end_ts:
+                return
+            self.account(now_ts)
+            self.desired = desired = self.limit(desired, now_ts)
+            if abs(desired - self.power) < self.deadband and (desired or not self.power):
+                return
+            if self.written_ts is not None and now_ts - self.written_ts < self.min_interval:
+                if not self.deferred:
+                    self.deferred = True
+                    self.app.dispatcher.schedule("load_follow", self.write_deferred, self.written_ts + self.min_interval)
+                return
+            self.write(desired, now_ts)
+
+    def write_deferred(self, kwargs):
+        self.deferred = False
+        if self.quarter is not None:
+            self.regulate(self.desired)
+
+    def write(self, power, now_ts):
+        self.account(now_ts)
+        self.power = self.desired = power
+        self.written_ts = now_ts
+        set_forced_discharge(self.app, power)
+
+    def account(self, now_ts):
+        if self.power_ts is not None and self.quarter is not None:
+            self.discharged_wh += self.power * (now_ts - self.power_ts) / 3600
+        self.power_ts = now_ts
+
+    def limit(self, desired, now_ts):
+        # Never faster than what is left of the budget spread over what is
+        # left of the quarter, so it cannot run out early
+        remaining_s = self.quarter.end_ts - now_ts
+        remaining_wh = max(self.budget_wh - self.discharged_wh, 0.0)
+        cap = min(self.max_power, remaining_wh * 3600 / remaining_s) if remaining_s > 0 else 0.0
+        return float(round(min(max(desired, 0.0), cap)))
+
+
+def to_watts(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
@@ -0,0 +1,196 @@
+import os
+import struct
+from array import array
+from datetime import datetime, timedelta
+from constants import LOAD_PROFILE_DAYS, LOAD_PROFILE_MIN_DAYS
+from price_series import localize
+
+QUARTERS_PER_DAY = 96
+SEASONS = ("winter", "shoulder", "summer")
+MAGIC = b"SGLP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHH")
+BUCKET_HEADER = struct.Struct("<II")
+MAX_SAMPLE_GAP = 2 * 3600
+
+
+class LoadProfile:
+    # Per-quarter consumption in Wh, split by season and weekday/weekend.
+    # Every bucket is a ring of the last `days` days of 96 float32 slots
+    # plus running sums, so the mean profile is ready without scanning.
+    # The whole store is one fixed-size binary file. season_of maps a day
+    # to one of SEASONS.
+    def __init__(self, tz, season_of, path=None, days=LOAD_PROFILE_DAYS, min_days=LOAD_PROFILE_MIN_DAYS):
+        self.tz = tz
+        self.season_of = season_of
+        self.path = path
+        self.days = days
+        self.min_days = min_days
+        self.buckets = len(SEASONS) * 2
+        self.data = [array("f", bytes(4 * days * QUARTERS_PER_DAY)) for _ in range(self.buckets)]
+        self.counts = [0] * self.buckets
+        self.next_slot = [0] * self.buckets
+        self.sums = [array("d", bytes(8 * QUARTERS_PER_DAY)) for _ in range(self.buckets)]
+
+        self.day = None
+        self.day_start = None
+        self.day_end = None
+        self.boundaries = None
+        self.last_sample = None
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        with self.path.open("rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) != HEADER.size:
+                return
+            magic, version, days, buckets = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION or days != self.days or buckets != self.buckets:
+                return
+            # A truncated file is thrown away and the profile starts empty
+            try:
+                stored = []
+                for b in range(self.buckets):
+                    count, next_slot = BUCKET_HEADER.unpack(f.read(BUCKET_HEADER.size))
+                    data = array("f")
+                    data.fromfile(f, self.days * QUARTERS_PER_DAY)
+                    stored.append((count, next_slot, data))
+            except (struct.error, EOFError, ValueError):
+                return
+        for b, (count, next_slot, data) in enumerate(stored):
+            self.counts[b] = count
+            self.next_slot[b] = next_slot
+            self.data[b] = data
+            self.refresh_sums(b)
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.days, self.buckets))
+            for b in range(self.buckets):
+                f.write(BUCKET_HEADER.pack(self.counts[b], self.next_slot[b]))
+                self.data[b].tofile(f)
+        os.replace(tmp, self.path)
+
+    def refresh_sums(self, b):
+        sums = array("d", bytes(8 * QUARTERS_PER_DAY))
+        data = self.data[b]
+        for d in range(min(self.counts[b], self.days)):
+            offset = d * QUARTERS_PER_DAY
+            for i, value in enumerate(data[offset : offset + QUARTERS_PER_DAY]):
+                sums[i] += value
+        self.sums[b] = sums
+
+    def add_day(self, day, quarters_wh):
+        if len(quarters_wh) != QUARTERS_PER_DAY:
+            return
+        b = self.bucket_index(day)
+        offset = self.next_slot[b] * QUARTERS_PER_DAY
+        data = self.data[b]
+        sums = self.sums[b]
+        evict = self.counts[b] >= self.days
+
+        for i, value in enumerate(quarters_wh):
+            if evict:
+                sums[i] -= data[offset + i]
+            data[offset + i] = value
+            sums[i] += data[offset + i]
+
+        self.next_slot[b] = (self.next_slot[b] + 1) % self.days
+        self.counts[b] = min(self.counts[b] + 1, self.days)
+
+    def bucket_index(self, day):
+        weekend = 1 if day.weekday() >= 5 else 0
+        return SEASONS.index(self.season_of(day)) * 2 + weekend
+
+    def profile(self, day):
+        b = self.bucket_index(day)
+        count = self.counts[b]
+        if count < self.min_days:
+            return None
+        return [total / count for total in self.sums[b]]
+
+    def samples(self, day):
+        # The stored days of the bucket `day` falls in, oldest first, or
+        # None when the bucket does not have enough history yet
+        b = self.bucket_index(day)
+        count = self.counts[b]
+        if count < self.min_days:
+            return None
+        first = self.next_slot[b] if count >= self.days else 0
+        data = self.data[b]
+        return [
+            data[slot * QUARTERS_PER_DAY : (slot + 1) * QUARTERS_PER_DAY]
+            for slot in ((first + i) % self.days for i in range(count))
+        ]
+
+    def demand(self, first_day, days):
+        # Expected Wh per quarter for `days` consecutive days, or None when
+        # a bucket does not have enough history yet
+        vector = []
+        for i in range(days):
+            profile = self.profile(first_day + timedelta(days=i))
+            if profile is None:
+                return None
+            vector.extend(profile)
+        return vector
+
+    def record(self, ts, state):
+        # Feed raw meter samples. Quarter boundary readings are interpolated
+        # between samples and a finished day is committed to its bucket.
+        try:
+            energy_kwh = float(state)
+        except (ValueError, TypeError):
+            return
+
+        if self.last_sample is not None:
+            if ts <= self.last_sample[0]:
+                return
+            if energy_kwh < self.last_sample[1]:
+                # Meter was reset, start over from this reading
+                self.last_sample = (ts, energy_kwh)
+                self.day = None
+                return
+
+        if self.day is None:
+            self.start_day(ts)
+        elif ts >= self.day_end:
+            self.fill_boundaries(ts, energy_kwh)
+            self.finish_day()
+            self.start_day(ts)
+
+        self.fill_boundaries(ts, energy_kwh)
+        self.last_sample = (ts, energy_kwh)
+
+    def start_day(self, ts):
+        self.day = datetime.fromtimestamp(ts, self.tz).date()
+        self.day_start = local_midnight(self.tz, self.day).timestamp()
+        self.day_end = local_midnight(self.tz, self.day + timedelta(days=1)).timestamp()
+        self.boundaries = [None] * (round((self.day_end - self.day_start) / 900) + 1)
+
+    def fill_boundaries(self, ts, energy_kwh):
+        if self.last_sample is None:
+            return
+        last_ts, last_kwh = self.last_sample
+        if ts - last_ts > MAX_SAMPLE_GAP:
+            return
+        first = max(int((last_ts - self.day_start) // 900) + 1, 0)
+        last = min(int((ts - self.day_start) // 900), len(self.boundaries) - 1)
+        for i in range(first, last + 1):
+            fraction = (self.day_start + i * 900 - last_ts) / (ts - last_ts)
+            self.boundaries[i] = last_kwh + (energy_kwh - last_kwh) * fraction
+
+    def finish_day(self):
+        boundaries = self.boundaries
+        if len(boundaries) != QUARTERS_PER_DAY + 1 or None in boundaries:
+            # Incomplete or DST day, not representative for a 96-slot profile
+            return
+        self.add_day(self.day, [(boundaries[i + 1] - boundaries[i]) * 1000 for i in range(QUARTERS_PER_DAY)])
+        self.save()
+
+
+def local_midnight(tz, day):
+    return localize(tz, datetime(day.year, day.month, day.day))
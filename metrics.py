@@ -0,0 +1,162 @@
+import functools
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+# Upper bounds in ms, the last bucket catches everything slower
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = array("L", bytes(array("L").itemsize * (len(BUCKETS_MS) + 1)))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding the percentile, capped at the max
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p90_ms": round(self.percentile(90), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max, 3),
+        }
+
+
+class Metrics:
+    # Fixed-size latency histograms per phase plus plain event counters.
+    # Timing goes through timer() and @timed, which cost one attribute
+    # check when metrics are off.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, ms):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(ms)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summaries(self):
+        with self.lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def counter_values(self):
+        with self.lock:
+            return dict(sorted(self.counters.items()))
+
+    def prometheus(self, prefix="sungrow"):
+        lines = []
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{prefix}_{name.replace('.', '_')}_ms"
+                lines.append(f"# TYPE {metric} histogram")
+                seen = 0
+                for bound, count in zip(BUCKETS_MS + ("+Inf",), histogram.counts):
+                    seen += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {seen}')
+                lines.append(f"{metric}_sum {histogram.total:.3f}")
+                lines.append(f"{metric}_count {histogram.count}")
+            for name, value in sorted(self.counters.items()):
+                metric = f"{prefix}_{name.replace('.', '_')}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(self.prometheus())
+        os.replace(tmp, path)
+
+
+class PhaseTimer:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, (time.perf_counter() - self.started) * 1000)
+        return False
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def get_metrics(app):
+    metrics = getattr(app, "metrics", None)
+    if metrics is None or not metrics.enabled:
+        return None
+    return metrics
+
+
+def timer(app, name):
+    # with timer(app, "optimizer"): ...
+    metrics = get_metrics(app)
+    if metrics is None:
+        return NULL_TIMER
+    return PhaseTimer(metrics, name)
+
+
+def timed(name):
+    # Decorator for functions and methods whose first argument is the app
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(app, *args, **kwargs):
+            metrics = get_metrics(app)
+            if metrics is None:
+                return func(app, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(app, *args, **kwargs)
+            finally:
+                metrics.observe(name, (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorator
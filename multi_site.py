@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from constants import MAX_PLANNER_WORKERS
+from scheduler import SungrowScheduler
+from sites import Site
+
+
+class SiteScheduler(SungrowScheduler):
+    # The planner of one site in a MultiSiteScheduler. AppDaemon never sets
+    # it up: Home Assistant calls go through the host app, timers through
+    # the host's dispatcher and price days through the host's cache.
+    def __init__(self, host, site):
+        self.host = host
+        self.site = site
+        self.tz = host.tz
+        self.metrics = host.metrics
+        self.dispatcher = host.dispatcher.scope(site.name)
+        self.price_cache = host.price_cache
+        self.plan_cache = host.plan_cache
+
+    def get_prices(self):
+        return self.host.area_prices(self.site, self.price_dates()[0], super().get_prices)
+
+    def refresh_prices(self):
+        self.host.refresh_area_prices(self.site, super().refresh_prices)
+
+    def local_now(self):
+        return self.host.local_now()
+
+    def log(self, msg, *args, **kwargs):
+        return self.host.log(f"[{self.site.name}] {msg}", *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        return self.host.error(f"[{self.site.name}] {msg}", *args, **kwargs)
+
+    def get_state(self, *args, **kwargs):
+        return self.host.get_state(*args, **kwargs)
+
+    def set_state(self, *args, **kwargs):
+        return self.host.set_state(*args, **kwargs)
+
+    def turn_on(self, *args, **kwargs):
+        return self.host.turn_on(*args, **kwargs)
+
+    def turn_off(self, *args, **kwargs):
+        return self.host.turn_off(*args, **kwargs)
+
+    def call_service(self, *args, **kwargs):
+        return self.host.call_service(*args, **kwargs)
+
+    def get_history(self, *args, **kwargs):
+        return self.host.get_history(*args, **kwargs)
+
+    def listen_state(self, *args, **kwargs):
+        return self.host.listen_state(*args, **kwargs)
+
+    def run_in(self, *args, **kwargs):
+        return self.host.run_in(*args, **kwargs)
+
+    def run_at(self, *args, **kwargs):
+        return self.host.run_at(*args, **kwargs)
+
+    def cancel_timer(self, *args, **kwargs):
+        return self.host.cancel_timer(*args, **kwargs)
+
+
+class MultiSiteScheduler(SungrowScheduler):
+    # Plans every site listed under `sites` in the app arguments from one
+    # AppDaemon app, e.g.
+    #
+    #   sungrow:
+    #     module: multi_site
+    #     class: MultiSiteScheduler
+    #     sites:
+    #       - name: home
+    #         state_dir: /conf/apps/sungrow/home
+    #       - name: cabin
+    #         area: SE2
+    #         state_dir: /conf/apps/sungrow/cabin
+    #         battery_level: sensor.cabin_battery_level
+    #
+    # Each site keeps its own plan, state file and entities (see
+    # sites.SITE_DEFAULTS). Sites share the dispatcher, the metrics and
+    # the price and plan caches, and sites in the same area share one
+    # price series. The daily runs plan the sites in parallel on a thread
+    # pool.
+
+    site_class = SiteScheduler
+
+    def start_sites(self):
+        sites = [Site(**settings) for settings in self.args.get("sites", [])]
+        if not sites:
+            raise ValueError("No sites configured")
+        names = [site.name for site in sites]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Site names must be unique: {', '.join(names)}")
+
+        self.price_lock = threading.Lock()
+        self.prices = {}
+        self.planners = [self.site_class(self, site) for site in sites]
+        for planner in self.planners:
+            planner.start_site()
+
+    def stop_sites(self):
+        for planner in self.planners:
+            planner.stop_site()
+
+    def plan_next_day(self, run_time=None):
+        self.run_sites("plan_next_day", run_time)
+
+    def check_no_nightly_charge(self, run_time=None):
+        self.run_sites("check_no_nightly_charge", run_time)
+
+    def watch_prices(self, run_time=None):
+        self.run_sites("watch_prices", run_time)
+
+    def run_sites(self, method, *args):
+        # A failing site is logged and does not hold up the others
+        workers = min(len(self.planners), MAX_PLANNER_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(getattr(planner, method), *args): planner
+                for planner in self.planners
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.error(f"[{futures[future].site.name}] {method} failed: {e}")
+
+    def area_prices(self, site, day, fetch):
+        # One series per area and day. The first site to ask fetches it
+        # while the others wait on price_lock, and an incomplete series is
+        # fetched again on the next call.
+        key = (site.area, site.currency, day)
+        with self.price_lock:
+            prices = self.prices.get(key)
+            if prices is None or not (prices.is_complete_day(0) and prices.is_complete_day(1)):
+                prices = fetch()
+                self.prices = {k: v for k, v in self.prices.items() if k[2] == day}
+                self.prices[key] = prices
+            return prices
+
+    def refresh_area_prices(self, site, refresh):
+        # Corrected prices replace the area's series for every site in it
+        with self.price_lock:
+            refresh()
+            self.prices = {k: v for k, v in self.prices.items() if k[:2] != (site.area, site.currency)}
@@ -1,66 +1,278 @@
+import heapq
 import math
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import time
 from constants import (
     MIN_SOC,
     BATTERY_CAPACITY,
     MAX_CHARGE_POWER,
+    MIN_CHARGE_POWER,
     SEK_THRESHOLD,
-    STANDARD_DEVIATION_THRESHOLD
+    CHEAP_CHARGE_PRICE,
+    STANDARD_DEVIATION_THRESHOLD,
+    DP_SOC_STEP,
+    ROBUST_OBJECTIVE
 )
 
-def select_night_plan(prices, avg_15min_energy_wh, current_soc):
-    night_prices = sorted(
-        {q["price"] for q in prices[22 * 4 : 30 * 4]}
-    )
+def select_night_plan(prices, avg_15min_energy_wh, current_soc, engine="threshold", demand=None, scenarios=None):
+    # prices is a PriceSeries starting today. demand is an optional expected
+    # Wh per quarter aligned with it, without it every quarter is assumed to
+    # use avg_15min_energy_wh. scenarios are possible net loads aligned the
+    # same way, used by the robust engine.
+    if demand is not None and len(demand) != len(prices):
+        demand = None
+    if scenarios is not None:
+        scenarios = [scenario for scenario in scenarios if len(scenario) == len(prices)]
+    if engine == "robust" and not scenarios:
+        engine = "threshold"
 
-    best = None
+    if engine == "dp":
+        # Everything from tonight's 22:00 to the end of tomorrow, the rest
+        # of the two-day series. Today's quarters before 22:00 are over by
+        # the time the night plan runs, so they are left out on purpose.
+        horizon = prices.between(time(22), prices.local_time(2, time(0)))
+        return plan_dp(
+            horizon,
+            avg_15min_energy_wh,
+            current_soc,
+            demand_for(prices, horizon, demand),
+        )
+    if engine not in ("threshold", "robust"):
+        raise ValueError(f"Unknown optimizer engine: {engine}")
+
+    night = prices.between(time(22), time(6))
+    day = prices.between(time(6), time(22), day=1)
 
-    for price in night_prices:
-        candidate = evaluate_candidate(
-            prices,
-            price,
+    if engine == "robust":
+        best_price = sweep_robust_thresholds(
+            night,
+            day,
+            current_soc,
+            [demand_for(prices, day, scenario) for scenario in scenarios],
+        )
+    else:
+        best_price = sweep_night_thresholds(
+            night,
+            day,
             avg_15min_energy_wh,
             current_soc,
+            demand_for(prices, day, demand),
         )
-        if not candidate:
+
+    if best_price is not None:
+        # Night quarters are in time order, so one pass gives the sorted
+        # union of threshold and cheap quarters
+        charge_quarters = night.where(lambda price: price <= best_price or price < CHEAP_CHARGE_PRICE)
+        discharge_quarters = day.where(lambda price: price >= best_price + SEK_THRESHOLD)
+        return charge_quarters, discharge_quarters
+    else:
+        return night.where(lambda price: price < CHEAP_CHARGE_PRICE), []
+
+
+def demand_for(prices, part, demand):
+    if demand is None or not len(part):
+        return None
+    first = prices.index_of(part.starts[0])
+    return demand[first : first + len(part)]
+
+
+def sweep_night_thresholds(night, day, avg_15min_energy_wh, current_soc, day_demand=None):
+    # Scores every distinct night price as charge threshold in one pass and
+    # returns the winning price, with the same ordering as evaluate_candidate
+    if avg_15min_energy_wh <= 0 or not night:
+        return None
+
+    night_prices = sorted(night.prices)
+    day_prices = sorted(day.prices)
+
+    # With a load profile the quarters are served most expensive first, so
+    # the affordable count comes from the cumulative demand in that order
+    cumulative_demand = None
+    if day_demand is not None:
+        cumulative_demand = [0.0]
+        for _, energy in sorted(zip(day.prices, day_demand), key=lambda p: -p[0]):
+            cumulative_demand.append(cumulative_demand[-1] + max(energy, 0))
+
+    usable_existing_energy = max(
+        (current_soc - MIN_SOC) / 100 * BATTERY_CAPACITY,
+        0,
+    )
+    remaining_capacity = (
+        (100 - MIN_SOC) / 100 * BATTERY_CAPACITY
+        - usable_existing_energy
+    )
+
+    # Shift by the cheapest price to keep the running sum of squares stable
+    shift = night_prices[0]
+    total = 0.0
+    total_sq = 0.0
+
+    best = None
+    best_price = None
+
+    for i, price in enumerate(night_prices):
+        delta = price - shift
+        total += delta
+        total_sq += delta * delta
+
+        if i + 1 < len(night_prices) and night_prices[i + 1] == price:
+            continue
+
+        count = i + 1
+        mean = total / count
+        variance = max(total_sq / count - mean * mean, 0.0)
+        standard_deviation = math.sqrt(variance)
+        if abs(standard_deviation - STANDARD_DEVIATION_THRESHOLD) < 1e-6:
+            # Too close to call with running sums, settle it the exact way
+            standard_deviation = get_standard_deviation(night_prices[:count])
+        if standard_deviation > STANDARD_DEVIATION_THRESHOLD:
             continue
 
-        key = (
-            candidate[2],        # est_discharge_quarters
-            len(candidate[0]),   # charge_quarters
+        discharge_count = len(day_prices) - bisect_left(day_prices, price + SEK_THRESHOLD)
+        if discharge_count == 0:
+            continue
+
+        chargeable_energy = min(
+            count * MAX_CHARGE_POWER * 0.25,
+            remaining_capacity,
         )
+        available_energy = usable_existing_energy + chargeable_energy
 
-        if best is None or key > best[0]:
-            best = (key, candidate)
-            
-    cheap_quarters = [q for q in prices[22 * 4 : 30 * 4] if q["price"] < 100]
+        if cumulative_demand is None:
+            affordable = int(available_energy // avg_15min_energy_wh)
+        else:
+            affordable = bisect_right(cumulative_demand, available_energy) - 1
 
-    if best:
-        charge_quarters, discharge_quarters = best[1][0], best[1][1]
-        unique_charge = {q["start"]: q for q in charge_quarters + cheap_quarters}
-        charge_quarters = sorted(unique_charge.values(), key=lambda q: q["start"])
-        return charge_quarters, discharge_quarters
-    else:
-        return sorted(cheap_quarters, key=lambda q: q["start"]), []
+        est_discharge_quarters = min(affordable, discharge_count)
+        if est_discharge_quarters == 0:
+            continue
+
+        key = (est_discharge_quarters, count)
+        if best is None or key > best:
+            best = key
+            best_price = price
+
+    return best_price
     
 
+def sweep_robust_thresholds(night, day, current_soc, day_scenarios, objective=None):
+    # Scores every distinct night price as charge threshold against every
+    # scenario of tomorrow's net load and returns the price with the best
+    # expected (mean) or worst-case gain, None when none of them gains.
+    # A scenario's gain is what the discharged energy saves over what it
+    # cost to charge. Every scenario serves the day quarters most expensive
+    # first, so the price order and each scenario's prefix sums along it
+    # are built once and a (candidate, scenario) pair is one bisect.
+    # Without numpy the scenarios are still a Python loop: running them
+    # through map() over builtins measured no faster, as the min and
+    # bisect calls cost the same either way.
+    objective = objective or ROBUST_OBJECTIVE
+    if objective not in ("expected", "worst"):
+        raise ValueError(f"Unknown robust objective: {objective}")
+    if not night or not day or not day_scenarios:
+        return None
+
+    order = sorted(range(len(day)), key=lambda i: -day.prices[i])
+    ordered_prices = [day.prices[i] for i in order]
+    ascending = ordered_prices[::-1]
+    energy_sums = []
+    value_sums = []
+    for scenario in day_scenarios:
+        energy = array("d", [0.0])
+        value = array("d", [0.0])
+        total = 0.0
+        worth = 0.0
+        for i, price in zip(order, ordered_prices):
+            wh = scenario[i]
+            if wh > 0:
+                total += wh
+                worth += wh * price
+            energy.append(total)
+            value.append(worth)
+        energy_sums.append(energy)
+        value_sums.append(value)
+
+    night_prices = sorted(night.prices)
+    full_wh = MAX_CHARGE_POWER * 0.25
+    usable_existing_energy = max((current_soc - MIN_SOC) / 100 * BATTERY_CAPACITY, 0)
+    remaining_capacity = (100 - MIN_SOC) / 100 * BATTERY_CAPACITY - usable_existing_energy
+    scenario_count = len(day_scenarios)
+
+    shift = night_prices[0]
+    total = 0.0
+    total_sq = 0.0
+    cheapest = [0.0]
+    best = None
+    best_price = None
+
+    for i, price in enumerate(night_prices):
+        delta = price - shift
+        total += delta
+        total_sq += delta * delta
+        cheapest.append(cheapest[-1] + price)
+
+        if i + 1 < len(night_prices) and night_prices[i + 1] == price:
+            continue
+
+        count = i + 1
+        mean = total / count
+        standard_deviation = math.sqrt(max(total_sq / count - mean * mean, 0.0))
+        if abs(standard_deviation - STANDARD_DEVIATION_THRESHOLD) < 1e-6:
+            standard_deviation = get_standard_deviation(night_prices[:count])
+        if standard_deviation > STANDARD_DEVIATION_THRESHOLD:
+            continue
+
+        discharge_count = len(ascending) - bisect_left(ascending, price + SEK_THRESHOLD)
+        if discharge_count == 0:
+            continue
+
+        # The charged energy comes from the cheapest quarters and the
+        # energy already stored is counted at the same price
+        chargeable_energy = max(min(count * full_wh, remaining_capacity), 0)
+        full = int(chargeable_energy // full_wh)
+        charge_cost = cheapest[full] * full_wh + (chargeable_energy - full * full_wh) * (night_prices[full] if full < count else 0)
+        available_energy = usable_existing_energy + chargeable_energy
+        if available_energy <= 0:
+            continue
+        energy_price = charge_cost / chargeable_energy if chargeable_energy > 0 else night_prices[0]
+
+        gains = []
+        for energy, value in zip(energy_sums, value_sums):
+            served = min(available_energy, energy[discharge_count])
+            k = bisect_right(energy, served, 0, discharge_count + 1) - 1
+            worth = value[k]
+            if k < discharge_count:
+                worth += (served - energy[k]) * ordered_prices[k]
+            gains.append(worth - served * energy_price)
+
+        score = sum(gains) / scenario_count if objective == "expected" else min(gains)
+        key = (score, count)
+        if score > 0 and (best is None or key > best):
+            best = key
+            best_price = price
+
+    return best_price
+
+
 def evaluate_candidate(prices, max_charge_price, avg_15min_energy_wh, current_soc):
     if avg_15min_energy_wh <= 0:
         return None
 
-    night = prices[22 * 4 : 30 * 4]
-    day = prices[30 * 4 : 46 * 4]
+    night = prices.between(time(22), time(6))
+    day = prices.between(time(6), time(22), day=1)
 
-    charge_quarters = [q for q in night if q["price"] <= max_charge_price]
+    charge_quarters = [q for q in night if q.price <= max_charge_price]
     if not charge_quarters:
         return None
         
-    standard_deviation = get_standard_deviation(charge_quarters)
+    standard_deviation = get_standard_deviation([q.price for q in charge_quarters])
     if standard_deviation > STANDARD_DEVIATION_THRESHOLD:
         return None
 
     discharge_quarters = [
         q for q in day
-        if q["price"] >= max_charge_price + SEK_THRESHOLD
+        if q.price >= max_charge_price + SEK_THRESHOLD
     ]
     if not discharge_quarters:
         return None
@@ -97,12 +309,106 @@ def evaluate_candidate(prices, max_charge_price, avg_15min_energy_wh, current_so
         return None
 
     return (
-        sorted(charge_quarters, key=lambda q: q["start"]),
-        sorted(discharge_quarters, key=lambda q: q["start"]),
+        charge_quarters,
+        discharge_quarters,
         est_discharge_quarters,
     )
 
+def allocate_charge(charge_quarters, charge_amount):
+    # Power per quarter for charge_amount Wh plus 10% losses. The cheapest
+    # quarters run at MAX_CHARGE_POWER and the most expensive one picked
+    # takes the rest, rounded up to 100 W and at least MIN_CHARGE_POWER.
+    # Returns (quarter, power) pairs in the order the quarters were given.
+    if not charge_quarters or charge_amount <= 0:
+        return []
+
+    full_wh = MAX_CHARGE_POWER * 0.25
+    needed = charge_amount * 1.1
+    count = min(math.ceil(needed / full_wh), len(charge_quarters))
+    # Equal prices go to the earlier quarter
+    prices = [q.price for q in charge_quarters]
+    picked = heapq.nsmallest(count, range(len(prices)), key=prices.__getitem__)
+
+    rest = needed - (count - 1) * full_wh
+    last_power = math.ceil(round(rest * 4 / 100, 6)) * 100
+    last_power = min(max(last_power, MIN_CHARGE_POWER), MAX_CHARGE_POWER)
+
+    powers = dict.fromkeys(picked[:-1], MAX_CHARGE_POWER)
+    powers[picked[-1]] = last_power
+    return [(charge_quarters[i], powers[i]) for i in sorted(powers)]
+
+
 def get_standard_deviation(prices):
-    mean = sum(q['price'] for q in prices) / len(prices)
-    variance = sum((q['price'] - mean) ** 2 for q in prices) / len(prices)
+    mean = sum(prices) / len(prices)
+    variance = sum((p - mean) ** 2 for p in prices) / len(prices)
     return math.sqrt(variance)
+
+
+
+def plan_dp(prices, avg_15min_energy_wh, current_soc, demand=None):
+    # Least-cost charge/discharge/idle sequence over every quarter in prices.
+    # State is the usable SoC above MIN_SOC in DP_SOC_STEP levels, demand is
+    # the per-quarter load (flat avg_15min_energy_wh unless given) and every
+    # discharged kWh carries SEK_THRESHOLD as wear cost, the same spread the
+    # threshold engine demands.
+    if not prices:
+        return [], []
+
+    step_wh = BATTERY_CAPACITY * DP_SOC_STEP / 100
+    top = int((100 - MIN_SOC) // DP_SOC_STEP)
+    charge_steps = max(1, int(MAX_CHARGE_POWER * 0.25 // step_wh))
+    loads = [max(e, 0) for e in demand] if demand else [max(avg_15min_energy_wh, 0)] * len(prices)
+
+    policy = []
+    discharge_plan = []
+    value = [0.0] * (top + 1)
+
+    for q, load_wh in zip(reversed(prices), reversed(loads)):
+        price_wh = q.price / 1000
+        idle_cost = price_wh * load_wh
+        discharge_steps = max(1, round(load_wh / step_wh))
+        discharge_cost = SEK_THRESHOLD * discharge_steps * step_wh / 1000
+
+        best = [idle_cost + v for v in value]
+        action = bytearray(top + 1)
+
+        charge_cost = idle_cost + price_wh * charge_steps * step_wh
+        for s, v in enumerate(value[charge_steps:]):
+            cost = charge_cost + v
+            if cost < best[s]:
+                best[s] = cost
+                action[s] = 1
+        for s in range(max(top - charge_steps + 1, 0), top):
+            cost = idle_cost + price_wh * (top - s) * step_wh + value[top]
+            if cost < best[s]:
+                best[s] = cost
+                action[s] = 1
+
+        if load_wh > 0:
+            for s, v in enumerate(value[: top + 1 - discharge_steps], discharge_steps):
+                cost = discharge_cost + v
+                if cost < best[s]:
+                    best[s] = cost
+                    action[s] = 2
+
+        policy.append(action)
+        discharge_plan.append(discharge_steps)
+        value = best
+
+    policy.reverse()
+    discharge_plan.reverse()
+
+    state = min(max(round((current_soc - MIN_SOC) / DP_SOC_STEP), 0), top)
+    charge_quarters = []
+    discharge_quarters = []
+
+    for q, action, discharge_steps in zip(prices, policy, discharge_plan):
+        decision = action[state]
+        if decision == 1:
+            charge_quarters.append(q)
+            state = min(state + charge_steps, top)
+        elif decision == 2:
+            discharge_quarters.append(q)
+            state -= discharge_steps
+
+    return charge_quarters, discharge_quarters
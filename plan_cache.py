@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import threading
+from array import array
+from collections import OrderedDict
+import optimizer
+from constants import (
+    PLAN_CACHE_SIZE,
+    PLAN_CACHE_SPILL_SIZE,
+    PLAN_CACHE_SOC_STEP,
+    PLAN_CACHE_ENERGY_STEP,
+)
+
+CACHE_VERSION = 1
+# Constants select_night_plan reads, part of the key so a sweep that
+# overrides them never gets another setting's plan
+OPTIMIZER_SETTINGS = (
+    "MIN_SOC",
+    "BATTERY_CAPACITY",
+    "MAX_CHARGE_POWER",
+    "SEK_THRESHOLD",
+    "CHEAP_CHARGE_PRICE",
+    "STANDARD_DEVIATION_THRESHOLD",
+    "DP_SOC_STEP",
+    "ROBUST_OBJECTIVE",
+)
+
+
+class PlanCache:
+    # select_night_plan results keyed by the price vector, the demand and
+    # scenarios, and the SoC and load rounded to soc_step and energy_step
+    # (demand and scenarios are rounded to energy_step too). The plan is
+    # solved for the rounded inputs, so a hit returns exactly what a solve
+    # would. Plans are kept as indexes into the price series and pushed out
+    # least recently used first, into the spill file when there is one.
+    def __init__(
+        self,
+        path=None,
+        size=PLAN_CACHE_SIZE,
+        spill_size=PLAN_CACHE_SPILL_SIZE,
+        soc_step=PLAN_CACHE_SOC_STEP,
+        energy_step=PLAN_CACHE_ENERGY_STEP,
+        metrics=None,
+    ):
+        self.path = path
+        self.size = size
+        self.spill_size = spill_size
+        self.soc_step = soc_step
+        self.energy_step = energy_step
+        self.metrics = metrics
+        self.entries = OrderedDict()
+        self.spilled = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != CACHE_VERSION:
+            return
+        self.spilled = {key: (tuple(charge), tuple(discharge)) for key, (charge, discharge) in data.get("plans", {}).items()}
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            "version": CACHE_VERSION,
+            "plans": {key: [list(charge), list(discharge)] for key, (charge, discharge) in self.spilled.items()},
+        }
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def select_night_plan(self, prices, avg_15min_energy_wh, current_soc, engine="threshold", demand=None, scenarios=None):
+        # Same arguments and result as optimizer.select_night_plan
+        avg_15min_energy_wh = round_to(avg_15min_energy_wh, self.energy_step)
+        current_soc = round_to(current_soc, self.soc_step)
+        if demand is not None:
+            demand = [round_to(energy, self.energy_step) for energy in demand]
+        if scenarios is not None:
+            scenarios = [[round_to(energy, self.energy_step) for energy in scenario] for scenario in scenarios]
+        key = self.key(prices, avg_15min_energy_wh, current_soc, engine, demand, scenarios)
+
+        with self.lock:
+            plan = self.lookup(key)
+        if plan is not None:
+            charge, discharge = plan
+            return [prices[i] for i in charge], [prices[i] for i in discharge]
+
+        charge_quarters, discharge_quarters = optimizer.select_night_plan(
+            prices, avg_15min_energy_wh, current_soc, engine=engine, demand=demand, scenarios=scenarios
+        )
+        plan = (
+            tuple(prices.index_of(q.start_ts) for q in charge_quarters),
+            tuple(prices.index_of(q.start_ts) for q in discharge_quarters),
+        )
+        with self.lock:
+            self.store(key, plan)
+        return charge_quarters, discharge_quarters
+
+    def key(self, prices, avg_15min_energy_wh, current_soc, engine, demand, scenarios):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(prices.starts.tobytes())
+        digest.update(prices.ends.tobytes())
+        digest.update(prices.prices.tobytes())
+        if demand is not None:
+            digest.update(array("d", demand).tobytes())
+        for scenario in scenarios or ():
+            digest.update(array("d", scenario).tobytes())
+        settings = tuple(getattr(optimizer, name) for name in OPTIMIZER_SETTINGS)
+        shape = (demand is None, len(scenarios) if scenarios is not None else None)
+        digest.update(repr((avg_15min_energy_wh, current_soc, engine, shape, settings)).encode())
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        plan = self.entries.get(key)
+        if plan is not None:
+            self.entries.move_to_end(key)
+            self.count("plan_cache.hit")
+            return plan
+
+        plan = self.spilled.pop(key, None)
+        if plan is not None:
+            self.store(key, plan)
+            self.count("plan_cache.spill_hit")
+            return plan
+
+        self.count("plan_cache.miss")
+        return None
+
+    def store(self, key, plan):
+        self.entries[key] = plan
+        self.entries.move_to_end(key)
+        if len(self.entries) <= self.size:
+            return
+        evicted_key, evicted = self.entries.popitem(last=False)
+        if self.path is None or not self.spill_size:
+            return
+        self.spilled[evicted_key] = evicted
+        while len(self.spilled) > self.spill_size:
+            del self.spilled[next(iter(self.spilled))]
+        try:
+            self.save()
+        except OSError:
+            pass
+
+    def count(self, name):
+        if name == "plan_cache.miss":
+            self.misses += 1
+        else:
+            self.hits += 1
+        if self.metrics is not None and self.metrics.enabled:
+            self.metrics.increment(name)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate(), 3),
+            "entries": len(self.entries),
+            "spilled": len(self.spilled),
+        }
+
+
+def round_to(value, step):
+    if not step:
+        return value
+    return round(value / step) * step
@@ -0,0 +1,41 @@
+import json
+import os
+
+SNAPSHOT_VERSION = 2
+
+
+def save_snapshot(path, snapshot):
+    # Written next to the target and swapped in, so a crash mid-write
+    # leaves the previous plan intact
+    data = dict(snapshot, version=SNAPSHOT_VERSION)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_snapshot(path):
+    # The stored plan as a dict, None when there is nothing usable. Files
+    # from before snapshots were versioned only carry the two schedules.
+    if path is None or not path.exists():
+        return None
+    try:
+        with path.open() as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    version = data.get("version", 1)
+    if version == 1:
+        return {
+            "version": 1,
+            "charge": data.get("charge", []),
+            "discharge": data.get("discharge", []),
+        }
+    if version != SNAPSHOT_VERSION:
+        return None
+    return data
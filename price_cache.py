@@ -0,0 +1,105 @@
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+from constants import PRICE_MISS_TTL, PRICE_CACHE_DAYS
+
+CACHE_VERSION = 1
+QUARTERS_PER_DAY = 96
+
+
+class PriceCache:
+    # Nordpool days keyed by (area, currency, date). Complete days never
+    # change once published, so they are kept for good (and on disk), while
+    # missing days are remembered only for miss_ttl seconds.
+    def __init__(self, path=None, miss_ttl=PRICE_MISS_TTL, keep_days=PRICE_CACHE_DAYS):
+        self.path = path
+        self.miss_ttl = miss_ttl
+        self.keep_days = keep_days
+        self.days = {}
+        self.misses = {}
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != CACHE_VERSION:
+            return
+
+        for key, rows in data.get("days", {}).items():
+            area, currency, day = key.split("|")
+            self.days[(area, currency, day)] = [
+                {"start": start, "end": end, "price": price, "start_ts": start_ts, "end_ts": end_ts}
+                for start, end, price, start_ts, end_ts in rows
+            ]
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            "version": CACHE_VERSION,
+            "days": {
+                "|".join(key): [
+                    [q["start"], q["end"], q["price"], q["start_ts"], q["end_ts"]]
+                    for q in quarters
+                ]
+                for key, quarters in self.days.items()
+            },
+        }
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def get(self, area, currency, day, now=None):
+        # List of quarters if known, [] while a miss is still fresh,
+        # None when the day has to be fetched
+        key = (area, currency, str(day))
+        quarters = self.days.get(key)
+        if quarters is not None:
+            return quarters
+
+        expires = self.misses.get(key)
+        if expires is not None:
+            if (now or time.time()) < expires:
+                return []
+            del self.misses[key]
+        return None
+
+    def put(self, area, currency, day, quarters, now=None, expected=QUARTERS_PER_DAY):
+        key = (area, currency, str(day))
+        if len(quarters) != expected:
+            self.misses[key] = (now or time.time()) + self.miss_ttl
+            return []
+
+        parsed = [parse_quarter(q) for q in quarters]
+        self.days[key] = parsed
+        self.misses.pop(key, None)
+        self.prune(date.fromisoformat(str(day)))
+        self.save()
+        return parsed
+
+    def expire(self, area, currency, day):
+        # A missing day is fetched again on the next get
+        self.misses.pop((area, currency, str(day)), None)
+
+    def prune(self, newest):
+        oldest = (newest - timedelta(days=self.keep_days)).isoformat()
+        for key in [key for key in self.days if key[2] < oldest]:
+            del self.days[key]
+
+
+def parse_quarter(q):
+    start = datetime.fromisoformat(q["start"])
+    end = datetime.fromisoformat(q["end"])
+    return {
+        "start": q["start"],
+        "end": q["end"],
+        "price": float(q["price"]),
+        "start_ts": start.timestamp(),
+        "end_ts": end.timestamp(),
+    }
@@ -0,0 +1,201 @@
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, time, timedelta
+
+QUARTER_SECONDS = 900
+
+
+def localize(tz, naive):
+    # Works for both pytz (AppDaemon) and zoneinfo timezones
+    if hasattr(tz, "localize"):
+        return tz.localize(naive)
+    return naive.replace(tzinfo=tz)
+
+
+def quarters_in_day(tz, day):
+    # 96 on normal days, 92/100 when DST starts/ends
+    start = localize(tz, datetime(day.year, day.month, day.day))
+    next_day = day + timedelta(days=1)
+    end = localize(tz, datetime(next_day.year, next_day.month, next_day.day))
+    return round((end.timestamp() - start.timestamp()) / QUARTER_SECONDS)
+
+
+def to_timestamp(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+class Quarter:
+    __slots__ = ("series", "index")
+
+    def __init__(self, series, index):
+        self.series = series
+        self.index = index
+
+    @property
+    def start_ts(self):
+        return self.series.starts[self.index]
+
+    @property
+    def end_ts(self):
+        return self.series.ends[self.index]
+
+    @property
+    def price(self):
+        return self.series.prices[self.index]
+
+    @property
+    def start(self):
+        return datetime.fromtimestamp(self.start_ts, self.series.tz)
+
+    @property
+    def end(self):
+        return datetime.fromtimestamp(self.end_ts, self.series.tz)
+
+    def as_dict(self):
+        return {
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "price": self.price,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Quarter):
+            return NotImplemented
+        return (self.start_ts, self.end_ts, self.price) == (other.start_ts, other.end_ts, other.price)
+
+    def __hash__(self):
+        return hash(self.start_ts)
+
+    def __repr__(self):
+        return f"Quarter({self.start.isoformat()}, {self.price})"
+
+
+class PriceSeries:
+    # Quarter prices as parallel arrays of epoch seconds and floats. Quarters
+    # are handed out as light views, slicing is by local time rather than
+    # by fixed index, and a timestamp maps to its index in O(1).
+    def __init__(self, starts, ends, prices, tz, first_day=None, uniform=None):
+        self.starts = starts
+        self.ends = ends
+        self.prices = prices
+        self.tz = tz
+        if first_day is None and len(starts):
+            first_day = datetime.fromtimestamp(starts[0], tz).date()
+        self.first_day = first_day
+        if uniform is None:
+            uniform = all(
+                starts[i + 1] - starts[i] == QUARTER_SECONDS for i in range(len(starts) - 1)
+            )
+        self.uniform = uniform
+
+    @classmethod
+    def from_quarters(cls, quarters, tz, first_day=None):
+        starts = array("d")
+        ends = array("d")
+        prices = array("d")
+        for q in quarters:
+            if isinstance(q, Quarter):
+                starts.append(q.start_ts)
+                ends.append(q.end_ts)
+            else:
+                starts.append(q["start_ts"] if "start_ts" in q else to_timestamp(q["start"]))
+                ends.append(q["end_ts"] if "end_ts" in q else to_timestamp(q["end"]))
+            prices.append(float(q.price if isinstance(q, Quarter) else q["price"]))
+        return cls(starts, ends, prices, tz, first_day)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield Quarter(self, i)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            uniform = self.uniform if key.step in (None, 1) else None
+            return PriceSeries(
+                self.starts[key], self.ends[key], self.prices[key], self.tz, self.first_day, uniform
+            )
+        if key < 0:
+            key += len(self.starts)
+        if not 0 <= key < len(self.starts):
+            raise IndexError(key)
+        return Quarter(self, key)
+
+    def index_of(self, when):
+        # Index of the quarter containing `when`, None outside the series
+        ts = to_timestamp(when)
+        starts = self.starts
+        if not starts:
+            return None
+        if self.uniform:
+            i = int((ts - starts[0]) // QUARTER_SECONDS)
+        else:
+            i = bisect_left(starts, ts + 1e-6) - 1
+        if 0 <= i < len(starts) and starts[i] <= ts < self.ends[i]:
+            return i
+        return None
+
+    def local_time(self, day, at):
+        on = self.first_day + timedelta(days=day)
+        return localize(self.tz, datetime.combine(on, at))
+
+    def between(self, start, end, day=0):
+        # start/end are datetimes, or local times on `day` days after the
+        # first day of the series; an end at or before start is next day
+        if isinstance(start, time):
+            start = self.local_time(day, start)
+        if isinstance(end, time):
+            end_time = end
+            end = self.local_time(day, end_time)
+            if end <= start:
+                end = self.local_time(day + 1, end_time)
+        i = bisect_left(self.starts, to_timestamp(start))
+        j = bisect_left(self.starts, to_timestamp(end))
+        return self[i:j]
+
+    def day(self, day):
+        return self.between(time(0), time(0), day)
+
+    def is_complete_day(self, day):
+        on = self.first_day + timedelta(days=day)
+        return len(self.day(day)) == quarters_in_day(self.tz, on)
+
+    def where(self, test):
+        # Quarters whose price passes `test`, without building a view for
+        # every quarter that does not
+        return [Quarter(self, i) for i, price in enumerate(self.prices) if test(price)]
+
+    def to_dicts(self):
+        return [q.as_dict() for q in self]
+
+    def to_columns(self):
+        return {
+            "first_day": self.first_day.isoformat() if self.first_day else None,
+            "starts": list(self.starts),
+            "ends": list(self.ends),
+            "prices": list(self.prices),
+        }
+
+    @classmethod
+    def from_columns(cls, data, tz):
+        first_day = date.fromisoformat(data["first_day"]) if data.get("first_day") else None
+        return cls(
+            array("d", data["starts"]),
+            array("d", data["ends"]),
+            array("d", data["prices"]),
+            tz,
+            first_day,
+        )
+
+
+def quarters_to_dicts(quarters):
+    return [q.as_dict() for q in quarters]
+
+
+def quarters_from_dicts(rows, tz):
+    return list(PriceSeries.from_quarters(rows, tz))
@@ -0,0 +1,90 @@
+from constants import PRICE_POLL_SECONDS, PRICE_POLL_MAX_SECONDS
+
+
+class PriceWatcher:
+    # Runs jobs as soon as tomorrow's prices are complete. A change of the
+    # site's Nordpool sensor fetches them right away, polling with
+    # exponential backoff only covers a sensor that stays quiet. A job
+    # still waiting at its deadline is dropped, or run with what there is
+    # when it asked for that. Sensor updates with nothing waiting ask the
+    # app for a replan.
+    def __init__(self, app, first_delay=PRICE_POLL_SECONDS, max_delay=PRICE_POLL_MAX_SECONDS):
+        self.app = app
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.waiting = []
+        self.delay = first_delay
+
+    def listen(self):
+        self.app.listen_state(self.on_price_sensor, self.app.site.price_sensor, attribute="all")
+
+    def wait(self, job, deadline, run_late=False):
+        self.waiting = [waiter for waiter in self.waiting if waiter[0] != job]
+        self.waiting.append((job, deadline.timestamp(), run_late))
+        self.delay = self.first_delay
+        self.check()
+
+    def cancel(self, job):
+        self.waiting = [waiter for waiter in self.waiting if waiter[0] != job]
+        if not self.waiting:
+            self.app.dispatcher.cancel_group("prices")
+
+    def on_price_sensor(self, entity, attribute, old, new, kwargs):
+        # Only a new update ends a cached miss, other attribute churn is
+        # left to the poll
+        if not sensor_updated(old, new):
+            return
+        # With nothing waiting the update is late or corrected prices for
+        # the plan already armed
+        if not self.waiting:
+            self.count("price_watch.replan")
+            self.app.request_replan("prices")
+            return
+        # Sensors that say whether tomorrow is there are taken at their word
+        attributes = new.get("attributes", {}) if isinstance(new, dict) else {}
+        if attributes.get("tomorrow_valid") is False:
+            return
+        self.count("price_watch.sensor")
+        self.app.expire_price_miss(self.app.price_dates()[1])
+        self.check()
+
+    def check(self, kwargs=None):
+        if not self.waiting:
+            return
+        prices = self.app.get_prices()
+        complete = prices.is_complete_day(0) and prices.is_complete_day(1)
+        now_ts = self.app.local_now().timestamp()
+        due = [waiter for waiter in self.waiting if complete or waiter[1] <= now_ts]
+        self.waiting = [waiter for waiter in self.waiting if waiter not in due]
+        self.schedule_poll(now_ts)
+
+        for job, deadline, run_late in due:
+            if complete or run_late:
+                self.app.run_price_job(job)
+            else:
+                self.app.log(f"Tomorrow's prices missing, {job.__name__} gave up")
+
+    def schedule_poll(self, now_ts):
+        self.app.dispatcher.cancel_group("prices")
+        if not self.waiting:
+            return
+        deadline = min(waiter[1] for waiter in self.waiting)
+        self.app.dispatcher.schedule("prices", self.poll, min(now_ts + self.delay, deadline))
+        self.delay = min(self.delay * 2, self.max_delay)
+
+    def poll(self, kwargs=None):
+        self.count("price_watch.poll")
+        self.check()
+
+    def count(self, name):
+        if self.app.metrics.enabled:
+            self.app.metrics.increment(name)
+
+
+def sensor_updated(old, new):
+    # The sensor's state is the time of its last update
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return True
+    old_valid = old.get("attributes", {}).get("tomorrow_valid")
+    new_valid = new.get("attributes", {}).get("tomorrow_valid")
+    return old.get("state") != new.get("state") or old_valid != new_valid
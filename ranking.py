@@ -0,0 +1,43 @@
+class DischargeRanking:
+    # Price order of a discharge plan, fixed when the plan is built. A
+    # Fenwick tree over that order counts how many still-running quarters
+    # are more expensive than a given one, and quarters drop out of it as
+    # their end passes.
+    def __init__(self, quarters):
+        count = len(quarters)
+        order = sorted(range(count), key=lambda i: quarters[i].price, reverse=True)
+        self.position = {quarters[i].start_ts: pos for pos, i in enumerate(order)}
+        self.tree = [0] + [i & -i for i in range(1, count + 1)]
+        self.expiry = sorted(
+            (quarters[i].end_ts, pos) for pos, i in enumerate(order)
+        )
+        self.expired = 0
+
+    def expire(self, now_ts):
+        expiry = self.expiry
+        while self.expired < len(expiry) and expiry[self.expired][0] <= now_ts:
+            self.remove(expiry[self.expired][1])
+            self.expired += 1
+
+    def remove(self, pos):
+        i = pos + 1
+        tree = self.tree
+        while i < len(tree):
+            tree[i] -= 1
+            i += i & -i
+
+    def rank(self, quarter, now_ts):
+        # Number of remaining quarters ranked above this one, None if the
+        # quarter is not part of the plan
+        self.expire(now_ts)
+        pos = self.position.get(quarter.start_ts)
+        if pos is None:
+            return None
+        total = 0
+        i = pos
+        tree = self.tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
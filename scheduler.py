@@ -1,212 +1,466 @@
 import appdaemon.plugins.hass.hassapi as hass
-from datetime import datetime, time, timedelta
-import json
+from datetime import date, datetime, time, timedelta
+import heapq
 import math
 import pytz
-from pathlib import Path
 from constants import (
     SEK_THRESHOLD,
     MIN_SOC,
     BATTERY_CAPACITY,
     AVG_ENERGY_HOURS,
-    MAX_CHARGE_POWER,
+    METRICS_ENABLED,
+    METRICS_PUBLISH_SECONDS,
+    REPLAN_DEBOUNCE_SECONDS,
+    REPLAN_SOC_DELTA,
+    REPLAN_LOAD_CHANGE,
+    OPTIMIZER_ENGINE,
+    ROBUST_SOLAR_ERRORS,
+    DISCHARGE_CONTROL,
+    SNAPSHOT_SAVE_SECONDS,
 )
 from battery_commands import (
+    EMS_MODE,
+    FORCED_CMD,
+    FORCED_POWER,
+    InverterCommander,
     set_start_charge,
     set_stop_charge,
     set_start_discharge,
     set_stop_discharge
 )
-from optimizer import select_night_plan
-from forecast import get_forecast
+from consumption import ConsumptionEstimator
+from load_follow import LoadFollower
+from load_profile import LoadProfile, local_midnight
+from optimizer import allocate_charge
+from price_cache import PriceCache
+from plan_cache import PlanCache
+from price_watch import PriceWatcher
+from price_series import PriceSeries, quarters_in_day, quarters_to_dicts, quarters_from_dicts
+from forecast import get_forecast, get_solar_forecast
+from dispatcher import Dispatcher
+from ranking import DischargeRanking
+from metrics import Metrics, timed, timer
+from plan_snapshot import load_snapshot, save_snapshot
+from archive import QuarterArchive, IDLE, CHARGE, DISCHARGE
+from sites import DEFAULT_SITE, STATE_DIR
 
-SCHEDULE_FILE = Path("/conf/apps/sungrow/schedules.json")
+# Shared by every site the app plans
+PRICE_CACHE_FILE = STATE_DIR / "prices.json"
+PLAN_CACHE_FILE = STATE_DIR / "plans.json"
+METRICS_FILE = STATE_DIR / "metrics.prom"
+METRICS_SENSOR = "sensor.sungrow_scheduler_metrics"
 
 class SungrowScheduler(hass.Hass):
 
+    commander_class = InverterCommander
+    site = DEFAULT_SITE
+    price_cache_file = PRICE_CACHE_FILE
+    plan_cache_file = PLAN_CACHE_FILE
+
     def initialize(self):
         self.log("Sungrow Scheduler started")
         self.tz = pytz.timezone("Europe/Stockholm")
-        self.handles = {
-            "charge": [],
-            "discharge": [],
-            "stop_discharge": []
-        }
-        if SCHEDULE_FILE.exists():
-            with SCHEDULE_FILE.open() as f:
-                schedules = json.load(f)
-        else:
-            schedules = {"charge": [], "discharge": []}
-        self.charge_windows = schedules["charge"]
-        self.discharge_schedule = schedules["discharge"]
-        self.price_fetch_retries = 0
+        self.metrics = Metrics(METRICS_ENABLED)
+        self.dispatcher = Dispatcher(self, self.tz, clock=self.local_now)
+        self.price_cache = PriceCache(self.price_cache_file)
+        self.price_cache.load()
+        self.plan_cache = PlanCache(self.plan_cache_file, metrics=self.metrics)
+        self.plan_cache.load()
+        self.start_sites()
+
+        # Schedule daily planning at 21:55. Tomorrow's prices are watched
+        # for from 12:45, about when Nordpool publishes them.
+        self.run_daily(self.plan_next_day, time(21, 55))
+        self.run_daily(self.watch_prices, time(12, 45))
+        if METRICS_ENABLED:
+            self.run_every(self.publish_metrics, self.local_now() + timedelta(minutes=1), METRICS_PUBLISH_SECONDS)
+
+    def terminate(self):
+        self.stop_sites()
+
+    def start_sites(self):
+        self.start_site()
+
+    def stop_sites(self):
+        self.stop_site()
+
+    def start_site(self):
+        # Loads the site's plan and state and starts following its entities
+        snapshot = load_snapshot(self.site.schedule_file) or {"charge": [], "discharge": []}
+        self.armed = {}
+        self.charge_windows = snapshot["charge"]
+        self.charge_quarters = quarters_from_dicts(snapshot.get("charge_quarters", []), self.tz)
+        self.set_discharge_schedule(
+            quarters_from_dicts(snapshot["discharge"], self.tz),
+            unranked=snapshot.get("unranked", False)
+        )
+        self.plan_energy = snapshot.get("avg_15min_energy")
+        self.after_solar_at = snapshot.get("after_solar")
+        self.resume_at = snapshot.get("resume")
+        self.plan_prices = None
+        self.replan_pending = False
+        self.replan_reasons = set()
+        self.checked_prices_end = None
+        night_planned = snapshot.get("night_planned")
+        self.night_planned_on = date.fromisoformat(night_planned) if night_planned else None
+        if "prices" in snapshot:
+            self.plan_prices = PriceSeries.from_columns(snapshot["prices"], self.tz)
+            self.restore_price_days(self.plan_prices)
+
+        # Seed the consumption window once, then follow the meter live. A
+        # fresh snapshot already holds the window, so the recorder is skipped
+        self.consumption = ConsumptionEstimator()
+        if not self.restore_consumption(snapshot):
+            self.seed_consumption()
+        self.load_profile = LoadProfile(self.tz, season_of, self.site.load_profile_file)
+        self.load_profile.load()
+        self.listen_state(self.on_consumption_change, self.site.consumption)
+
+        # Follow the SoC so quarter callbacks do not have to read it. Right
+        # after a Home Assistant restart the sensor is often unavailable,
+        # the last known SoC stands in until it reports.
+        try:
+            self.battery_soc = float(self.get_state(self.site.battery_level))
+        except (ValueError, TypeError):
+            soc = snapshot.get("soc")
+            self.battery_soc = float(soc if soc is not None else MIN_SOC)
+            self.log(f"{self.site.battery_level} unavailable, assuming {self.battery_soc}% SoC")
+        self.current_soc = snapshot.get("soc", self.battery_soc)
+        self.replan_soc = self.battery_soc
+        self.listen_state(self.on_battery_level_change, self.site.battery_level)
+
+        # Cache the last known inverter settings so commands only send
+        # changes. The snapshot picks them up at most every
+        # SNAPSHOT_SAVE_SECONDS, not on every write.
+        self.snapshot_pending = False
+        self.inverter = self.commander_class(
+            self,
+            on_commanded=self.request_snapshot,
+            entities=self.site.inverter_entities
+        )
+        self.inverter.resync()
+        self.log_inverter_changes(snapshot.get("inverter"))
+        self.inverter.listen()
+
+        # Discharge quarters can follow the live load in forced mode
+        # instead of handing the battery to self-consumption
+        self.load_follower = LoadFollower(self)
+        if DISCHARGE_CONTROL == "load_follow":
+            self.load_follower.listen()
+
+        # Every quarter is recorded with its plan and what actually happened
+        self.archive = None
+        self.meter_kwh = None
+        self.archive_meter_kwh = None
+        if self.site.archive_dir is not None:
+            self.archive = QuarterArchive(self.site.archive_dir, self.tz)
+            self.schedule_archive()
 
         # Restore existing plan on restart
         self.restore_and_schedule()
 
-        # Schedule daily planning at 21:55
-        self.run_daily(self.plan_next_day, time(21, 55))
-        self.run_daily(self.check_no_nightly_charge, time(14, 00))
+        # The check for tomorrow's prices goes on after a restart
+        self.price_watcher = PriceWatcher(self)
+        self.price_watcher.listen()
+        now = self.local_now()
+        if time(12, 45) <= now.time() < time(21, 55):
+            self.watch_prices()
+
+    def stop_site(self):
+        # Releases the files the site keeps open
+        if self.archive is not None:
+            self.archive.close()
 
+    @timed("plan_next_day")
     def plan_next_day(self, run_time=None):
-        skip = self.get_state("input_boolean.skip_next_battery_schedule") == "on"
-        self.turn_off("input_boolean.skip_next_battery_schedule")
+        skip = self.get_state(self.site.skip_schedule) == "on"
+        self.turn_off(self.site.skip_schedule)
         if skip:
             self.log("Skipping schedule")
             return
         
         self.log("Running daily schedule planner")
-        for key in ("charge", "discharge"):
-            for h in self.handles.get(key, []):
-                self.cancel_timer(h)
-            self.handles[key].clear()
-        
-        self.current_soc = float(self.get_state("sensor.battery_level"))
-        prices = self.get_prices()
-        
         if self.is_summer():
-            now = datetime.now(self.tz)
+            # Tonight's discharge plan stays armed. Tomorrow's is built by
+            # set_discharge_after_solar once production ends.
+            now = self.local_now()
             tomorrow = now + timedelta(days=1)
             default_end = tomorrow.replace(hour=18, minute=0, second=0, microsecond=0)
             latest_end = tomorrow.replace(hour=20, minute=0, second=0, microsecond=0)
-            forecast_start, forecast_end = get_forecast(self)
+            forecast_start, forecast_end = get_forecast(self, self.site.forecast)
             candidate_end = forecast_end or default_end
             end_time = min(candidate_end, latest_end)
-            #run discharge_after_solar at end_time
-
-            self.discharge_schedule = []
-            if forecast_end is not None:
-                discharge_start = forecast_end + timedelta(hours=-2)
-                discharge_end = forecast_end + timedelta(minutes=-1)
-                discharge_obj = {"start": discharge_start, "end": discharge_end}
-                self.discharge_schedule.append(discharge_obj)
-                self.handles["discharge"].append(self.run_at(self.start_discharge, discharge_start, discharge_quarter=discharge_obj, unranked=True))
-
-            schedules = {"charge": [], "discharge": self.discharge_schedule}
-            with SCHEDULE_FILE.open("w") as f:
-                json.dump(schedules, f)
-        else:
-            charge_quarters, discharge_quarters = select_night_plan(prices, self.get_avg_15min_energy(), self.current_soc)
-            if self.current_soc > 40 and not discharge_quarters:
-                self.log("No discharge from optimizer and above 40% SoC - using fallback price")
-                discharge_quarters = self.get_fallback_discharge_quarters(prices)
-            self.log(f"Number of nightly charge quarters {len(charge_quarters)}")
-            self.log(f"Number of discharge quarters: {len(discharge_quarters)}")
-            self.discharge_schedule = discharge_quarters
-            self.set_night_charging(charge_quarters, len(discharge_quarters))
-            
-            for q in discharge_quarters:
-                self.handles["discharge"].append(
-                    self.run_at(
-                        self.start_discharge,
-                        datetime.fromisoformat(q["start"]),
-                        discharge_quarter=q,
-                        unranked=False
-                    )
-                )
-            
-            schedules = {"charge": self.charge_windows, "discharge": self.discharge_schedule}
-            with SCHEDULE_FILE.open("w") as f:
-                json.dump(schedules, f)
-                
+            self.dispatcher.cancel_group("solar")
+            self.dispatcher.schedule("solar", self.set_discharge_after_solar, end_time)
+            self.after_solar_at = end_time.isoformat()
+            self.save_snapshot()
+            return
+
+        # Planned as soon as tomorrow's prices are in, with what there is
+        # if they are still missing late in the evening. The midday check
+        # is over from here on, even if its prices never came.
+        now = self.local_now()
+        self.night_planned_on = now.date()
+        self.price_watcher.cancel(self.check_no_nightly_charge)
+        self.price_watcher.wait(self.plan_night, now.replace(hour=23, minute=45, second=0, microsecond=0), run_late=True)
+
+    def plan_night(self, run_time=None):
+        self.dispatcher.cancel_group("solar")
+        self.charge_windows = []
+        self.after_solar_at = None
+        
+        self.current_soc = self.replan_soc = float(self.get_state(self.site.battery_level))
+        self.plan_energy = self.get_avg_15min_energy()
+        prices = self.plan_prices = self.get_prices()
+        self.checked_prices_end = prices.ends[-1] if len(prices) else None
+        
+        demand = self.get_demand(prices)
+        with timer(self, "optimizer"):
+            charge_quarters, discharge_quarters = self.plan_cache.select_night_plan(
+                prices,
+                self.plan_energy,
+                self.current_soc,
+                engine=OPTIMIZER_ENGINE,
+                demand=demand,
+                scenarios=self.get_scenarios(prices)
+            )
+        if self.current_soc > 40 and not discharge_quarters:
+            self.log("No discharge from optimizer and above 40% SoC - using fallback price")
+            discharge_quarters = self.get_fallback_discharge_quarters(prices)
+        self.log(f"Number of nightly charge quarters {len(charge_quarters)}")
+        self.log(f"Number of discharge quarters: {len(discharge_quarters)}")
+        self.set_discharge_schedule(discharge_quarters)
+        self.set_night_charging(
+            charge_quarters,
+            len(discharge_quarters),
+            self.get_expected_energy(prices, demand, discharge_quarters)
+        )
+        self.arm_plan()
+        self.save_snapshot()
+
+    def watch_prices(self, run_time=None):
+        if self.is_summer():
+            return
+        now = self.local_now()
+        self.price_watcher.wait(self.check_no_nightly_charge, now.replace(hour=21, minute=55, second=0, microsecond=0))
+
+    def run_price_job(self, job):
+        job()
+
+    def expire_price_miss(self, dt):
+        request = self.price_request(dt)
+        self.price_cache.expire(request["areas"], request["currency"], dt)
+
     def check_no_nightly_charge(self, run_time=None):
         if self.is_summer():
             return
+        # It may still be queued when prices come late. Once tonight's plan
+        # is on its way it would only clear its charging and leave the skip
+        # flag on for tomorrow.
+        if self.night_planned_on == self.local_now().date():
+            return
         
         prices = self.get_prices()
-        if len(prices) != 192:
-            if self.price_fetch_retries >= 8:
-                return
-            self.price_fetch_retries += 1
-            self.run_in(self.check_no_nightly_charge, 15 * 60)
+        if not (prices.is_complete_day(0) and prices.is_complete_day(1)):
+            self.log("Tomorrow's prices not available yet")
             return
-        self.price_fetch_retries = 0
+        self.checked_prices_end = prices.ends[-1]
 
-        charge_quarters, discharge_quarters = select_night_plan(prices, self.get_avg_15min_energy(), MIN_SOC)
+        avg_15min_energy = self.get_avg_15min_energy()
+        with timer(self, "optimizer"):
+            charge_quarters, discharge_quarters = self.plan_cache.select_night_plan(
+                prices,
+                avg_15min_energy,
+                MIN_SOC,
+                engine=OPTIMIZER_ENGINE,
+                demand=self.get_demand(prices),
+                scenarios=self.get_scenarios(prices)
+            )
         if not charge_quarters:
             return
         
-        for discharge in self.handles["discharge"]:
-            self.cancel_timer(discharge)
-        self.handles["discharge"].clear()
+        self.charge_windows = []
+        self.charge_quarters = []
+        self.plan_prices = prices
+        self.plan_energy = avg_15min_energy
         
-        ref_price = float(self.get_state("input_number.latest_night_charge_high_price"))
-        self.discharge_schedule = [
-            q for q in prices[15 * 4 : 46 * 4]
-            if q["price"] >= ref_price + SEK_THRESHOLD
-        ]
-        
-        for q in self.discharge_schedule:
-            self.handles["discharge"].append(
-                self.run_at(
-                    self.start_discharge,
-                    datetime.fromisoformat(q["start"]),
-                    discharge_quarter=q,
-                    unranked=False
-                )
-            )
-        
-        schedules = {"charge": [], "discharge": self.discharge_schedule}
-        with SCHEDULE_FILE.open("w") as f:
-            json.dump(schedules, f)
+        ref_price = float(self.get_state(self.site.night_charge_high_price))
+        self.set_discharge_schedule([
+            q for q in prices.between(prices.local_time(0, time(15)), prices.local_time(1, time(22)))
+            if q.price >= ref_price + SEK_THRESHOLD
+        ])
+        self.arm_plan()
+        self.save_snapshot()
             
-        self.turn_on("input_boolean.skip_next_battery_schedule")
+        self.turn_on(self.site.skip_schedule)
 
-    def get_prices(self):
-        all_prices = []
-    
-        today = self.datetime().date()
-        tomorrow = today + timedelta(days=1)
-    
-        for dt in [today, tomorrow]:
-            result = self.call_service(
-                "nordpool/get_prices_for_date",
-                config_entry="01KBGCDMY25VMPA5FNMZCFKN4H",
-                date=dt.isoformat(),
-                areas="SE3",
-                currency="SEK"
-            )
+    def set_discharge_schedule(self, quarters, unranked=False):
+        self.discharge_schedule = quarters
+        self.discharge_unranked = unranked
+        self.discharge_ranking = DischargeRanking(quarters)
 
-            day_prices = (
-                result
-                .get("result", {})
-                .get("response", {})
-                .get("SE3")
-            )
+    def request_snapshot(self):
+        if self.snapshot_pending or self.site.schedule_file is None:
+            return
+        self.snapshot_pending = True
+        self.dispatcher.schedule(
+            "snapshot",
+            self.write_requested_snapshot,
+            self.local_now().timestamp() + SNAPSHOT_SAVE_SECONDS
+        )
 
-            if day_prices is None:
-                self.log("SE3 prices not available yet")
-                continue
+    def write_requested_snapshot(self, kwargs=None):
+        self.snapshot_pending = False
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        # Everything a restart needs to pick the plan up again without
+        # asking Home Assistant or the recorder first. A snapshot still
+        # waiting for SNAPSHOT_SAVE_SECONDS is covered by this one.
+        if self.snapshot_pending:
+            self.snapshot_pending = False
+            self.dispatcher.cancel_group("snapshot")
+        if self.site.schedule_file is None:
+            return
+        times, values = self.consumption.samples()
+        snapshot = {
+            "created": self.local_now().timestamp(),
+            "charge": self.charge_windows,
+            "charge_quarters": quarters_to_dicts(self.charge_quarters),
+            "discharge": quarters_to_dicts(self.discharge_schedule),
+            "unranked": self.discharge_unranked,
+            "soc": self.current_soc,
+            "avg_15min_energy": self.plan_energy,
+            "after_solar": self.after_solar_at,
+            "resume": self.resume_at,
+            "night_planned": self.night_planned_on.isoformat() if self.night_planned_on else None,
+            "consumption": {"times": times, "values": values},
+            "inverter": dict(self.inverter.known),
+        }
+        if self.plan_prices is not None:
+            snapshot["prices"] = self.plan_prices.to_columns()
+        try:
+            save_snapshot(self.site.schedule_file, snapshot)
+        except OSError as e:
+            self.error(f"Could not write {self.site.schedule_file}: {e}")
 
-            if len(day_prices) != 96:
-                self.error(f"Invalid price data for {dt}: {day_prices}")
+    def restore_price_days(self, prices):
+        # Put the plan's price days back if the price cache lost them
+        for day in range(2):
+            if not prices.is_complete_day(day):
                 continue
+            dt = prices.first_day + timedelta(days=day)
+            request = self.price_request(dt)
+            if self.price_cache.get(request["areas"], request["currency"], dt) is None:
+                self.store_price_day(dt, prices.day(day).to_dicts())
+
+    def restore_consumption(self, snapshot):
+        consumption = snapshot.get("consumption")
+        age = self.local_now().timestamp() - snapshot.get("created", 0)
+        if not consumption or age > AVG_ENERGY_HOURS * 3600:
+            return False
+        self.consumption.restore(consumption["times"], consumption["values"])
+        return True
+
+    def log_inverter_changes(self, previous):
+        if not previous:
+            return
+        for entity_id, value in self.inverter.known.items():
+            if previous.get(entity_id) != value:
+                self.log(f"{entity_id} changed while stopped: {previous.get(entity_id)} -> {value}")
+
+    @timed("price_fetch")
+    def get_prices(self):
+        all_prices = []
+        dates = self.price_dates()
     
-            all_prices.extend(day_prices)
+        for dt in dates:
+            all_prices.extend(self.get_price_day(dt))
     
         self.log(f"Retrieved {len(all_prices)} hourly prices")
-        return all_prices
+        return PriceSeries.from_quarters(all_prices, self.tz, first_day=dates[0])
+
+    def get_price_day(self, dt):
+        request = self.price_request(dt)
+        cached = self.price_cache.get(request["areas"], request["currency"], dt, now=self.local_now().timestamp())
+        if cached is not None:
+            return cached
+
+        result = self.call_service("nordpool/get_prices_for_date", **request)
+        return self.store_price_day(dt, self.extract_day_prices(result, dt))
+
+    def refresh_prices(self):
+        # Cached days are never fetched again, so corrected prices are
+        # fetched over them. A day that does not come back complete keeps
+        # what the cache has.
+        for dt in self.price_dates():
+            result = self.call_service("nordpool/get_prices_for_date", **self.price_request(dt))
+            self.store_price_day(dt, self.extract_day_prices(result, dt))
+
+    def store_price_day(self, dt, day_prices):
+        request = self.price_request(dt)
+        return self.price_cache.put(
+            request["areas"],
+            request["currency"],
+            dt,
+            day_prices,
+            now=self.local_now().timestamp(),
+            expected=quarters_in_day(self.tz, dt)
+        )
+
+    def price_dates(self):
+        today = self.local_now().date()
+        return [today, today + timedelta(days=1)]
+
+    def price_request(self, dt):
+        return {
+            "config_entry": self.site.config_entry,
+            "date": dt.isoformat(),
+            "areas": self.site.area,
+            "currency": self.site.currency,
+        }
+
+    def extract_day_prices(self, result, dt):
+        day_prices = (
+            (result or {})
+            .get("result", {})
+            .get("response", {})
+            .get(self.site.area)
+        )
+
+        if day_prices is None:
+            self.log(f"{self.site.area} prices not available yet")
+            return []
+
+        if len(day_prices) != quarters_in_day(self.tz, dt):
+            self.error(f"Invalid price data for {dt}: {day_prices}")
+            return []
+
+        return day_prices
         
     def get_fallback_discharge_quarters(self, prices):
-        ref_price = float(self.get_state("input_number.latest_night_charge_high_price"))
+        ref_price = float(self.get_state(self.site.night_charge_high_price))
     
-        day = prices[30 * 4 : 46 * 4]
+        day = prices.between(time(6), time(22), day=1)
     
         return [
             q for q in day
-            if q["price"] >= ref_price + SEK_THRESHOLD
+            if q.price >= ref_price + SEK_THRESHOLD
         ]
         
-    def set_night_charging(self, charge_quarters, discharge_quarters):
-        if charge_quarters == 0:
+    def set_night_charging(self, charge_quarters, discharge_quarters, discharge_energy=None):
+        # The optimizer's charge quarters are kept so replans can move the
+        # energy between them
+        self.charge_quarters = charge_quarters
+        if not charge_quarters:
             return
-        latest_balance_upper_str = self.get_state("input_text.latest_battery_balance_upper")
+        latest_balance_upper_str = self.get_state(self.site.balance_upper)
         latest_balance_upper = datetime.fromisoformat(latest_balance_upper_str)
-        now = datetime.now(self.tz)
+        now = self.local_now()
         diff_days = (now - latest_balance_upper).days
         should_balance_battery_upper = diff_days >= 7
         
-        target_soc = self.get_target_soc(charge_quarters, discharge_quarters, should_balance_battery_upper)
+        target_soc = self.get_target_soc(charge_quarters, discharge_quarters, should_balance_battery_upper, discharge_energy)
         self.log(f"Target SoC {target_soc}")
         self.log(f"Current SoC {self.current_soc}")
         charge_amount = ((target_soc - self.current_soc)/100) * BATTERY_CAPACITY
@@ -215,63 +469,57 @@ class SungrowScheduler(hass.Hass):
             # no need to charge
             return
         
-        charging_power = math.ceil(((charge_amount / (len(charge_quarters) / 4)) * 1.1) / 100) * 100
-        while len(charge_quarters) > 1:
-            if charging_power < 800:
-                # Remove the highest price quarter
-                charge_quarters = sorted(charge_quarters, key=lambda x: x["price"], reverse=True)[1:]
-                # Sort remaining quarters by time ascending
-                charge_quarters = sorted(charge_quarters, key=lambda x: x["start"])
-                
-                # Recalculate charging power with 1.15 factor
-                charging_power = math.ceil(((charge_amount / (len(charge_quarters) / 4)) * 1.15) / 100) * 100
-            else:
-                break
-        charging_power = min(charging_power, MAX_CHARGE_POWER)
+        allocation = allocate_charge(charge_quarters, charge_amount)
         
         if target_soc == 100:
             self.set_state(
-                "input_text.latest_battery_balance_upper",
+                self.site.balance_upper,
                 state=now.isoformat()
             )
         
-        high_price = max(charge_quarters, key=lambda x: x["price"])["price"]
-        self.set_state("input_number.latest_night_charge_high_price", state=high_price)
-        
+        high_price = max(q.price for q, _ in allocation)
+        self.set_state(self.site.night_charge_high_price, state=high_price)
+        self.charge_windows = self.charge_windows_for(allocation, target_soc)
+
+    def charge_windows_for(self, allocation, target_soc):
+        if not allocation:
+            return []
+        # Back-to-back quarters with the same power share a window
         windows = []
-        start = datetime.fromisoformat(charge_quarters[0]["start"])
-        end = start + timedelta(minutes=15)
+        first, power = allocation[0]
+        start = first.start_ts
+        end = first.end_ts
         
-        for q in charge_quarters[1:]:
-            if datetime.fromisoformat(q["start"]) == end:
-                end += timedelta(minutes=15)
+        for q, q_power in allocation[1:]:
+            if q.start_ts == end and q_power == power:
+                end = q.end_ts
             else:
-                windows.append((start, end))
-                start = datetime.fromisoformat(q["start"])
-                end = start + timedelta(minutes=15)
+                windows.append((start, end, power))
+                start = q.start_ts
+                end = q.end_ts
+                power = q_power
         
-        windows.append((start, end))
+        windows.append((start, end, power))
         
-        self.charge_windows  = [
+        return [
             {
-                "start": start.isoformat(),
-                "end": end.isoformat(),
+                "start": datetime.fromtimestamp(start, self.tz).isoformat(),
+                "end": datetime.fromtimestamp(end, self.tz).isoformat(),
                 "target_soc": target_soc,
-                "power": charging_power
+                "power": power
             }
-            for start, end in windows
+            for start, end, power in windows
         ]
         
-        for charge_window in self.charge_windows:
-            self.handles["charge"].append(self.run_at(self.start_charge, datetime.fromisoformat(charge_window["start"]), charge_window=charge_window))
-            self.handles["charge"].append(self.run_at(self.stop_charge, datetime.fromisoformat(charge_window["end"]), charge_window=charge_window))
-        
-    def get_target_soc(self, charge_quarters, discharge_quarters, should_balance_battery_upper):
+    def get_target_soc(self, charge_quarters, discharge_quarters, should_balance_battery_upper, discharge_energy=None):
         target_soc = 0
         if discharge_quarters > 0:
-            avg_15min_energy = self.get_avg_15min_energy()
-            self.log(f"Avg 15min energy: {avg_15min_energy}")
-            total_energy = avg_15min_energy * discharge_quarters
+            if discharge_energy is None:
+                avg_15min_energy = self.get_avg_15min_energy()
+                self.log(f"Avg 15min energy: {avg_15min_energy}")
+                total_energy = avg_15min_energy * discharge_quarters
+            else:
+                total_energy = discharge_energy
             self.log(f"Total energy: {total_energy}")
             target_soc = min(math.ceil(((BATTERY_CAPACITY * (MIN_SOC / 100) + total_energy)/BATTERY_CAPACITY) * 100), 100)
             self.log(f"Target soc: {target_soc}")
@@ -279,7 +527,7 @@ class SungrowScheduler(hass.Hass):
             if target_soc >= 100:
                 target_soc = 100 if should_balance_battery_upper else 99
                 
-        charge_quarters_mean = sum(q["price"] for q in charge_quarters) / len(charge_quarters)
+        charge_quarters_mean = sum(q.price for q in charge_quarters) / len(charge_quarters)
         target_soc = max((80 if charge_quarters_mean < 100 else 30), target_soc)
         
         if not self.is_winter():
@@ -289,74 +537,286 @@ class SungrowScheduler(hass.Hass):
         return target_soc
     
     def get_avg_15min_energy(self):
-        now = datetime.now(self.tz)
-        start_time = now - timedelta(hours=AVG_ENERGY_HOURS)
-    
+        return self.consumption.avg_15min_energy(self.local_now().timestamp())
+
+    def get_demand(self, prices):
+        # Per-quarter load from the profile, None until it has enough days.
+        # Forecast solar production is netted off as negative demand.
+        today = self.local_now().date()
+        demand = self.load_profile.demand(today, 2)
+        if demand is None or len(demand) != len(prices):
+            return None
+        production = get_solar_forecast(self, self.site.forecast).production(prices)
+        return [load - solar for load, solar in zip(demand, production)]
+
+    def get_scenarios(self, prices):
+        # Net load scenarios for the robust engine: every stored day of the
+        # load profile with the solar forecast scaled by each of
+        # ROBUST_SOLAR_ERRORS. None for the other engines and until the
+        # profile has enough days.
+        if OPTIMIZER_ENGINE != "robust":
+            return None
+        today = self.local_now().date()
+        days = [self.load_profile.samples(today + timedelta(days=i)) for i in range(2)]
+        if days[0] is None or days[1] is None:
+            return None
+        production = get_solar_forecast(self, self.site.forecast).production(prices)
+        scenarios = []
+        for i in range(max(len(days[0]), len(days[1]))):
+            load = list(days[0][i % len(days[0])]) + list(days[1][i % len(days[1])])
+            if len(load) != len(prices):
+                return None
+            for factor in ROBUST_SOLAR_ERRORS:
+                scenarios.append([wh - solar * factor for wh, solar in zip(load, production)])
+        return scenarios
+
+    def get_expected_energy(self, prices, demand, quarters):
+        if demand is None:
+            return None
+        indexes = (prices.index_of(q.start_ts) for q in quarters)
+        return sum(max(demand[i], 0) for i in indexes if i is not None)
+
+    def on_battery_level_change(self, entity, attribute, old, new, kwargs):
+        try:
+            self.battery_soc = float(new)
+        except (ValueError, TypeError):
+            return
+        # The SoC is meant to move inside planned charge and discharge
+        # quarters, so only a move outside them counts, from where the last
+        # of them left it
+        if self.plan_active(self.local_now().timestamp()):
+            self.replan_soc = self.battery_soc
+            return
+        if abs(self.battery_soc - self.replan_soc) >= REPLAN_SOC_DELTA:
+            self.request_replan("soc")
+
+    def plan_active(self, now_ts):
+        for w in self.charge_windows:
+            if datetime.fromisoformat(w["start"]).timestamp() <= now_ts < datetime.fromisoformat(w["end"]).timestamp():
+                return True
+        return any(q.start_ts <= now_ts < q.end_ts for q in self.discharge_schedule)
+
+    @timed("history_query")
+    def seed_consumption(self):
+        now = self.local_now()
         history = self.get_history(
-            "sensor.total_consumed_energy",
-            start_time=start_time,
+            self.site.consumption,
+            start_time=now - timedelta(hours=AVG_ENERGY_HOURS),
             end_time=now
         )
-    
-        if not history or not history[0]:
-            return 0.0
-    
-        samples = []
-        for s in history[0]:
-            try:
-                energy_kwh = float(s["state"])
-            except (ValueError, TypeError):
-                continue
-    
-            ts = s["last_changed"]
-            samples.append((ts, energy_kwh))
-    
-        if len(samples) < 2:
-            return 0.0
-    
-        start_ts, start_kwh = samples[0]
-        end_ts, end_kwh = samples[-1]
-    
-        total_energy_wh = (end_kwh - start_kwh) * 1000
-        total_time_hours = (end_ts - start_ts).total_seconds() / 3600
-    
-        if total_time_hours <= 0:
-            return 0.0
-    
-        # Average Wh per 15 minutes
-        return total_energy_wh * (0.25 / total_time_hours)    
+        self.consumption.seed(history)
+
+    def on_consumption_change(self, entity, attribute, old, new, kwargs):
+        ts = self.local_now().timestamp()
+        self.consumption.add(ts, new)
+        self.load_profile.record(ts, new)
+        try:
+            self.meter_kwh = float(new)
+        except (ValueError, TypeError):
+            pass
+        if self.plan_energy:
+            change = abs(self.consumption.avg_15min_energy(ts) - self.plan_energy) / self.plan_energy
+            if change >= REPLAN_LOAD_CHANGE:
+                self.request_replan("load")
+
+    def request_replan(self, reason):
+        # Changes arriving within REPLAN_DEBOUNCE_SECONDS share one replan
+        self.replan_reasons.add(reason)
+        if self.replan_pending:
+            return
+        self.replan_pending = True
+        self.dispatcher.schedule(
+            "replan",
+            self.replan,
+            self.local_now().timestamp() + REPLAN_DEBOUNCE_SECONDS
+        )
+
+    @timed("replan")
+    def replan(self, kwargs=None):
+        # Re-optimises what is left of the current plan from where it
+        # stands now, new prices included. Only timers whose decision
+        # changed are re-armed.
+        self.replan_pending = False
+        reasons = self.replan_reasons
+        self.replan_reasons = set()
+        reason_text = ", ".join(sorted(reasons))
+        now = self.local_now()
+        now_ts = now.timestamp()
+        self.replan_soc = self.battery_soc
+        self.plan_energy = self.get_avg_15min_energy()
+
+        # Tomorrow's prices showing up is what the 14:00 check waits for
+        if "prices" in reasons:
+            self.refresh_prices()
+        prices = self.get_prices()
+        if (
+            not self.is_summer()
+            and self.night_planned_on != now.date()
+            and prices.is_complete_day(1)
+            and self.checked_prices_end is not None
+            and prices.ends[-1] > self.checked_prices_end
+        ):
+            self.log(f"Replan ({reason_text}): new prices")
+            self.run_price_job(self.check_no_nightly_charge)
+            return
+
+        # Late or corrected prices plan tonight again from scratch while
+        # none of it has started. Once it runs, and after midnight, its
+        # quarters stand and only the summer discharge below follows them.
+        if "prices" in reasons and self.prices_changed(prices, now_ts):
+            if (
+                not self.is_summer()
+                and self.night_planned_on == now.date()
+                and not self.plan_started(now_ts)
+            ):
+                self.log(f"Replan ({reason_text}): new prices, planning the night again")
+                self.run_price_job(self.plan_night)
+                return
+            self.plan_prices = prices
+
+        previous = (self.charge_windows, self.discharge_schedule)
+        if self.charge_windows:
+            self.replan_charging(now_ts, "load" in reasons)
+        resume = datetime.fromisoformat(self.resume_at) if self.resume_at else None
+        if resume is not None and resume > now:
+            discharge_quarters = self.select_after_solar(self.plan_prices, now, resume, self.battery_soc)
+            remaining = [q.start_ts for q in self.discharge_schedule if q.end_ts > now_ts]
+            if [q.start_ts for q in discharge_quarters] != remaining:
+                self.set_discharge_schedule(discharge_quarters)
+                if not any(q.start_ts <= now_ts < q.end_ts for q in discharge_quarters):
+                    self.halt_discharge()
+                for q in discharge_quarters:
+                    if q.start_ts <= now_ts < q.end_ts:
+                        self.start_discharge({"discharge_quarter": q, "unranked": False})
+
+        cancelled, scheduled = self.arm_plan()
+        if (self.charge_windows, self.discharge_schedule) != previous:
+            self.save_snapshot()
+        self.log(
+            f"Replan ({reason_text}): SoC {self.battery_soc}% | "
+            f"{cancelled} timers cancelled, {scheduled} armed"
+        )
+
+    def prices_changed(self, prices, now_ts):
+        # Prices reaching further than the plan's, or a new price for one
+        # of its quarters still ahead
+        planned = self.plan_prices
+        if planned is None or not len(prices):
+            return False
+        if not len(planned) or prices.ends[-1] > planned.ends[-1]:
+            return True
+        for start, end, price in zip(planned.starts, planned.ends, planned.prices):
+            if end > now_ts:
+                index = prices.index_of(start)
+                if index is not None and prices.prices[index] != price:
+                    return True
+        return False
+
+    def plan_started(self, now_ts):
+        return (
+            any(datetime.fromisoformat(w["start"]).timestamp() <= now_ts for w in self.charge_windows)
+            or any(q.start_ts <= now_ts for q in self.discharge_schedule)
+        )
+
+    def replan_charging(self, now_ts, retarget):
+        # The running window is cut at the end of its quarter and the energy
+        # still missing for the target is spread over the charge quarters
+        # after it. The target is only re-estimated when the load changed.
+        current_end = now_ts - now_ts % 900 + 900
+        kept = []
+        for w in self.charge_windows:
+            start = datetime.fromisoformat(w["start"]).timestamp()
+            end = datetime.fromisoformat(w["end"]).timestamp()
+            if start <= now_ts < end:
+                kept.append(dict(w, end=datetime.fromtimestamp(min(end, current_end), self.tz).isoformat()))
+
+        remaining = [q for q in self.charge_quarters if q.start_ts >= current_end]
+        if not remaining:
+            self.charge_windows = kept
+            return
+        target_soc = self.charge_windows[0]["target_soc"]
+        if retarget:
+            discharge_quarters = sum(1 for q in self.discharge_schedule if q.start_ts >= current_end)
+            target_soc = self.get_target_soc(remaining, discharge_quarters, target_soc == 100)
+        charge_amount = ((target_soc - self.battery_soc) / 100) * BATTERY_CAPACITY
+        allocation = allocate_charge(remaining, charge_amount)
+        self.charge_windows = kept + self.charge_windows_for(allocation, target_soc)
+
+    def arm_plan(self):
+        # Timers for the plan in charge_windows and discharge_schedule. Keys
+        # describe the decision, so timers whose decision is unchanged stay.
+        now_ts = self.local_now().timestamp()
+        charge = {}
+        for w in self.charge_windows:
+            start = datetime.fromisoformat(w["start"]).timestamp()
+            end = datetime.fromisoformat(w["end"]).timestamp()
+            decision = (w["start"], w["end"], w["target_soc"], w["power"])
+            if start > now_ts:
+                charge[("start",) + decision] = (self.start_charge, start, {"charge_window": w})
+            if end > now_ts:
+                charge[("stop",) + decision] = (self.stop_charge, end, {"charge_window": w})
+        unranked = self.discharge_unranked
+        discharge = {
+            (q.start_ts, unranked): (self.start_discharge, q.start_ts, {"discharge_quarter": q, "unranked": unranked})
+            for q in self.discharge_schedule
+            if q.start_ts > now_ts
+        }
+        charge_counts = self.rearm("charge", charge, now_ts)
+        discharge_counts = self.rearm("discharge", discharge, now_ts)
+        return charge_counts[0] + discharge_counts[0], charge_counts[1] + discharge_counts[1]
+
+    def rearm(self, group, events, now_ts):
+        # events maps key -> (callback, ts, kwargs). Returns how many timers
+        # were cancelled and scheduled.
+        armed = self.armed.setdefault(group, {})
+        for key in [key for key, (_, ts) in armed.items() if ts <= now_ts]:
+            del armed[key]
+        cancelled = 0
+        for key in [key for key in armed if key not in events]:
+            self.dispatcher.cancel(armed.pop(key)[0])
+            cancelled += 1
+        scheduled = 0
+        for key, (callback, ts, kwargs) in events.items():
+            if key not in armed:
+                armed[key] = (self.dispatcher.schedule(group, callback, ts, **kwargs), ts)
+                scheduled += 1
+        return cancelled, scheduled
 
     def restore_and_schedule(self):
-        now = datetime.now(self.tz)
+        now = self.local_now()
 
+        # Windows and quarters already running are started now, arm_plan
+        # takes care of everything still ahead
         for charge_window in self.charge_windows:
             start = datetime.fromisoformat(charge_window["start"])
             end = datetime.fromisoformat(charge_window["end"])
-            if end <= now:
-                continue
-            
-            if start > now:
-                self.handles["charge"].append(self.run_at(self.start_charge, start, charge_window=charge_window))
-                self.handles["charge"].append(self.run_at(self.stop_charge, end, charge_window=charge_window))
-            else:
+            if start <= now < end:
                 self.start_charge({"charge_window": charge_window})
-                self.handles["charge"].append(self.run_at(self.stop_charge, end, charge_window=charge_window))
         
+        now_ts = now.timestamp()
         for discharge_quarter in self.discharge_schedule:
-            start = datetime.fromisoformat(discharge_quarter["start"])
-            end = datetime.fromisoformat(discharge_quarter["end"])
-            if end <= now:
-                continue
-            
-            if start > now:
-                self.handles["discharge"].append(self.run_at(self.start_discharge, start, discharge_quarter=discharge_quarter, unranked=False))
+            if discharge_quarter.start_ts <= now_ts < discharge_quarter.end_ts:
+                self.start_discharge({"discharge_quarter": discharge_quarter, "unranked": self.discharge_unranked})
+        self.arm_plan()
+
+        # Summer callbacks missed while the app was down run right away
+        if self.resume_at is not None:
+            resume = datetime.fromisoformat(self.resume_at)
+            if resume > now:
+                self.dispatcher.schedule("resume", self.resume_self_consumption, resume)
+            else:
+                self.resume_self_consumption({})
+        if self.after_solar_at is not None:
+            after_solar = datetime.fromisoformat(self.after_solar_at)
+            if after_solar > now:
+                self.dispatcher.schedule("solar", self.set_discharge_after_solar, after_solar)
             else:
-                self.start_discharge({"discharge_quarter": discharge_quarter, "unranked": False})
+                self.set_discharge_after_solar({})
 
     def start_charge(self, kwargs):
         charge_window = kwargs["charge_window"]
     
-        now = datetime.now(self.tz)
+        now = self.local_now()
         if now < datetime.fromisoformat(charge_window["start"]) or now >= datetime.fromisoformat(charge_window["end"]):
             return
     
@@ -367,72 +827,66 @@ class SungrowScheduler(hass.Hass):
             f"Power: {charge_window['power']}W"
         )
         
+        self.load_follower.stop()
         set_start_charge(self, charge_window["target_soc"], charge_window["power"])
-        
-        handle = kwargs.get("__handle")
-        if handle and handle in self.handles["charge"]:
-            self.handles["charge"].remove(handle)
 
     def stop_charge(self, kwargs):
         charge_window = kwargs["charge_window"]
         
-        now = datetime.now(self.tz)
+        now = self.local_now()
         if now < datetime.fromisoformat(charge_window["end"]):
             return
+        # The next window only changes the power, keep charging
+        if any(w["start"] == charge_window["end"] for w in self.charge_windows):
+            return
     
         self.log("STOP CHARGE")
         
-        current_soc = float(self.get_state("sensor.battery_level"))
+        current_soc = float(self.get_state(self.site.battery_level))
         set_stop_charge(self)
-        self.set_state("input_number.latest_charge_soc", state=charge_window['target_soc'] * current_soc)
-        
-        handle = kwargs.get("__handle")
-        if handle and handle in self.handles["charge"]:
-            self.handles["charge"].remove(handle)
+        self.set_state(self.site.latest_charge_soc, state=charge_window['target_soc'] * current_soc)
 
     def start_discharge(self, kwargs):
         discharge_quarter = kwargs["discharge_quarter"]
-        unranked = kwargs["unkranked"]
+        unranked = kwargs["unranked"]
         
-        now = datetime.now(self.tz)
-        if now < datetime.fromisoformat(discharge_quarter["start"]) or now >= datetime.fromisoformat(discharge_quarter["end"]):
+        now = self.local_now().timestamp()
+        if now < discharge_quarter.start_ts or now >= discharge_quarter.end_ts:
             return
         
         if unranked:
-            set_start_discharge(self)
-            self.handles["stop_discharge"].append(self.run_at(self.stop_discharge, datetime.fromisoformat(discharge_quarter["end"])))
+            self.begin_discharge(discharge_quarter)
+            self.dispatcher.schedule("stop_discharge", self.stop_discharge, discharge_quarter.end_ts)
         else:
-            remaining = [q for q in self.discharge_schedule if datetime.fromisoformat(q["end"]) > now]
-            remaining_sorted = sorted(remaining, key=lambda q: q["price"], reverse=True)
-            rank = remaining_sorted.index(discharge_quarter)
+            rank = self.discharge_ranking.rank(discharge_quarter, now)
+            if rank is None:
+                return
             
             self.log(
                 f"START DISCHARGE "
-                f"{discharge_quarter['start']} - {discharge_quarter['end']} | "
+                f"{discharge_quarter.start.isoformat()} - {discharge_quarter.end.isoformat()} | "
                 f"Rank: {rank}"
             )
             
             avg_15min_energy = self.get_avg_15min_energy()
-            current_soc = float(self.get_state("sensor.battery_level"))
-            discharge_capacity = ((current_soc - MIN_SOC) / 100) * 24320
+            discharge_capacity = ((self.battery_soc - MIN_SOC) / 100) * BATTERY_CAPACITY
             weighted_discharge_capacity = discharge_capacity * 1.15
-            quarters = round(weighted_discharge_capacity / avg_15min_energy)
+            quarters = (
+                round(weighted_discharge_capacity / avg_15min_energy)
+                if avg_15min_energy > 0 else rank
+            )
             self.log(f"Rank: {rank} Quarters: {quarters}")
             if rank > quarters:
-                set_stop_discharge(self)
+                self.halt_discharge()
             else:
-                set_start_discharge(self)
-                self.handles["stop_discharge"].append(self.run_at(self.stop_discharge, datetime.fromisoformat(discharge_quarter["end"])))
-        
-        handle = kwargs.get("__handle")
-        if handle and handle in self.handles["discharge"]:
-            self.handles["discharge"].remove(handle)
+                self.begin_discharge(discharge_quarter)
+                self.dispatcher.schedule("stop_discharge", self.stop_discharge, discharge_quarter.end_ts)
         
     def stop_discharge(self, kwargs):
-        now = datetime.now(self.tz)
+        now = self.local_now().timestamp()
 
         next_quarter = any(
-            datetime.fromisoformat(q["start"]) <= now < datetime.fromisoformat(q["end"])
+            q.start_ts <= now < q.end_ts
             for q in self.discharge_schedule
         )
         
@@ -441,30 +895,55 @@ class SungrowScheduler(hass.Hass):
     
         self.log("STOP DISCHARGE")
         
+        self.halt_discharge()
+
+    def begin_discharge(self, quarter):
+        if DISCHARGE_CONTROL == "load_follow":
+            self.load_follower.start(quarter, self.discharge_budget(quarter))
+        else:
+            set_start_discharge(self)
+
+    def halt_discharge(self):
+        self.load_follower.stop()
         set_stop_discharge(self)
-        
-        handle = kwargs.get("__handle")
-        if handle and handle in self.handles["stop_discharge"]:
-            self.handles["stop_discharge"].remove(handle)
 
+    def discharge_budget(self, quarter):
+        # The quarter's load from the profile the plan is built on, or the
+        # recent average, at most an even share of what is left above
+        # MIN_SOC over the planned quarters still ahead
+        energy = None
+        day = quarter.start.date()
+        profile = self.load_profile.profile(day)
+        if profile is not None:
+            i = int((quarter.start_ts - local_midnight(self.tz, day).timestamp()) // 900)
+            if 0 <= i < len(profile):
+                energy = profile[i]
+        if energy is None:
+            energy = self.get_avg_15min_energy()
+        remaining = sum(1 for q in self.discharge_schedule if q.end_ts > quarter.start_ts) or 1
+        available = max(self.battery_soc - MIN_SOC, 0) / 100 * BATTERY_CAPACITY
+        return min(energy, available / remaining)
+
+    @timed("discharge_after_solar")
     def set_discharge_after_solar(self, kwargs):
-        current_soc = float(self.get_state("sensor.battery_level"))
-        self.set_state("input_number.latest_charge_soc", state=current_soc)
-        now = datetime.now(self.tz).isoformat()
+        current_soc = float(self.get_state(self.site.battery_level))
+        self.set_state(self.site.latest_charge_soc, state=current_soc)
+        now = self.local_now()
+        self.after_solar_at = None
 
         if current_soc == 100:
             self.set_state(
-                "input_text.latest_battery_balance_upper",
-                state=now
+                self.site.balance_upper,
+                state=now.isoformat()
             )
         
-        for key in ("charge", "discharge"):
-            for h in self.handles.get(key, []):
-                self.cancel_timer(h)
-            self.handles[key].clear()
+        for key in ("solar", "resume"):
+            self.dispatcher.cancel_group(key)
+        self.charge_windows = []
+        self.charge_quarters = []
         
         prices = self.get_prices()
-        forecast_start, forecast_end = get_forecast(self)
+        forecast_start, forecast_end = get_forecast(self, self.site.forecast)
 
         if forecast_start is not None:
             discharge_end_hour = min(forecast_start.hour, 9)
@@ -474,42 +953,178 @@ class SungrowScheduler(hass.Hass):
         else:
             discharge_end_hour = 9
             discharge_end_minute = 0
+        discharge_end = prices.local_time(1, time(discharge_end_hour, discharge_end_minute))
+
+        self.plan_energy = self.get_avg_15min_energy()
+        self.plan_prices = prices
+        self.replan_soc = current_soc
+        discharge_quarters = self.select_after_solar(prices, now, discharge_end, current_soc)
 
-        start_index = now.hour * 4 + (2 if now.minute >= 30 else 0)
-        end_index = (
-            24 * 4
-            + discharge_end_hour * 4
-            + (2 if discharge_end_minute == 30 else 0)
+        self.log(
+            f"Discharge after solar: {len(discharge_quarters)} quarters "
+            f"until {discharge_end.isoformat()} | SoC: {current_soc}%"
         )
+        self.set_discharge_schedule(discharge_quarters)
+
+        # Hold the battery between the chosen quarters and hand it back to
+        # self-consumption when solar starts
+        now_ts = now.timestamp()
+        if not any(q.start_ts <= now_ts < q.end_ts for q in discharge_quarters):
+            self.halt_discharge()
+        for q in discharge_quarters:
+            if q.start_ts <= now_ts:
+                self.start_discharge({"discharge_quarter": q, "unranked": False})
+        self.arm_plan()
+        self.dispatcher.schedule("resume", self.resume_self_consumption, discharge_end)
+        self.resume_at = discharge_end.isoformat()
+
+        self.save_snapshot()
 
-        discharge_quarters_price_sorted = sorted(
-            (
-                p for p in prices[start_index:end_index]
-                if p["price"] >= -200
-            ),
-            key=lambda p: p["price"],
-            reverse=True
+    def select_after_solar(self, prices, now, discharge_end, soc):
+        window = prices.between(
+            now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0),
+            discharge_end
         )
+
+        # Whatever is discharged tonight is refilled from solar that could
+        # have been exported, so a quarter is only worth it when it beats
+        # tomorrow's production prices by SEK_THRESHOLD
+        forecast_end = get_forecast(self, self.site.forecast)[1]
+        refill_end = forecast_end if forecast_end is not None and forecast_end > discharge_end else discharge_end + timedelta(hours=10)
+        refill = [q.price for q in prices.between(discharge_end, refill_end)]
+        min_price = max(sum(refill) / len(refill) + SEK_THRESHOLD, -200) if refill else -200
+
+        # Spend the energy above MIN_SOC on the most expensive quarters until
+        # solar takes over. Quarters come off a heap only until the battery
+        # is used up, so the window is never fully sorted.
+        demand = self.get_demand(prices)
+        available = ((soc - MIN_SOC) / 100) * BATTERY_CAPACITY
+        heap = [(-q.price, q.start_ts, q) for q in window if q.price >= min_price]
+        heapq.heapify(heap)
+        discharge_quarters = []
+        while heap and available > 0:
+            q = heapq.heappop(heap)[2]
+            index = prices.index_of(q.start_ts) if demand is not None else None
+            energy = max(demand[index], 0) if index is not None else self.plan_energy
+            discharge_quarters.append(q)
+            available -= energy
+        discharge_quarters.sort(key=lambda q: q.start_ts)
+        return discharge_quarters
+
+    def schedule_archive(self):
+        # A second before the quarter ends, while its commands still hold
+        now_ts = self.local_now().timestamp()
+        start = now_ts - now_ts % 900
+        if start + 899 <= now_ts:
+            start += 900
+        self.dispatcher.schedule("archive", self.archive_quarter, start + 899, start=start)
+
+    @timed("archive")
+    def archive_quarter(self, kwargs):
+        start = kwargs["start"]
+        end = start + 900
+        self.schedule_archive()
+
+        action = IDLE
+        target_soc = None
+        for w in self.charge_windows:
+            if datetime.fromisoformat(w["start"]).timestamp() <= start < datetime.fromisoformat(w["end"]).timestamp():
+                action = CHARGE
+                target_soc = w["target_soc"]
+        if any(q.start_ts == start for q in self.discharge_schedule):
+            action = DISCHARGE
+
+        # Forced power, negative while discharging. A followed quarter is
+        # recorded with its mean power.
+        known = self.inverter.known
+        power = 0.0
+        if known.get(EMS_MODE) == "Forced mode" and known.get(FORCED_CMD) == "Forced charge":
+            power = known.get(FORCED_POWER) or 0.0
+        elif known.get(EMS_MODE) == "Forced mode" and known.get(FORCED_CMD) == "Forced discharge":
+            followed = self.load_follower.mean_power()
+            power = -(followed if followed is not None else known.get(FORCED_POWER) or 0.0)
+        index = self.plan_prices.index_of(start) if self.plan_prices is not None else None
+        consumption = None
+        if self.meter_kwh is not None and self.archive_meter_kwh is not None and self.meter_kwh >= self.archive_meter_kwh:
+            consumption = (self.meter_kwh - self.archive_meter_kwh) * 1000
+        self.archive_meter_kwh = self.meter_kwh
+
+        row = {
+            "start": start,
+            "price": self.plan_prices.prices[index] if index is not None else None,
+            "action": action,
+            "power": power,
+            "target_soc": target_soc,
+            "soc": self.battery_soc,
+            "consumption": consumption,
+            "solar": get_solar_forecast(self, self.site.forecast).energy_between(start, end),
+        }
+        try:
+            self.archive.append(row)
+            # The last quarter of a day rolls finished months together
+            next_day = datetime.fromtimestamp(end, self.tz)
+            if next_day.time() == time(0):
+                self.archive.compact(next_day.date())
+        except OSError as e:
+            self.error(f"Could not archive quarter: {e}")
+
+    def resume_self_consumption(self, kwargs):
+        self.resume_at = None
+        self.log("Solar started - back to self-consumption")
+        self.load_follower.stop()
+        set_start_discharge(self)
     
+    def publish_metrics(self, kwargs=None):
+        self.set_state(
+            METRICS_SENSOR,
+            state=self.local_now().isoformat(),
+            attributes=dict(
+                self.metrics.summaries(),
+                counters=self.metrics.counter_values(),
+                plan_cache=self.plan_cache.stats()
+            )
+        )
+        try:
+            self.metrics.write_prometheus(METRICS_FILE)
+        except OSError as e:
+            self.error(f"Could not write {METRICS_FILE}: {e}")
+
+    def local_now(self):
+        # Every time read goes through here so a replay can drive the clock
+        return datetime.now(self.tz)
+
     def is_summer(self):
-        now = datetime.now(self.tz)
-    
-        if now.month in (5, 6, 7, 8):
-            return True
-        elif now.month == 4:
-            return now.day >= 10
-        else:
-            return False
+        return is_summer_day(self.local_now())
     
     
     def is_winter(self):
-        now = datetime.now(self.tz)
-    
-        if now.month in (11, 12, 1, 2):
-            return True
-        elif now.month == 10:
-            return now.day >= 10
-        elif now.month == 3:
-            return now.day < 10
-        else:
-            return False
+        return is_winter_day(self.local_now())
+
+
+def is_summer_day(day):
+    if day.month in (5, 6, 7, 8):
+        return True
+    elif day.month == 4:
+        return day.day >= 10
+    else:
+        return False
+
+
+def is_winter_day(day):
+    if day.month in (11, 12, 1, 2):
+        return True
+    elif day.month == 10:
+        return day.day >= 10
+    elif day.month == 3:
+        return day.day < 10
+    else:
+        return False
+
+
+def season_of(day):
+    # The load profile keeps a bucket per season
+    if is_winter_day(day):
+        return "winter"
+    if is_summer_day(day):
+        return "summer"
+    return "shoulder"
@@ -0,0 +1,67 @@
+from pathlib import Path
+from battery_commands import EMS_MODE, FORCED_CMD, MAX_SOC, FORCED_POWER
+from consumption import CONSUMPTION_SENSOR
+from forecast import FORECAST_SENSOR
+
+STATE_DIR = Path("/conf/apps/sungrow")
+
+# Settings of the original single installation, any of them can be
+# overridden per site
+SITE_DEFAULTS = {
+    "name": "sungrow",
+    "area": "SE3",
+    "currency": "SEK",
+    "config_entry": "01KBGCDMY25VMPA5FNMZCFKN4H",
+    "price_sensor": "sensor.nord_pool_se3_last_updated",
+    "state_dir": STATE_DIR,
+    "battery_level": "sensor.battery_level",
+    "consumption": CONSUMPTION_SENSOR,
+    "load_power": "sensor.load_power",
+    "grid_power": "sensor.meter_active_power",
+    "forecast": FORECAST_SENSOR,
+    "ems_mode": EMS_MODE,
+    "forced_cmd": FORCED_CMD,
+    "max_soc": MAX_SOC,
+    "forced_power": FORCED_POWER,
+    "skip_schedule": "input_boolean.skip_next_battery_schedule",
+    "night_charge_high_price": "input_number.latest_night_charge_high_price",
+    "balance_upper": "input_text.latest_battery_balance_upper",
+    "latest_charge_soc": "input_number.latest_charge_soc",
+}
+
+
+class Site:
+    # One battery installation: its Nordpool area, where its state files
+    # live and the Home Assistant entities it is read and driven through
+    def __init__(self, **settings):
+        unknown = set(settings) - set(SITE_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown site settings: {', '.join(sorted(unknown))}")
+        for name, default in SITE_DEFAULTS.items():
+            setattr(self, name, settings.get(name, default))
+        # A site without a state_dir keeps nothing on disk
+        if self.state_dir is not None:
+            self.state_dir = Path(self.state_dir)
+
+    def __repr__(self):
+        return f"Site({self.name}, {self.area})"
+
+    @property
+    def schedule_file(self):
+        return self.state_dir / "schedules.json" if self.state_dir is not None else None
+
+    @property
+    def load_profile_file(self):
+        return self.state_dir / "load_profile.bin" if self.state_dir is not None else None
+
+    @property
+    def archive_dir(self):
+        return self.state_dir / "archive" if self.state_dir is not None else None
+
+    @property
+    def inverter_entities(self):
+        # In battery_commands.ENTITIES order
+        return (self.ems_mode, self.forced_cmd, self.max_soc, self.forced_power)
+
+
+DEFAULT_SITE = Site()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The app modules live flat at the top of the repo, as AppDaemon loads them
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
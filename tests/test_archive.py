@@ -0,0 +1,180 @@
+import math
+import os
+import shutil
+from array import array
+from datetime import date, datetime
+
+import pytest
+from zoneinfo import ZoneInfo
+
+from archive import CHARGE, COLUMNS, HEADER_SIZE, Chunk, QuarterArchive, header_rows, npy_header
+
+TZ = ZoneInfo("Europe/Stockholm")
+JAN_30 = datetime(2025, 1, 30, tzinfo=TZ).timestamp()
+
+
+def append_quarters(archive, first_ts, count):
+    for i in range(count):
+        assert archive.append({"start": first_ts + i * 900, "price": float(i), "action": CHARGE})
+
+
+def column_rows(chunk):
+    # The row count each column file's header claims
+    rows = {}
+    for name, _, _ in COLUMNS:
+        with (chunk / f"{name}.npy").open("rb") as f:
+            rows[name] = header_rows(f.read(HEADER_SIZE))
+    return rows
+
+
+def test_append_and_read_back(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 4)
+    archive.close()
+
+    rows = QuarterArchive(tmp_path, TZ).read()
+    assert list(rows["start"]) == [JAN_30 + i * 900 for i in range(4)]
+    assert list(rows["price"]) == [0.0, 1.0, 2.0, 3.0]
+    assert list(rows["action"]) == [CHARGE] * 4
+    assert all(math.isnan(value) for value in rows["soc"])
+
+
+def test_quarters_out_of_order_are_refused(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 2)
+    assert not archive.append({"start": JAN_30 + 900})
+    assert not archive.append({"start": JAN_30})
+    archive.close()
+    assert len(QuarterArchive(tmp_path, TZ).read()["start"]) == 2
+
+
+def test_open_chunk_cuts_off_a_half_written_row(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 3)
+    archive.close()
+    chunk = tmp_path / "days" / "2025-01-30"
+
+    # A crash after the data of row 4 went out, before its row count did,
+    # and with only some of the columns written
+    for name, typecode, _ in COLUMNS[:5]:
+        with (chunk / f"{name}.npy").open("ab") as f:
+            f.write(array(typecode, [7]).tobytes())
+
+    reopened = QuarterArchive(tmp_path, TZ)
+    assert not reopened.append({"start": JAN_30 + 2 * 900})
+    assert reopened.append({"start": JAN_30 + 3 * 900, "price": 42.0})
+    reopened.close()
+
+    assert set(column_rows(chunk).values()) == {4}
+    for name, typecode, _ in COLUMNS:
+        size = (chunk / f"{name}.npy").stat().st_size
+        assert size == HEADER_SIZE + 4 * array(typecode).itemsize
+    assert list(QuarterArchive(tmp_path, TZ).read()["price"]) == [0.0, 1.0, 2.0, 42.0]
+
+
+def test_open_chunk_takes_the_shortest_column(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 3)
+    archive.close()
+    chunk = tmp_path / "days" / "2025-01-30"
+
+    # A crash between the headers of the columns of row 3
+    name, typecode, descr = COLUMNS[-1]
+    with (chunk / f"{name}.npy").open("r+b") as f:
+        f.write(npy_header(descr, 2))
+
+    reopened = QuarterArchive(tmp_path, TZ)
+    assert reopened.append({"start": JAN_30 + 2 * 900, "price": 9.0})
+    reopened.close()
+    assert list(QuarterArchive(tmp_path, TZ).read()["price"]) == [0.0, 1.0, 9.0]
+
+
+def test_compact_rolls_finished_months(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    # Jan 30 to Feb 1, then compacted on Feb 2
+    append_quarters(archive, JAN_30, 3 * 96)
+    assert archive.compact(date(2025, 2, 2)) == ["2025-01"]
+    archive.close()
+
+    assert sorted(p.name for p in (tmp_path / "days").iterdir()) == ["2025-02-01"]
+    with Chunk(tmp_path / "months" / "2025-01") as chunk:
+        assert len(chunk) == 2 * 96
+    assert len(QuarterArchive(tmp_path, TZ).read()["start"]) == 3 * 96
+
+
+def test_compact_merges_an_interrupted_run_once(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 2 * 96)
+    archive.close()
+    days = tmp_path / "days"
+
+    # The month chunk was written but the day chunks were not removed yet
+    months = tmp_path / "months" / "2025-01"
+    months.mkdir(parents=True)
+    sources = [Chunk(days / "2025-01-30"), Chunk(days / "2025-01-31")]
+    archive.write_merged(months, sources)
+    for chunk in sources:
+        chunk.close()
+
+    assert QuarterArchive(tmp_path, TZ).compact(date(2025, 2, 1)) == ["2025-01"]
+    starts = QuarterArchive(tmp_path, TZ).read()["start"]
+    assert list(starts) == [JAN_30 + i * 900 for i in range(2 * 96)]
+    assert not days.exists() or not any(days.iterdir())
+
+
+def interrupted_compact(tmp_path):
+    # January 30 went into the month chunk on an earlier run, January 31
+    # is being added: the old chunk is moved aside, the new one is only
+    # in the .tmp folder
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 2 * 96)
+    archive.close()
+    days = tmp_path / "days"
+    months = tmp_path / "months"
+    months.mkdir()
+    with Chunk(days / "2025-01-30") as chunk:
+        (months / "2025-01.old").mkdir()
+        archive.write_merged(months / "2025-01.old", [chunk])
+    shutil.rmtree(days / "2025-01-30")
+    with Chunk(months / "2025-01.old") as old, Chunk(days / "2025-01-31") as day:
+        (months / "2025-01.tmp").mkdir()
+        archive.write_merged(months / "2025-01.tmp", [old, day])
+    return months
+
+
+def test_compact_recovers_a_month_moved_aside(tmp_path):
+    months = interrupted_compact(tmp_path)
+    assert QuarterArchive(tmp_path, TZ).compact(date(2025, 2, 1)) == ["2025-01"]
+
+    assert sorted(p.name for p in months.iterdir()) == ["2025-01"]
+    starts = QuarterArchive(tmp_path, TZ).read()["start"]
+    assert list(starts) == [JAN_30 + i * 900 for i in range(2 * 96)]
+
+
+def test_compact_drops_a_month_replaced_before_the_crash(tmp_path):
+    months = interrupted_compact(tmp_path)
+    os.replace(months / "2025-01.tmp", months / "2025-01")
+
+    assert QuarterArchive(tmp_path, TZ).compact(date(2025, 2, 1)) == ["2025-01"]
+    assert sorted(p.name for p in months.iterdir()) == ["2025-01"]
+    assert len(QuarterArchive(tmp_path, TZ).read()["start"]) == 2 * 96
+
+
+def test_compact_skips_the_current_month(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 4)
+    assert archive.compact(date(2025, 1, 31)) == []
+    assert archive.append({"start": JAN_30 + 4 * 900})
+    archive.close()
+
+
+def test_closed_chunk_refuses_reads(tmp_path):
+    archive = QuarterArchive(tmp_path, TZ)
+    append_quarters(archive, JAN_30, 2)
+    archive.close()
+
+    chunk = Chunk(tmp_path / "days" / "2025-01-30")
+    starts = chunk.columns["start"]
+    chunk.close()
+    with pytest.raises(ValueError):
+        starts[0]
@@ -0,0 +1,130 @@
+import asyncio
+from zoneinfo import ZoneInfo
+
+from battery_commands import (
+    EMS_MODE,
+    FORCED_CMD,
+    FORCED_POWER,
+    MAX_SOC,
+    AsyncInverterCommander,
+    InverterCommander,
+)
+from benchmarks.fake_hass import FakeHass
+
+TZ = ZoneInfo("Europe/Stockholm")
+STOPPED = {
+    EMS_MODE: "Self-consumption mode (default)",
+    FORCED_CMD: "Stop (default)",
+    MAX_SOC: "100",
+    FORCED_POWER: "0",
+}
+
+
+def make_commander(commander_class=InverterCommander, app=None):
+    app = app or FakeHass(states=STOPPED, tz=TZ)
+    commander = commander_class(app, coalesce_seconds=5)
+    commander.resync()
+    return app, commander
+
+
+def written(app):
+    return [
+        (kwargs["entity_id"], kwargs.get("option", kwargs.get("value")))
+        for service, kwargs in app.service_calls
+    ]
+
+
+def end_window(app):
+    # What AppDaemon does when the coalesce timer is due
+    (handle, (kind, callback, when, kwargs)), = app.timers.items()
+    del app.timers[handle]
+    return callback(kwargs)
+
+
+def test_unchanged_state_is_not_sent_again():
+    app, commander = make_commander()
+    commander.request({FORCED_CMD: "Stop (default)", MAX_SOC: 100.0, FORCED_POWER: 0.0})
+    assert written(app) == []
+    assert not app.timers
+
+
+def test_writes_inside_the_window_collapse_to_the_last_value():
+    app, commander = make_commander()
+    commander.request({FORCED_POWER: 1000.0})
+    commander.request({FORCED_POWER: 2000.0})
+    commander.request({FORCED_POWER: 1500.0})
+    assert written(app) == [(FORCED_POWER, 1000.0)]
+
+    end_window(app)
+    assert written(app) == [(FORCED_POWER, 1000.0), (FORCED_POWER, 1500.0)]
+    # The write at the end of the window opened the next one
+    assert len(app.timers) == 1
+
+
+def test_window_ends_quietly_when_nothing_changed():
+    app, commander = make_commander()
+    commander.request({FORCED_POWER: 1000.0})
+    commander.request({FORCED_POWER: 0.0})
+    commander.request({FORCED_POWER: 1000.0})
+
+    end_window(app)
+    assert written(app) == [(FORCED_POWER, 1000.0)]
+    assert not app.timers
+
+
+def test_immediate_write_bypasses_the_window():
+    app, commander = make_commander()
+    commander.request({FORCED_POWER: 1000.0})
+    commander.request({FORCED_CMD: "Forced discharge"})
+    commander.request({FORCED_POWER: 3000.0}, immediate=True)
+
+    # Takes what was waiting along and leaves no window behind
+    assert written(app) == [
+        (FORCED_POWER, 1000.0),
+        (FORCED_CMD, "Forced discharge"),
+        (FORCED_POWER, 3000.0),
+    ]
+    assert not app.timers
+
+    commander.request({FORCED_POWER: 500.0})
+    assert written(app)[-1] == (FORCED_POWER, 500.0)
+
+
+def test_writes_follow_the_inverter_order():
+    app, commander = make_commander()
+    commander.request({FORCED_POWER: 2000.0, FORCED_CMD: "Forced charge", EMS_MODE: "Forced mode"})
+    assert [entity_id for entity_id, value in written(app)] == [EMS_MODE, FORCED_CMD, FORCED_POWER]
+
+
+class AsyncApp(FakeHass):
+    # Service calls take a turn of the loop, so the log shows which ones
+    # were in flight together
+    def __init__(self):
+        super().__init__(states=STOPPED, tz=TZ)
+        self.calls = []
+
+    async def call_service(self, service, **kwargs):
+        self.calls.append(("start", kwargs["entity_id"]))
+        await asyncio.sleep(0)
+        super().call_service(service, **kwargs)
+        self.calls.append(("end", kwargs["entity_id"]))
+
+
+def test_async_ems_mode_lands_before_the_rest():
+    app, commander = make_commander(AsyncInverterCommander, AsyncApp())
+    commander.request({FORCED_POWER: 2000.0, FORCED_CMD: "Forced discharge", EMS_MODE: "Forced mode"})
+    asyncio.run(end_window(app))
+
+    assert app.calls[:2] == [("start", EMS_MODE), ("end", EMS_MODE)]
+    assert {entity_id for _, entity_id in app.calls[2:]} == {FORCED_CMD, FORCED_POWER}
+    # The others went out together
+    assert [event for event, _ in app.calls[2:]] == ["start", "start", "end", "end"]
+    assert commander.known[FORCED_POWER] == 2000.0
+
+
+def test_async_immediate_write_opens_no_window():
+    app, commander = make_commander(AsyncInverterCommander, AsyncApp())
+    commander.request({FORCED_POWER: 2000.0}, immediate=True)
+    asyncio.run(end_window(app))
+    assert written(app) == [(FORCED_POWER, 2000.0)]
+    assert not app.timers
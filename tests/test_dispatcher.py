@@ -0,0 +1,112 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from benchmarks.fake_hass import FakeHass
+from dispatcher import Dispatcher
+
+TZ = ZoneInfo("Europe/Stockholm")
+T0 = datetime(2025, 1, 15, 12, 0, tzinfo=TZ).timestamp()
+
+
+def make_dispatcher():
+    app = FakeHass(tz=TZ)
+    app.clock = T0
+    dispatcher = Dispatcher(app, TZ, clock=lambda: datetime.fromtimestamp(app.clock, TZ))
+    return app, dispatcher
+
+
+def armed_at(app):
+    # The one AppDaemon timer the dispatcher keeps, as a timestamp
+    timers = [timer for timer in app.timers.values() if timer[0] == "run_at"]
+    assert len(timers) <= 1
+    return timers[0][2].timestamp() if timers else None
+
+
+def run_timer(app, until):
+    # What AppDaemon does when the armed timer is due
+    app.clock = until
+    handle, (kind, callback, when, kwargs) = next(iter(app.timers.items()))
+    assert when.timestamp() <= until
+    del app.timers[handle]
+    callback(kwargs)
+
+
+def test_fires_in_time_order():
+    app, dispatcher = make_dispatcher()
+    fired = []
+    for offset in (300, 100, 200, 100):
+        dispatcher.schedule("plan", lambda kwargs: fired.append(kwargs["offset"]), T0 + offset, offset=offset)
+    assert armed_at(app) == T0 + 100
+
+    run_timer(app, T0 + 300)
+    assert fired == [100, 100, 200, 300]
+    assert armed_at(app) is None
+
+
+def test_cancel_rearms_for_the_next_event():
+    app, dispatcher = make_dispatcher()
+    fired = []
+    first = dispatcher.schedule("plan", lambda kwargs: fired.append("first"), T0 + 100)
+    dispatcher.schedule("plan", lambda kwargs: fired.append("second"), T0 + 200)
+
+    dispatcher.cancel(first)
+    assert armed_at(app) == T0 + 200
+
+    run_timer(app, T0 + 200)
+    assert fired == ["second"]
+
+
+def test_cancel_group_leaves_other_groups():
+    app, dispatcher = make_dispatcher()
+    fired = []
+    dispatcher.schedule("charge", lambda kwargs: fired.append("charge"), T0 + 100)
+    dispatcher.schedule("discharge", lambda kwargs: fired.append("discharge"), T0 + 200)
+
+    dispatcher.cancel_group("charge")
+    assert armed_at(app) == T0 + 200
+    # Scheduled after the cancel, so it belongs to the new generation
+    dispatcher.schedule("charge", lambda kwargs: fired.append("charge again"), T0 + 300)
+
+    run_timer(app, T0 + 300)
+    assert fired == ["discharge", "charge again"]
+
+
+def test_rearms_for_what_is_left_after_firing():
+    app, dispatcher = make_dispatcher()
+    fired = []
+    dispatcher.schedule("plan", lambda kwargs: fired.append("late"), T0 + 600)
+    dispatcher.schedule("plan", lambda kwargs: fired.append("early"), T0 + 60)
+
+    run_timer(app, T0 + 60)
+    assert fired == ["early"]
+    assert armed_at(app) == T0 + 600
+
+
+def test_failing_callback_does_not_stop_the_rest():
+    app, dispatcher = make_dispatcher()
+    fired = []
+    errors = []
+    app.error = lambda msg, *args, **kwargs: errors.append(msg)
+
+    def fail(kwargs):
+        raise RuntimeError("boom")
+
+    dispatcher.schedule("plan", fail, T0 + 10)
+    dispatcher.schedule("plan", lambda kwargs: fired.append("after"), T0 + 20)
+
+    run_timer(app, T0 + 20)
+    assert fired == ["after"]
+    assert len(errors) == 1
+
+
+def test_scopes_only_cancel_their_own_groups():
+    app, dispatcher = make_dispatcher()
+    fired = []
+    home = dispatcher.scope("home")
+    cabin = dispatcher.scope("cabin")
+    home.schedule("charge", lambda kwargs: fired.append("home"), T0 + 100)
+    cabin.schedule("charge", lambda kwargs: fired.append("cabin"), T0 + 100)
+
+    home.cancel_group("charge")
+    run_timer(app, T0 + 100)
+    assert fired == ["cabin"]
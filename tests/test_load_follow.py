@@ -0,0 +1,143 @@
+from datetime import datetime
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+from battery_commands import FORCED_CMD, FORCED_POWER, InverterCommander
+from benchmarks.fake_hass import FakeHass
+from dispatcher import Dispatcher
+from load_follow import LoadFollower
+
+TZ = ZoneInfo("Europe/Stockholm")
+T0 = datetime(2025, 1, 15, 17, 0, tzinfo=TZ).timestamp()
+QUARTER = SimpleNamespace(start_ts=T0, end_ts=T0 + 900)
+
+
+class FollowApp(FakeHass):
+    def __init__(self):
+        super().__init__(tz=TZ)
+        self.clock = T0
+        self.dispatcher = Dispatcher(self, TZ, clock=self.local_now)
+        self.inverter = InverterCommander(self, coalesce_seconds=0)
+
+    def local_now(self):
+        return datetime.fromtimestamp(self.clock, TZ)
+
+    def advance(self, seconds):
+        # Moves the clock and runs what the dispatcher has due by then
+        self.clock += seconds
+        while self.dispatcher.heap and self.dispatcher.heap[0][0] <= self.clock:
+            self.dispatcher.fire()
+
+    def written_powers(self):
+        return [
+            kwargs["value"] for service, kwargs in self.service_calls
+            if kwargs.get("entity_id") == FORCED_POWER
+        ]
+
+
+def start(budget_wh=1000, load_w=None, **settings):
+    app = FollowApp()
+    follower = LoadFollower(app, **settings)
+    if load_w is not None:
+        follower.on_load_power("sensor.load", "state", None, str(load_w), {})
+    follower.start(QUARTER, budget_wh)
+    return app, follower
+
+
+def test_starts_at_the_live_load():
+    app, follower = start(load_w=1800)
+    assert app.written_powers() == [1800.0]
+    assert app.inverter.known[FORCED_CMD] == "Forced discharge"
+
+
+def test_starts_at_the_budget_rate_without_a_reading():
+    app, follower = start(budget_wh=500)
+    assert app.written_powers() == [2000.0]
+
+
+def test_changes_inside_the_deadband_are_not_written():
+    app, follower = start(load_w=1500, deadband=150, min_interval=0)
+    app.advance(30)
+    follower.on_load_power("sensor.load", "state", None, "1600", {})
+    follower.on_load_power("sensor.load", "state", None, "1400", {})
+    assert app.written_powers() == [1500.0]
+
+    follower.on_load_power("sensor.load", "state", None, "1700", {})
+    assert app.written_powers() == [1500.0, 1700.0]
+
+
+def test_falling_to_zero_is_written_inside_the_deadband():
+    app, follower = start(load_w=100, deadband=150, min_interval=0)
+    app.advance(30)
+    follower.on_load_power("sensor.load", "state", None, "-50", {})
+    assert app.written_powers() == [100.0, 0.0]
+
+
+def test_power_is_capped_by_what_is_left_of_the_budget():
+    # 450 Wh over 900 s allows 1800 W on average
+    app, follower = start(budget_wh=450, load_w=3000, min_interval=0)
+    assert app.written_powers() == [1800.0]
+
+    # Half the quarter at 1800 W uses up 225 Wh, the rest may not go faster
+    app.advance(450)
+    follower.on_load_power("sensor.load", "state", None, "4000", {})
+    assert follower.power == 1800.0
+    assert abs(follower.discharged_wh - 225) < 1e-6
+
+
+def test_power_never_exceeds_max_power():
+    app, follower = start(budget_wh=5000, load_w=9000, max_power=5000)
+    assert app.written_powers() == [5000.0]
+
+
+def test_late_start_gets_its_share_of_the_budget():
+    app = FollowApp()
+    app.clock = T0 + 450
+    follower = LoadFollower(app)
+    follower.start(QUARTER, 1000)
+    assert follower.budget_wh == 500
+
+
+def test_writes_within_min_interval_are_deferred():
+    app, follower = start(load_w=1000, deadband=150, min_interval=5)
+    app.advance(1)
+    follower.on_load_power("sensor.load", "state", None, "2000", {})
+    follower.on_load_power("sensor.load", "state", None, "2500", {})
+    assert app.written_powers() == [1000.0]
+
+    # One deferred write when the interval ends, with the latest load
+    app.advance(3)
+    assert app.written_powers() == [1000.0]
+    app.advance(1)
+    assert app.written_powers() == [1000.0, 2500.0]
+    app.advance(10)
+    assert app.written_powers() == [1000.0, 2500.0]
+
+
+def test_grid_readings_trim_the_load():
+    app, follower = start(load_w=1000, deadband=150, min_interval=5)
+    app.advance(10)
+    # 400 W still bought, so the load sensor misses that much
+    follower.on_grid_power("sensor.grid", "state", None, "400", {})
+    assert app.written_powers() == [1000.0, 1400.0]
+    app.advance(10)
+    follower.on_load_power("sensor.load", "state", None, "1200", {})
+    assert app.written_powers() == [1000.0, 1400.0, 1600.0]
+
+
+def test_grid_readings_right_after_a_write_are_ignored():
+    app, follower = start(load_w=1000, min_interval=5)
+    app.advance(2)
+    follower.on_grid_power("sensor.grid", "state", None, "800", {})
+    assert app.written_powers() == [1000.0]
+    assert follower.trim == 0
+
+
+def test_stop_cancels_a_deferred_write():
+    app, follower = start(load_w=1000, min_interval=5)
+    app.advance(1)
+    follower.on_load_power("sensor.load", "state", None, "2000", {})
+    follower.stop()
+    app.advance(10)
+    assert app.written_powers() == [1000.0, 0.0]
+    assert follower.mean_power() is None
@@ -0,0 +1,159 @@
+import math
+import random
+from datetime import date, datetime, time, timedelta
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from benchmarks.corpus import generate_scenarios
+from constants import CHEAP_CHARGE_PRICE, MAX_CHARGE_POWER, MIN_CHARGE_POWER, SEK_THRESHOLD
+from optimizer import allocate_charge, evaluate_candidate, select_night_plan, sweep_night_thresholds
+from price_series import PriceSeries
+
+TZ = ZoneInfo("Europe/Stockholm")
+CORPUS = generate_scenarios(seed=2025, count=12)
+
+
+def two_days(today, tomorrow, first_day=date(2025, 1, 15)):
+    # Hourly price lists for today and tomorrow, four quarters each
+    start = datetime(first_day.year, first_day.month, first_day.day, tzinfo=TZ)
+    quarters = []
+    for i, price in enumerate(p for p in today + tomorrow for _ in range(4)):
+        quarter_start = start + timedelta(minutes=15 * i)
+        quarters.append({
+            "start": quarter_start.isoformat(),
+            "end": (quarter_start + timedelta(minutes=15)).isoformat(),
+            "price": price,
+        })
+    return PriceSeries.from_quarters(quarters, TZ)
+
+
+def brute_force_price(prices, avg_15min_energy_wh, current_soc):
+    # Every night price tried as threshold with evaluate_candidate, as
+    # before the sweep
+    best = None
+    best_price = None
+    night = prices.between(time(22), time(6))
+    for price in sorted({q.price for q in night}):
+        candidate = evaluate_candidate(prices, price, avg_15min_energy_wh, current_soc)
+        if candidate and (best is None or (candidate[2], len(candidate[0])) > best):
+            best = (candidate[2], len(candidate[0]))
+            best_price = price
+    return best_price
+
+
+def brute_force_plan(prices, avg_15min_energy_wh, current_soc):
+    night = prices.between(time(22), time(6))
+    day = prices.between(time(6), time(22), day=1)
+    cheap = [q for q in night if q.price < CHEAP_CHARGE_PRICE]
+    price = brute_force_price(prices, avg_15min_energy_wh, current_soc)
+    if price is None:
+        return cheap, []
+    charge = {q.start_ts: q for q in evaluate_candidate(prices, price, avg_15min_energy_wh, current_soc)[0] + cheap}
+    return sorted(charge.values(), key=lambda q: q.start_ts), [q for q in day if q.price >= price + SEK_THRESHOLD]
+
+
+def sweep_price(prices, avg_15min_energy_wh, current_soc):
+    night = prices.between(time(22), time(6))
+    day = prices.between(time(6), time(22), day=1)
+    return sweep_night_thresholds(night, day, avg_15min_energy_wh, current_soc)
+
+
+@pytest.mark.parametrize("scenario", CORPUS)
+@pytest.mark.parametrize("current_soc", [None, 30, 95])
+def test_sweep_matches_brute_force_on_the_corpus(scenario, current_soc):
+    soc = scenario.current_soc if current_soc is None else current_soc
+    args = (scenario.prices, scenario.avg_15min_energy_wh, soc)
+    assert sweep_price(*args) == brute_force_price(*args)
+    assert select_night_plan(*args) == brute_force_plan(*args)
+
+
+def test_all_equal_prices():
+    prices = two_days([500.0] * 24, [500.0] * 24)
+    assert brute_force_price(prices, 400, 40) is None
+    assert sweep_price(prices, 400, 40) is None
+    assert select_night_plan(prices, 400, 40) == ([], [])
+
+
+def test_no_profitable_candidate():
+    # Tomorrow never beats tonight by the threshold
+    prices = two_days([300.0] * 22 + [400.0, 420.0], [410.0] * 6 + [500.0] * 16 + [450.0] * 2)
+    assert brute_force_price(prices, 400, 40) is None
+    assert sweep_price(prices, 400, 40) is None
+    assert select_night_plan(prices, 400, 40) == ([], [])
+
+
+def test_one_clear_threshold():
+    prices = two_days([300.0] * 22 + [100.0, 110.0], [105.0] * 6 + [900.0] * 16 + [300.0] * 2)
+    price = brute_force_price(prices, 400, 30)
+    assert price is not None
+    assert sweep_price(prices, 400, 30) == price
+    assert select_night_plan(prices, 400, 30) == brute_force_plan(prices, 400, 30)
+
+
+def quarters(*prices):
+    # Consecutive quarters from t=0 with the given prices
+    return [
+        SimpleNamespace(start_ts=i * 900, end_ts=(i + 1) * 900, price=price)
+        for i, price in enumerate(prices)
+    ]
+
+
+def sorted_allocation(charge_quarters, charge_amount):
+    # Fills the fully sorted quarters one at a time, the allocation
+    # nsmallest picks in one pass
+    if not charge_quarters or charge_amount <= 0:
+        return []
+    needed = charge_amount * 1.1
+    order = sorted(range(len(charge_quarters)), key=lambda i: (charge_quarters[i].price, i))
+    powers = {}
+    for i in order:
+        if needed <= 0:
+            break
+        energy = min(needed, MAX_CHARGE_POWER * 0.25)
+        power = math.ceil(round(energy * 4 / 100, 6)) * 100
+        powers[i] = min(max(power, MIN_CHARGE_POWER), MAX_CHARGE_POWER)
+        needed -= energy
+    return [(charge_quarters[i], powers[i]) for i in sorted(powers)]
+
+
+def test_allocation_matches_a_full_sort():
+    rng = random.Random(18)
+    for _ in range(500):
+        # Few distinct prices, so ties are common
+        plan = quarters(*(rng.choice((50.0, 80.0, 80.0, 120.0, 300.0)) for _ in range(rng.randint(1, 32))))
+        charge_amount = rng.uniform(-500, 12000)
+        assert allocate_charge(plan, charge_amount) == sorted_allocation(plan, charge_amount)
+
+
+def test_cheapest_quarters_charge_at_full_power():
+    plan = quarters(300, 100, 200, 50)
+    # 2500 Wh plus losses: two full quarters and 750 Wh in the third
+    assert [(q.price, power) for q, power in allocate_charge(plan, 2500)] == [
+        (100, MAX_CHARGE_POWER), (200, 3000), (50, MAX_CHARGE_POWER),
+    ]
+
+
+def test_equal_prices_go_to_the_earlier_quarter():
+    plan = quarters(200, 100, 100, 100, 300)
+    allocation = allocate_charge(plan, 1500)
+    assert [(q.start_ts, power) for q, power in allocation] == [(900, MAX_CHARGE_POWER), (1800, 2600)]
+
+
+def test_small_remainder_runs_at_min_charge_power():
+    plan = quarters(100, 200, 300)
+    # 1100 Wh with losses leaves 100 Wh, 400 W, for the second quarter
+    allocation = allocate_charge(plan, 1000)
+    assert [power for _, power in allocation] == [MAX_CHARGE_POWER, MIN_CHARGE_POWER]
+    assert allocate_charge(plan, 10) == [(plan[0], MIN_CHARGE_POWER)]
+
+
+def test_more_than_the_quarters_can_take():
+    plan = quarters(100, 200)
+    assert [power for _, power in allocate_charge(plan, 50000)] == [MAX_CHARGE_POWER] * 2
+
+
+def test_nothing_to_charge():
+    assert allocate_charge(quarters(100), 0) == []
+    assert allocate_charge([], 1000) == []
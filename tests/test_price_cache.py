@@ -0,0 +1,83 @@
+import json
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from price_cache import PriceCache
+
+TZ = ZoneInfo("Europe/Stockholm")
+DAY = date(2025, 1, 15)
+
+
+def nordpool_day(day, quarters=96):
+    start = datetime(day.year, day.month, day.day, tzinfo=TZ)
+    return [
+        {
+            "start": (start + timedelta(minutes=15 * i)).isoformat(),
+            "end": (start + timedelta(minutes=15 * (i + 1))).isoformat(),
+            "price": 100 + i,
+        }
+        for i in range(quarters)
+    ]
+
+
+def test_unknown_day_has_to_be_fetched():
+    cache = PriceCache()
+    assert cache.get("SE3", "SEK", DAY, now=0) is None
+
+
+def test_miss_is_remembered_for_its_ttl():
+    cache = PriceCache(miss_ttl=300)
+    assert cache.put("SE3", "SEK", DAY, [], now=1000) == []
+    assert cache.get("SE3", "SEK", DAY, now=1000) == []
+    assert cache.get("SE3", "SEK", DAY, now=1299) == []
+    assert cache.get("SE3", "SEK", DAY, now=1300) is None
+    # Once it ran out the day is fetched on every get until the next miss
+    assert cache.get("SE3", "SEK", DAY, now=1301) is None
+
+
+def test_incomplete_day_counts_as_a_miss():
+    cache = PriceCache(miss_ttl=300)
+    assert cache.put("SE3", "SEK", DAY, nordpool_day(DAY, 48), now=1000) == []
+    assert cache.get("SE3", "SEK", DAY, now=1100) == []
+
+
+def test_expire_drops_a_fresh_miss():
+    cache = PriceCache(miss_ttl=300)
+    cache.put("SE3", "SEK", DAY, [], now=1000)
+    cache.expire("SE3", "SEK", DAY)
+    assert cache.get("SE3", "SEK", DAY, now=1001) is None
+
+
+def test_expire_keeps_complete_days():
+    cache = PriceCache()
+    cache.put("SE3", "SEK", DAY, nordpool_day(DAY), now=1000)
+    cache.expire("SE3", "SEK", DAY)
+    assert len(cache.get("SE3", "SEK", DAY, now=10 ** 9)) == 96
+
+
+def test_complete_day_replaces_a_miss():
+    cache = PriceCache(miss_ttl=300)
+    cache.put("SE3", "SEK", DAY, [], now=1000)
+    quarters = cache.put("SE3", "SEK", DAY, nordpool_day(DAY), now=1100)
+    assert len(quarters) == 96
+    assert cache.get("SE3", "SEK", DAY, now=1100) is quarters
+    assert not cache.misses
+
+
+def test_misses_are_per_area():
+    cache = PriceCache(miss_ttl=300)
+    cache.put("SE3", "SEK", DAY, [], now=1000)
+    assert cache.get("SE4", "SEK", DAY, now=1000) is None
+
+
+def test_only_complete_days_are_saved(tmp_path):
+    path = tmp_path / "prices.json"
+    cache = PriceCache(path)
+    cache.put("SE3", "SEK", DAY, nordpool_day(DAY), now=1000)
+    cache.put("SE3", "SEK", DAY + timedelta(days=1), [], now=1000)
+
+    loaded = PriceCache(path)
+    loaded.load()
+    assert len(loaded.get("SE3", "SEK", DAY, now=1000)) == 96
+    assert loaded.get("SE3", "SEK", DAY + timedelta(days=1), now=1000) is None
+    assert list(json.loads(path.read_text())["days"]) == ["SE3|SEK|2025-01-15"]
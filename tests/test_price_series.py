@@ -0,0 +1,80 @@
+import random
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from benchmarks.corpus import generate_price_day
+from price_series import PriceSeries, quarters_in_day
+
+TZ = ZoneInfo("Europe/Stockholm")
+SPRING_FORWARD = date(2025, 3, 30)
+FALL_BACK = date(2025, 10, 26)
+
+
+def series_from(first_day, days=2):
+    rng = random.Random(7)
+    quarters = []
+    for i in range(days):
+        quarters.extend(generate_price_day(rng, first_day + timedelta(days=i)))
+    return PriceSeries.from_quarters(quarters, TZ, first_day=first_day)
+
+
+@pytest.mark.parametrize("day, quarters", [
+    (date(2025, 1, 15), 96),
+    (SPRING_FORWARD, 92),
+    (FALL_BACK, 100),
+])
+def test_quarters_in_day(day, quarters):
+    assert quarters_in_day(TZ, day) == quarters
+
+
+@pytest.mark.parametrize("day", [SPRING_FORWARD, FALL_BACK])
+def test_dst_day_is_complete(day):
+    prices = series_from(day - timedelta(days=1))
+    assert len(prices) == 96 + quarters_in_day(TZ, day)
+    assert prices.is_complete_day(0)
+    assert prices.is_complete_day(1)
+    assert len(prices.day(1)) == quarters_in_day(TZ, day)
+
+
+def test_night_into_spring_forward_is_an_hour_short():
+    prices = series_from(SPRING_FORWARD - timedelta(days=1))
+    night = prices.between(time(22), time(6))
+    assert len(night) == 7 * 4
+    assert night[0].start == datetime(2025, 3, 29, 22, tzinfo=TZ)
+    assert night[-1].end == datetime(2025, 3, 30, 6, tzinfo=TZ)
+
+
+def test_night_into_fall_back_is_an_hour_long():
+    prices = series_from(FALL_BACK - timedelta(days=1))
+    night = prices.between(time(22), time(6))
+    assert len(night) == 9 * 4
+    assert night[-1].end == datetime(2025, 10, 26, 6, tzinfo=TZ)
+
+
+def test_between_local_times_on_the_dst_day():
+    prices = series_from(FALL_BACK)
+    # 00:00 to 06:00 on the day the clocks go back holds seven hours
+    assert len(prices.between(time(0), time(6))) == 7 * 4
+    assert len(prices.between(time(6), time(22))) == 16 * 4
+
+
+def test_index_of_the_repeated_hour():
+    prices = series_from(FALL_BACK)
+    first = datetime(2025, 10, 26, 2, 30, tzinfo=TZ)
+    second = first.replace(fold=1)
+    assert second.timestamp() - first.timestamp() == 3600
+
+    # 02:30 comes twice, summer time first
+    assert prices.index_of(first) == 2 * 4 + 2
+    assert prices.index_of(second) == 3 * 4 + 2
+    assert prices.index_of(datetime(2025, 10, 26, 3, tzinfo=TZ)) == 4 * 4
+    assert prices[prices.index_of(second)].start == second
+
+
+def test_index_of_after_the_skipped_hour():
+    prices = series_from(SPRING_FORWARD)
+    assert prices.index_of(datetime(2025, 3, 30, 1, 45, tzinfo=TZ)) == 7
+    assert prices.index_of(datetime(2025, 3, 30, 3, tzinfo=TZ)) == 8
+    assert prices.index_of(prices.ends[-1]) is None
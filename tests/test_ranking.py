@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+from ranking import DischargeRanking
+
+
+def quarters(*prices):
+    # Consecutive quarters from t=0 with the given prices
+    return [
+        SimpleNamespace(start_ts=i * 900, end_ts=(i + 1) * 900, price=price)
+        for i, price in enumerate(prices)
+    ]
+
+
+def naive_rank(plan, quarter, now_ts):
+    # Equal prices keep plan order, the earlier quarter ranks higher
+    order = sorted(plan, key=lambda q: q.price, reverse=True)
+    return sum(1 for q in order[: order.index(quarter)] if q.end_ts > now_ts)
+
+
+def test_rank_counts_more_expensive_quarters():
+    plan = quarters(120, 300, 80, 250)
+    ranking = DischargeRanking(plan)
+    assert [ranking.rank(q, 0) for q in plan] == [2, 0, 3, 1]
+
+
+def test_equal_prices_rank_in_plan_order():
+    plan = quarters(75, 75, 90)
+    ranking = DischargeRanking(plan)
+    assert [ranking.rank(q, 0) for q in plan] == [1, 2, 0]
+
+
+def test_rank_after_quarters_end():
+    plan = quarters(120, 300, 80, 250, 90)
+    ranking = DischargeRanking(plan)
+    assert ranking.rank(plan[4], 0) == 3
+    # The first quarter is over at 900, the most expensive one at 1800
+    assert ranking.rank(plan[4], 900) == 2
+    assert ranking.rank(plan[4], 1800) == 1
+    assert ranking.rank(plan[4], 1800) == 1
+
+
+def test_rank_matches_a_recount_as_the_plan_runs():
+    plan = quarters(50, 410, 75, 75, 320, 15, 250, 260, 90, 410)
+    ranking = DischargeRanking(plan)
+    for now_ts in range(0, 900 * len(plan), 450):
+        for q in plan:
+            if q.end_ts > now_ts:
+                assert ranking.rank(q, now_ts) == naive_rank(plan, q, now_ts)
+
+
+def test_unknown_quarter_has_no_rank():
+    ranking = DischargeRanking(quarters(100, 200))
+    stranger = SimpleNamespace(start_ts=123, end_ts=1023, price=500)
+    assert ranking.rank(stranger, 0) is None
+
+
+def test_empty_plan():
+    ranking = DischargeRanking([])
+    assert ranking.rank(SimpleNamespace(start_ts=0, end_ts=900, price=1), 0) is None